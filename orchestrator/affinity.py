@@ -0,0 +1,90 @@
+import json
+import hashlib
+from prometheus_client import Counter, Histogram
+from .context import content_text, estimate_messages
+
+affinity_events = Counter('neural_home_affinity_total', 'Session affinity outcomes (hit/rerouted/new)', ['outcome'])
+prefix_reuse_ratio = Histogram('neural_home_prefix_reuse_ratio', 'Share of the prompt that repeats the previous turn sent to the same provider',
+                               buckets=(0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1.0))
+prefix_reuse_tokens = Counter('neural_home_prefix_reuse_tokens_total', 'Estimated prompt tokens resent to the provider that already has them cached', ['provider'])
+
+
+def _digest(messages):
+    h = hashlib.sha256()
+    for m in messages:
+        h.update(f"{m.get('role')}\x00{content_text(m.get('content'))}\x01".encode("utf-8"))
+    return h.hexdigest()
+
+
+class Session:
+    def __init__(self, key, pinned=None, prev_n=0, prev_hash=None):
+        self.key = key
+        self.pinned = pinned        # Provider che ha servito il turno precedente
+        self.prev_n = prev_n        # Messaggi del turno precedente
+        self.prev_hash = prev_hash  # Hash di quei messaggi (prefisso atteso ora)
+
+
+class SessionAffinity:
+    """
+    Conversation affinity. The session key is the X-Session-Id header or
+    a hash of the stable prefix (model, system prompts and first user
+    message). A session stays pinned to the provider that last served it
+    while that provider is sane, so Ollama's KV cache and the providers'
+    prompt caches see the same prefix again; the pin expires after
+    idle_ttl seconds without traffic. State lives in Redis (read in the
+    request-context pipeline, written through the flusher).
+    """
+    def __init__(self, flusher, idle_ttl=900, header="x-session-id"):
+        self.flusher = flusher
+        self.idle_ttl = idle_ttl
+        self.header = header
+
+    def session_key(self, body, headers):
+        explicit = headers.get(self.header)
+        if explicit:
+            return "h:" + hashlib.sha256(explicit.encode("utf-8")).hexdigest()[:24]
+        messages = body.get("messages") or []
+        system = [m for m in messages if m.get("role") == "system"]
+        first = next((m for m in messages if m.get("role") == "user"), None)
+        if first is None:
+            return None
+        h = hashlib.sha256(str(body.get("model", "")).encode("utf-8"))
+        h.update(_digest(system + [first]).encode("ascii"))
+        return "p:" + h.hexdigest()[:24]
+
+    @staticmethod
+    def redis_key(key):
+        return f"affinity:{key}"
+
+    def load(self, key, raw):
+        """Session from the value read in the request-context pipeline."""
+        if key is None:
+            return None
+        try:
+            state = json.loads(raw) if raw else {}
+        except ValueError:
+            state = {}
+        return Session(key, state.get("p"), state.get("n", 0), state.get("h"))
+
+    def record_route(self, session, target_id):
+        if session is None:
+            return
+        if session.pinned is None:
+            affinity_events.labels("new").inc()
+        else:
+            affinity_events.labels("hit" if target_id == session.pinned else "rerouted").inc()
+
+    def remember(self, session, p_id, messages):
+        """Pins the session to p_id (sliding idle TTL) and reports how much of the prompt that provider has seen already."""
+        if session is None:
+            return
+        if session.pinned == p_id and session.prev_n and len(messages) >= session.prev_n \
+                and _digest(messages[:session.prev_n]) == session.prev_hash:
+            reused = estimate_messages(messages[:session.prev_n])
+            prefix_reuse_ratio.observe(reused / max(1, estimate_messages(messages)))
+            prefix_reuse_tokens.labels(p_id).inc(reused)
+        elif session.pinned is not None:
+            prefix_reuse_ratio.observe(0.0)
+        state = json.dumps({"p": p_id, "n": len(messages), "h": _digest(messages)})
+        key, ttl = self.redis_key(session.key), self.idle_ttl
+        self.flusher.add(lambda pipe: pipe.setex(key, ttl, state))
@@ -0,0 +1,97 @@
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+from prometheus_client import Counter
+
+cache_events = Counter('neural_home_cache_events_total', 'Cache events (hit/miss/eviction)', ['cache', 'tier', 'event'])
+
+
+def normalized_hash(text):
+    """SHA-256 of the text with case and whitespace normalized."""
+    norm = " ".join(text.lower().split())
+    return hashlib.sha256(norm.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    """
+    Bounded in-process LRU. Evictions are counted under the given cache name.
+    """
+    def __init__(self, name, max_items=1024):
+        self.name = name
+        self.max_items = max_items
+        self._data = OrderedDict()
+
+    def get(self, key):
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_items:
+            self._data.popitem(last=False)
+            cache_events.labels(self.name, "local", "eviction").inc()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TwoTierCache:
+    """
+    In-process LRU in front of a shared Redis tier with TTL.
+    Values are JSON-serializable; a Redis hit is promoted into the LRU.
+    Writes to Redis are deferred to the flusher.
+    """
+    def __init__(self, redis_client, flusher, name, ttl=3600, max_items=1024):
+        self.redis = redis_client
+        self.flusher = flusher
+        self.name = name
+        self.ttl = ttl
+        self.local = LRUCache(name, max_items)
+
+    def redis_key(self, key):
+        return f"cache:{self.name}:{key}"
+
+    def _local(self, key):
+        value = self.local.get(key)
+        cache_events.labels(self.name, "local", "miss" if value is None else "hit").inc()
+        return value
+
+    async def get(self, key):
+        value = self._local(key)
+        if value is not None:
+            return value
+        try:
+            raw = await self.redis.get(self.redis_key(key))
+        except Exception as e:
+            logging.error(f"Cache {self.name} Redis Error: {e}")
+            raw = None
+        return self._promote(key, raw)
+
+    def lookup(self, key, values):
+        """
+        Like get(), with the Redis tier already read by the caller's pipeline
+        (values: {redis_key: raw}, see fetch_request_context extra_keys).
+        """
+        value = self._local(key)
+        if value is not None:
+            return value
+        return self._promote(key, values.get(self.redis_key(key)))
+
+    def _promote(self, key, raw):
+        if raw is None:
+            cache_events.labels(self.name, "redis", "miss").inc()
+            return None
+
+        cache_events.labels(self.name, "redis", "hit").inc()
+        value = json.loads(raw)
+        self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        raw = json.dumps(value)
+        self.flusher.add(lambda pipe: pipe.setex(self.redis_key(key), self.ttl, raw))
@@ -0,0 +1,345 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import fcntl
+import random
+import asyncio
+import argparse
+from pathlib import Path
+from collections import Counter, defaultdict
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+DEFAULT_LOG_FILE = PROJECT_ROOT / "judge_decisions.jsonl"
+DEFAULT_MODEL_FILE = PROJECT_ROOT / "orchestrator" / "classifier_model.json"
+
+MIN_SAMPLES_PER_CLASS = 5  # Sotto questa soglia una testa non viene usata (si chiede al giudice)
+CALIBRATION_FRACTION = 0.2
+SCALE_GRID = [0.5 * 1.25 ** i for i in range(40)]  # Temperature candidate per la calibrazione (0.5 .. ~3000)
+
+WORD_RE = re.compile(r"[a-zA-Z_àèéìòù]+|[{}()\[\];=<>#:.]")
+
+
+def intent_features(text):
+    """Word unigrams/bigrams plus code punctuation tokens."""
+    words = WORD_RE.findall(text.lower()[:2000])
+    feats = list(words)
+    feats += [f"{a} {b}" for a, b in zip(words, words[1:])]
+    return feats
+
+
+def lang_features(text):
+    """Character 1-3 grams over letters only (n-gram language ID)."""
+    clean = " " + " ".join(re.findall(r"[^\W\d_]+", text.lower()[:1000])) + " "
+    feats = []
+    for n in (1, 2, 3):
+        feats += [clean[i:i + n] for i in range(len(clean) - n + 1)]
+    return feats
+
+
+class NaiveBayes:
+    """
+    Multinomial Naive Bayes with Laplace smoothing over sparse token counts.
+    Stores only log-probabilities, so prediction is a handful of dict lookups.
+
+    The raw NB posterior saturates at ~1.0 on long prompts (every token adds
+    an independent vote), so confidence is a softmax over the per-feature
+    log-likelihoods times a scale fitted on held-out samples (calibrate()).
+    """
+    def __init__(self, alpha=1.0):
+        self.alpha = alpha
+        self.priors = {}        # label -> log P(label)
+        self.log_probs = {}     # label -> {feature: log P(feature|label)}
+        self.unseen = {}        # label -> log P(unseen feature|label)
+        self.counts = {}        # label -> training samples
+        self.scale = 1.0        # Temperatura della confidenza (1.0 = non calibrata, prudente)
+
+    @property
+    def usable(self):
+        """At least two classes, each with MIN_SAMPLES_PER_CLASS samples."""
+        return len(self.counts) >= 2 and min(self.counts.values()) >= MIN_SAMPLES_PER_CLASS
+
+    def problem(self):
+        if len(self.counts) < 2:
+            return f"{len(self.counts)} classi"
+        rare = sorted(label for label, n in self.counts.items() if n < MIN_SAMPLES_PER_CLASS)
+        return f"meno di {MIN_SAMPLES_PER_CLASS} esempi per {', '.join(rare)}" if rare else None
+
+    def fit(self, feature_lists, labels):
+        counts = defaultdict(Counter)
+        label_counts = Counter(labels)
+        vocab = set()
+        for feats, label in zip(feature_lists, labels):
+            counts[label].update(feats)
+            vocab.update(feats)
+        total = len(labels)
+        v = len(vocab) or 1
+        self.counts = dict(label_counts)
+        for label, n in label_counts.items():
+            denom = sum(counts[label].values()) + self.alpha * v
+            self.priors[label] = math.log(n / total)
+            self.log_probs[label] = {f: math.log((c + self.alpha) / denom) for f, c in counts[label].items()}
+            self.unseen[label] = math.log(self.alpha / denom)
+        return self
+
+    def margins(self, feats):
+        """Length-normalized log-likelihood per label (prior included once)."""
+        n = len(feats) or 1
+        scores = {}
+        for label, prior in self.priors.items():
+            lp, unseen = self.log_probs[label], self.unseen[label]
+            scores[label] = (prior + sum(lp.get(f, unseen) for f in feats)) / n
+        return scores
+
+    @staticmethod
+    def _softmax(scores, scale):
+        best = max(scores, key=scores.get)
+        norm = sum(math.exp(scale * (s - scores[best])) for s in scores.values())
+        return best, 1.0 / norm
+
+    def predict(self, feats):
+        """Returns (label, confidence); (None, 0.0) if the head is not usable."""
+        if not self.usable:
+            return None, 0.0
+        return self._softmax(self.margins(feats), self.scale)
+
+    def calibrate(self, feature_lists, labels):
+        """Picks the scale minimizing the log-loss on held-out samples."""
+        held = [(self.margins(feats), label) for feats, label in zip(feature_lists, labels) if label in self.priors]
+        if not held or not self.usable:
+            return self
+
+        def log_loss(scale):
+            loss = 0.0
+            for scores, label in held:
+                top = max(scores.values())
+                norm = sum(math.exp(scale * (s - top)) for s in scores.values())
+                loss -= scale * (scores[label] - top) - math.log(norm)
+            return loss
+
+        self.scale = min(SCALE_GRID, key=log_loss)
+        return self
+
+    def to_dict(self):
+        return {"alpha": self.alpha, "priors": self.priors, "log_probs": self.log_probs, "unseen": self.unseen,
+                "counts": self.counts, "scale": self.scale}
+
+    @classmethod
+    def from_dict(cls, d):
+        nb = cls(d["alpha"])
+        nb.priors, nb.log_probs, nb.unseen = d["priors"], d["log_probs"], d["unseen"]
+        # Modelli salvati prima della calibrazione: senza conteggi la testa resta inutilizzabile finché non si riaddestra
+        nb.counts, nb.scale = d.get("counts", {}), d.get("scale", 1.0)
+        return nb
+
+
+class LocalClassifier:
+    """
+    In-process replacement for the LLM judge, trained on logged judge verdicts.
+    classify() returns ({"cat", "lang"}, confidence); callers fall back to the
+    remote judge when confidence is below their threshold.
+    """
+    def __init__(self, intent_model, lang_model):
+        self.intent_model = intent_model
+        self.lang_model = lang_model
+
+    @property
+    def usable(self):
+        return self.intent_model.usable and self.lang_model.usable
+
+    def classify(self, query):
+        cat, cat_conf = self.intent_model.predict(intent_features(query))
+        lang, lang_conf = self.lang_model.predict(lang_features(query))
+        if cat is None or lang is None:
+            return None, 0.0
+        return {"cat": cat, "lang": lang}, min(cat_conf, lang_conf)
+
+    @classmethod
+    def train(cls, samples):
+        """
+        Fits both heads, calibrates their confidence on a held-out slice of
+        the samples, then refits on all of them keeping the fitted scale.
+        Heads without enough classes or samples are reported and never used.
+        """
+        heads = []
+        for key, features in (("cat", intent_features), ("lang", lang_features)):
+            feats, labels = [features(s["query"]) for s in samples], [s[key] for s in samples]
+            cut = len(samples) - int(len(samples) * CALIBRATION_FRACTION)
+            scale = NaiveBayes().fit(feats[:cut], labels[:cut]).calibrate(feats[cut:], labels[cut:]).scale
+            head = NaiveBayes().fit(feats, labels)
+            head.scale = scale
+            if not head.usable:
+                print(f"⚠️ Classifier: testa '{key}' non utilizzabile ({head.problem()}), si userà il giudice.")
+            else:
+                print(f"📐 Classifier: testa '{key}' calibrata (scala {scale:.2f}, {len(head.counts)} classi).")
+            heads.append(head)
+        return cls(*heads)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({"intent": self.intent_model.to_dict(), "lang": self.lang_model.to_dict()}, f)
+
+    @classmethod
+    def load(cls, path):
+        """Returns None if no usable model has been trained yet."""
+        try:
+            with open(path, 'r') as f:
+                d = json.load(f)
+            model = cls(NaiveBayes.from_dict(d["intent"]), NaiveBayes.from_dict(d["lang"]))
+            if not model.usable:
+                print(f"⚠️ Classifier model {path} senza classi/esempi sufficienti (o da riaddestrare): ignorato.")
+                return None
+            return model
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"⚠️ Classifier model non valido ({path}): {e}")
+            return None
+
+
+class JudgeLog:
+    """
+    Training log of judge verdicts (one JSON per line). add() only buffers;
+    a background task appends the buffer in a worker thread every interval.
+    When the file exceeds max_bytes it is rotated to <path>.1 (the previous
+    .1 is dropped), so at most ~2 x max_bytes of raw queries stay on disk.
+    Size check, rotation and append run under an flock on <path>.lock, so
+    several uvicorn workers sharing the file rotate it once and never
+    write into a file another worker has just renamed away.
+    An empty path disables the log.
+    """
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, interval=1.0, max_buffer=1000):
+        self.path = str(path) if path else None
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.lines = []
+        self._task = None
+
+    def add(self, query, verdict):
+        if not self.path or len(self.lines) >= self.max_buffer:
+            return  # Disco lento: meglio perdere qualche esempio che crescere in memoria
+        self.lines.append(json.dumps({"ts": time.time(), "query": query[:500], "cat": verdict.get("cat"), "lang": verdict.get("lang")}) + "\n")
+
+    def _write(self, lines):
+        with open(self.path + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # Rilasciato alla chiusura
+            try:
+                if os.path.getsize(self.path) >= self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+            except FileNotFoundError:
+                pass
+            with open(self.path, 'a') as f:
+                f.writelines(lines)
+
+    async def flush(self):
+        lines, self.lines = self.lines, []
+        if not lines:
+            return
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except Exception as e:
+            print(f"⚠️ Impossibile salvare {len(lines)} verdetti del giudice: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None and self.path:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+def load_samples(path):
+    """Samples from the log and its rotated copy (<path>.1), oldest first."""
+    samples = []
+    for name in (f"{path}.1", str(path)):
+        if name != str(path) and not os.path.exists(name):
+            continue
+        with open(name, 'r') as f:
+            for line in f:
+                try:
+                    s = json.loads(line)
+                except ValueError:
+                    continue
+                if s.get("query") and s.get("cat") and s.get("lang"):
+                    samples.append(s)
+    return samples
+
+
+def evaluate(model, samples, threshold):
+    """Agreement with the judge, coverage above threshold and per-request latency."""
+    agree_cat = agree_lang = covered = covered_ok = 0
+    t0 = time.perf_counter()
+    for s in samples:
+        verdict, conf = model.classify(s["query"])
+        verdict = verdict or {}
+        ok_cat, ok_lang = verdict.get("cat") == s["cat"], verdict.get("lang") == s["lang"]
+        agree_cat += ok_cat
+        agree_lang += ok_lang
+        if conf >= threshold:
+            covered += 1
+            covered_ok += ok_cat and ok_lang
+    elapsed = time.perf_counter() - t0
+    n = len(samples) or 1
+    return {
+        "samples": len(samples),
+        "cat_agreement": agree_cat / n,
+        "lang_agreement": agree_lang / n,
+        "coverage": covered / n,
+        "agreement_when_covered": covered_ok / (covered or 1),
+        "avg_latency_ms": elapsed / n * 1000,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train/evaluate the local judge classifier on logged verdicts.")
+    parser.add_argument("command", choices=["train", "eval"])
+    parser.add_argument("--log", default=str(DEFAULT_LOG_FILE), help="Judge decisions log (JSONL)")
+    parser.add_argument("--model", default=str(DEFAULT_MODEL_FILE), help="Model file to write/read")
+    parser.add_argument("--holdout", type=float, default=0.2, help="Fraction kept for evaluation when training")
+    parser.add_argument("--threshold", type=float, default=0.9, help="Confidence threshold for coverage stats")
+    args = parser.parse_args(argv)
+
+    samples = load_samples(args.log)
+    if not samples:
+        print(f"❌ Nessun verdetto in {args.log}")
+        return 1
+
+    if args.command == "train":
+        random.Random(42).shuffle(samples)
+        split = int(len(samples) * (1 - args.holdout)) if len(samples) > 10 else len(samples)
+        model = LocalClassifier.train(samples[:split])
+        if split < len(samples):
+            print(json.dumps(evaluate(model, samples[split:], args.threshold), indent=2))
+        # Il modello finale usa tutti i dati
+        model = LocalClassifier.train(samples)
+        if not model.usable:
+            print(f"❌ Verdetti insufficienti per un modello affidabile: non salvato ({args.model}).")
+            return 1
+        model.save(args.model)
+        print(f"✅ Modello salvato in {args.model} ({len(samples)} verdetti).")
+    else:
+        model = LocalClassifier.load(args.model)
+        if not model:
+            print(f"❌ Modello non trovato: {args.model}")
+            return 1
+        print(json.dumps(evaluate(model, samples, args.threshold), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import math
+import time
+import asyncio
+from collections import deque
+from prometheus_client import Counter, Gauge
+from .upstream import Upstream
+
+concurrency_limit = Gauge('neural_home_concurrency_limit', 'Adaptive concurrency limit per provider', ['provider'], multiprocess_mode='livesum')
+concurrency_in_flight = Gauge('neural_home_concurrency_in_flight', 'Requests in flight per provider', ['provider'], multiprocess_mode='livesum')
+concurrency_queue = Gauge('neural_home_concurrency_queue_depth', 'Requests waiting for a provider slot', ['provider'], multiprocess_mode='livesum')
+concurrency_shed = Counter('neural_home_concurrency_shed_total', 'Requests shed because a provider was saturated', ['provider'])
+
+
+class ConcurrencyShed(Exception):
+    def __init__(self, p_id, retry_after):
+        super().__init__(f"{p_id} saturo (riprova tra {retry_after}s)")
+        self.p_id = p_id
+        self.retry_after = retry_after
+
+
+def is_overload(e):
+    """429 and timeouts mean the provider is saturated (errors like 500 don't move the limit)."""
+    msg = str(e).lower()
+    return "429" in msg or "timed out" in msg or "timeout" in type(e).__name__.lower()
+
+
+class AdaptiveLimit:
+    """
+    AIMD concurrency limit for one provider. The limit grows by 1/limit per
+    request that completes within `tolerance` times the baseline latency
+    (a slow EWMA of the time to first byte) and is cut by `backoff` on a
+    429, a timeout or a slower answer, at most once per baseline interval.
+    Callers beyond the limit wait in a bounded FIFO queue.
+    """
+    def __init__(self, initial=8, min_limit=1, max_limit=64, max_queue=32, backoff=0.7, tolerance=2.0, alpha=0.05):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.alpha = alpha
+        self.in_flight = 0
+        self.baseline = None
+        self.waiters = deque()
+        self._last_drop = 0.0
+
+    def retry_after(self):
+        return max(1, math.ceil((self.baseline or 1.0) * (1 + len(self.waiters) / max(1, int(self.limit)))))
+
+    def _free(self):
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self, p_id, timeout):
+        if self._free() and not self.waiters:
+            self.in_flight += 1
+            return
+        if timeout <= 0 or len(self.waiters) >= self.max_queue:
+            raise ConcurrencyShed(p_id, self.retry_after())
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            raise ConcurrencyShed(p_id, self.retry_after())
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                self._release_slot()  # Slot già ceduto a chi è stato cancellato
+            raise
+        finally:
+            try:
+                self.waiters.remove(fut)
+            except ValueError:
+                pass
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        while self.waiters and self._free():
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                self.in_flight += 1
+
+    def release(self, latency, overloaded):
+        now = time.monotonic()
+        slow = latency is not None and self.baseline is not None and latency > self.tolerance * self.baseline
+        if overloaded or slow:
+            if now - self._last_drop >= (self.baseline or 0):
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._last_drop = now
+        elif latency is not None and self.in_flight >= self.limit / 2:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        if latency is not None:
+            self.baseline = latency if self.baseline is None else (1 - self.alpha) * self.baseline + self.alpha * latency
+        self._release_slot()
+
+
+class ConcurrencyLimiter:
+    """Per-provider AdaptiveLimit; wraps provider calls so the slot is held until the answer (or stream) ends."""
+    def __init__(self, initial=8, max_limit=64, max_queue=32):
+        self.initial = initial
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.limits = {}
+
+    def get(self, p_id):
+        lim = self.limits.get(p_id)
+        if lim is None:
+            lim = self.limits[p_id] = AdaptiveLimit(self.initial, max_limit=self.max_limit, max_queue=self.max_queue)
+        return lim
+
+    def _export(self, p_id, lim):
+        concurrency_limit.labels(p_id).set(int(lim.limit))
+        concurrency_in_flight.labels(p_id).set(lim.in_flight)
+        concurrency_queue.labels(p_id).set(len(lim.waiters))
+
+    async def call(self, p_id, wait, opener):
+        """
+        Waits up to `wait` seconds for a slot (ConcurrencyShed otherwise),
+        then runs opener() and returns its Upstream.
+        """
+        lim = self.get(p_id)
+        concurrency_queue.labels(p_id).set(len(lim.waiters) + 1)
+        try:
+            await lim.acquire(p_id, wait)
+        except ConcurrencyShed:
+            concurrency_shed.labels(p_id).inc()
+            raise
+        finally:
+            self._export(p_id, lim)
+
+        start = time.monotonic()
+        try:
+            result = await opener()
+        except BaseException as e:
+            lim.release(None, is_overload(e))
+            self._export(p_id, lim)
+            raise
+        latency = time.monotonic() - start
+        if not result.is_stream:
+            lim.release(latency, False)
+            self._export(p_id, lim)
+            return result
+
+        released = False
+        def done():
+            nonlocal released
+            if not released:
+                released = True
+                lim.release(latency, False)
+                self._export(p_id, lim)
+
+        async def guarded(chunks):
+            try:
+                async for chunk in chunks:
+                    yield chunk
+            finally:
+                done()
+
+        async def close():
+            done()
+            await result.aclose()
+        return Upstream(result.p_id, chunks=guarded(result.chunks), closer=close)
@@ -0,0 +1,135 @@
+import math
+from prometheus_client import Counter, Histogram
+
+TRIM_POLICIES = ("none", "drop_oldest", "summarize")
+MESSAGE_OVERHEAD = 4      # Token di servizio per messaggio (ruolo, separatori)
+DEFAULT_OUTPUT_RESERVE = 1024
+
+context_excluded = Counter('neural_home_context_excluded_total', 'Providers skipped because the request does not fit their context window', ['provider'])
+context_trimmed = Counter('neural_home_context_trimmed_total', 'Requests trimmed to fit the largest available context window', ['policy'])
+prompt_tokens_estimated = Histogram('neural_home_prompt_tokens_estimated', 'Estimated prompt size in tokens',
+                                    buckets=(256, 1024, 4096, 8192, 16384, 32768, 65536, 131072, 262144, 1048576))
+
+
+def estimate_tokens(text):
+    """
+    Cheap upper-leaning token estimate: UTF-8 bytes / 3.5 (~4 chars per
+    token for prose, ~3 for code, ~1 per CJK character). No tokenizer.
+    """
+    if not text:
+        return 0
+    return math.ceil(len(text.encode("utf-8")) / 3.5)
+
+
+def content_text(content):
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):  # Formato multi-part OpenAI
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return ""
+
+
+def estimate_messages(messages):
+    return sum(MESSAGE_OVERHEAD + estimate_tokens(content_text(m.get("content"))) for m in messages)
+
+
+def output_reserve(p, max_tokens=None):
+    """Tokens to keep free for the answer: the requested max_tokens, capped by the provider's output limit."""
+    reserve = max_tokens or DEFAULT_OUTPUT_RESERVE
+    if p.get("max_output"):
+        reserve = min(reserve, p["max_output"])
+    return reserve
+
+
+def prompt_budget(p, max_tokens=None, margin=1.1):
+    """Largest prompt (estimated tokens) that fits the provider, or None if its window is unknown."""
+    window = p.get("context_window")
+    if not window:
+        return None
+    return int((window - output_reserve(p, max_tokens)) / margin)
+
+
+def fits(p, prompt_tokens, max_tokens=None, margin=1.1):
+    budget = prompt_budget(p, max_tokens, margin)
+    return budget is None or prompt_tokens <= budget
+
+
+def parse_trim_policies(spec):
+    """
+    "aider:drop_oldest,continue:summarize" -> {"aider": "drop_oldest", ...}.
+    Keys are matched against X-Client-Id / User-Agent like the batch clients.
+    """
+    policies = {}
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        client, _, policy = item.partition(":")
+        if policy in TRIM_POLICIES:
+            policies[client.lower()] = policy
+    return policies
+
+
+def trim_policy(headers, policies, default="none"):
+    explicit = (headers.get("x-context-trim") or "").lower()
+    if explicit in TRIM_POLICIES:
+        return explicit
+    client = (headers.get("x-client-id") or headers.get("user-agent") or "").lower()
+    return next((policy for name, policy in policies.items() if name in client), default)
+
+
+def _groups(messages):
+    """
+    Indices of the system messages, and of the other messages grouped so
+    that an assistant turn with tool_calls and the tool results answering
+    it form one group (a kept suffix never starts on an orphan tool message).
+    """
+    system, groups = [], []
+    for i, m in enumerate(messages):
+        role = m.get("role")
+        if role == "system":
+            system.append(i)
+        elif role in ("tool", "function") and groups:
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    return system, groups
+
+
+def drop_oldest(messages, budget):
+    """
+    Drops the oldest non-system groups until the estimate fits the budget.
+    System messages (kept in place) and the last group are never dropped.
+    Returns (messages, dropped).
+    """
+    system, groups = _groups(messages)
+    cost = lambda idx: estimate_messages([messages[i] for i in idx])
+    size = cost(system) + (cost(groups[-1]) if groups else 0)
+    start = len(groups) - 1
+    while start > 0 and size + cost(groups[start - 1]) <= budget:
+        start -= 1
+        size += cost(groups[start])
+    dropped = {i for g in groups[:max(start, 0)] for i in g}
+    return [m for i, m in enumerate(messages) if i not in dropped], [messages[i] for i in sorted(dropped)]
+
+
+async def summarize_oldest(messages, budget, summarize_fn, summary_tokens=512):
+    """
+    Like drop_oldest, but the dropped turns come back as one summary
+    (summarize_fn(text) -> str). Falls back to plain dropping on failure.
+    """
+    trimmed, dropped = drop_oldest(messages, budget - summary_tokens)
+    if not dropped:
+        return trimmed
+    transcript = "\n\n".join(f"{m.get('role')}: {content_text(m.get('content'))}" for m in dropped)
+    try:
+        summary = await summarize_fn(transcript)
+    except Exception as e:
+        print(f"⚠️ [CONTEXT] Riassunto fallito ({e}), turni più vecchi scartati.")
+        return trimmed
+    note = {"role": "system", "content": f"Summary of the earlier conversation (older turns were trimmed to fit the context window):\n{summary}"}
+    at = next((i for i, m in enumerate(trimmed) if m.get("role") != "system"), len(trimmed))  # Al posto dei turni tagliati
+    return trimmed[:at] + [note] + trimmed[at:]
+
+
+async def trim(messages, budget, policy, summarize_fn=None):
+    if policy == "summarize" and summarize_fn:
+        return await summarize_oldest(messages, budget, summarize_fn)
+    return drop_oldest(messages, budget)[0]
@@ -0,0 +1,121 @@
+import asyncio
+from prometheus_client import Counter
+from .sse import DONE, loads, restamp
+from .upstream import Upstream
+
+stream_failover = Counter('neural_home_stream_failover_total', 'Streams switched to another provider mid-generation', ['from_provider', 'to_provider', 'reason'])
+
+CONTINUE_PROMPT = "(SYSTEM: the previous answer was cut off. Continue EXACTLY from where it stopped, without repeating or summarising anything already written.)"
+
+
+class StreamStalled(Exception):
+    pass
+
+
+class StreamTruncated(Exception):
+    pass
+
+
+def _emitted(frames):
+    """(completion id, text sent so far, finished?) from the raw frames already forwarded."""
+    cid, parts, finished = None, [], False
+    for frame in frames:
+        try:
+            d = loads(frame[6:])
+            choice = d["choices"][0]
+        except (ValueError, KeyError, IndexError, TypeError):
+            continue
+        cid = cid or d.get("id")
+        parts.append((choice.get("delta") or {}).get("content") or "")
+        finished = finished or bool(choice.get("finish_reason"))
+    return cid, "".join(parts), finished
+
+
+def continuation(messages, text):
+    """Original conversation plus the partial answer and the request to carry on."""
+    if not text:
+        return messages
+    return messages + [{"role": "assistant", "content": text}, {"role": "user", "content": CONTINUE_PROMPT}]
+
+
+class StreamFailover:
+    """
+    Keeps a stream alive across provider failures. Frames are forwarded as
+    they arrive and kept raw (parsed only on a switch); if the provider
+    errors or stays silent longer than chunk_timeout before [DONE], the
+    next candidate is asked to continue the partial answer and its frames
+    are stitched into the same SSE stream under the original completion id.
+    A stream that ends without [DONE] counts as a failure too.
+    """
+    def __init__(self, chunk_timeout=30.0, max_switches=2):
+        self.chunk_timeout = chunk_timeout
+        self.max_switches = max_switches
+
+    async def _next(self, it):
+        if not self.chunk_timeout:
+            return await it.__anext__()
+        try:
+            return await asyncio.wait_for(it.__anext__(), self.chunk_timeout)
+        except asyncio.TimeoutError:
+            raise StreamStalled(f"nessun chunk per {self.chunk_timeout}s")
+
+    def wrap(self, result, messages, candidates, opener, on_error, on_switch):
+        """
+        candidates(exclude) -> next provider dicts to try; opener(p, messages)
+        -> awaitable Upstream (stream); on_error(p_id, e) / on_switch(result)
+        keep stats and cooldowns in line with the waterfall.
+        """
+        if not result.is_stream or self.max_switches <= 0:
+            return result
+        live = {"up": result}  # Upstream corrente, per chiuderlo se il client se ne va
+
+        async def generate():
+            current, frames, tried, switches = result, [], {result.p_id}, 0
+            try:
+                while True:
+                    it = current.chunks.__aiter__()
+                    try:
+                        while True:
+                            frame = await self._next(it)
+                            if frame == DONE:
+                                yield frame
+                                return
+                            if frame.startswith("data: {"):
+                                frames.append(frame)
+                                yield restamp(frame, cid) if switches else frame
+                            else:
+                                yield frame
+                    except StopAsyncIteration:
+                        error, reason = StreamTruncated("stream chiuso senza [DONE]"), "truncated"
+                    except Exception as e:
+                        error, reason = e, "timeout" if isinstance(e, StreamStalled) else "error"
+                    await current.aclose()
+
+                    cid, text, finished = _emitted(frames)
+                    if finished:
+                        yield DONE  # La risposta era già completa (finish_reason ricevuto): manca solo la chiusura
+                        return
+                    on_error(current.p_id, error)
+                    nxt = None
+                    while switches < self.max_switches and nxt is None:
+                        p = next(iter(candidates(tried)), None)
+                        if p is None:
+                            break
+                        tried.add(p["id"])
+                        try:
+                            nxt = await opener(p, continuation(messages, text))
+                        except Exception as e:
+                            on_error(p["id"], e)
+                    if nxt is None:
+                        stream_failover.labels(current.p_id, "none", reason).inc()
+                        print(f"💥 [STREAM] {current.p_id} interrotto, nessun provider per continuare.")
+                        return  # Niente [DONE]: il client (e la cache) vedono lo stream troncato
+                    switches += 1
+                    stream_failover.labels(current.p_id, nxt.p_id, reason).inc()
+                    print(f"🔀 [STREAM] {current.p_id} -> {nxt.p_id} ({reason}, {len(text)} caratteri già inviati)")
+                    on_switch(nxt)
+                    current = live["up"] = nxt
+            finally:
+                await current.aclose()
+
+        return Upstream(result.p_id, chunks=generate(), closer=lambda: live["up"].aclose())
@@ -0,0 +1,270 @@
+import sys
+import json
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+from prometheus_client import Counter, Gauge, Histogram
+from .upstream import Upstream, call_provider
+
+PRIORITIES = ("high", "low")  # BLPOP svuota high prima di low (Blueprint Sec 4.2)
+
+gpu_queue_length = Gauge('neural_home_gpu_queue_length', 'Requests waiting for the local GPU', ['priority'], multiprocess_mode='livemostrecent')
+gpu_queue_events = Counter('neural_home_gpu_queue_total', 'GPU queue outcomes', ['priority', 'outcome'])
+gpu_queue_wait = Histogram('neural_home_gpu_queue_wait_seconds', 'Time spent in the GPU queue before inference starts', ['priority'],
+                           buckets=(0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300))
+
+
+class GpuQueueTimeout(Exception):
+    pass
+
+
+def queue_key(priority):
+    return f"gpu_queue:{priority}"
+
+
+def queue_priority(headers, category, batch_clients):
+    """
+    high = interactive (autocomplete, chat), low = batch (e.g. Aider bulk refactor).
+    An explicit X-Priority header wins; otherwise CODING requests from a batch client go low.
+    """
+    explicit = (headers.get("x-priority") or "").lower()
+    if explicit in PRIORITIES:
+        return explicit
+    client = (headers.get("x-client-id") or headers.get("user-agent") or "").lower()
+    if category == "CODING" and any(c in client for c in batch_clients):
+        return "low"
+    return "high"
+
+
+class GpuQueue:
+    """
+    Client side of the GPU queue. Jobs are RPUSHed on gpu_queue:{priority};
+    the worker answers on a Redis stream owned by this process, read by a
+    single XREAD loop and dispatched to the waiting requests. A job that is
+    not picked up before its deadline raises GpuQueueTimeout, so the
+    waterfall falls back to the cloud providers.
+
+    blocking_client serves the XREAD loop when redis_client has a socket
+    timeout shorter than the 1s block.
+    """
+    def __init__(self, redis_client, flusher, deadlines=None, idle_timeout=120, blocking_client=None):
+        self.redis = redis_client
+        self.blocking = blocking_client or redis_client
+        self.flusher = flusher
+        self.deadlines = deadlines or {"high": 15, "low": 120}
+        self.idle_timeout = idle_timeout
+        self.reply_stream = f"gpu_replies:{uuid.uuid4().hex[:12]}"
+        self.waiters = {}  # job id -> asyncio.Queue degli eventi
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._reader())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.redis.delete(self.reply_stream)
+        except Exception:
+            pass
+
+    async def _reader(self):
+        last = "0-0"
+        while True:
+            try:
+                res = await self.blocking.xread({self.reply_stream: last}, block=1000, count=100)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"GPU Queue Redis Error: {e}")
+                await asyncio.sleep(1)
+                continue
+            for _, entries in res or ():
+                for entry_id, fields in entries:
+                    last = entry_id
+                    q = self.waiters.get(fields.get("id"))
+                    if q:
+                        q.put_nowait(fields)
+            if res:
+                self.flusher.add(lambda pipe, last=last: pipe.xtrim(self.reply_stream, minid=last))
+
+    def _cancel(self, job_id, ttl):
+        self.flusher.add(lambda pipe: pipe.setex(f"gpu_cancel:{job_id}", max(1, int(ttl)), 1))
+
+    async def submit(self, p, messages, is_stream, req_model, priority="high"):
+        """Enqueues a local-inference job and returns its Upstream once the worker starts answering."""
+        self.start()
+        job_id = uuid.uuid4().hex
+        wait = self.deadlines.get(priority, self.deadlines["high"])
+        job = {"id": job_id, "reply_to": self.reply_stream, "deadline": time.time() + wait, "enqueued_at": time.time(),
+               "provider": p["id"], "priority": priority, "messages": messages, "stream": is_stream, "model": req_model}
+        events = self.waiters[job_id] = asyncio.Queue()
+        try:
+            await self.redis.rpush(queue_key(priority), json.dumps(job))
+            try:
+                ev = await asyncio.wait_for(events.get(), timeout=wait)
+            except asyncio.TimeoutError:
+                gpu_queue_events.labels(priority, "timeout").inc()
+                raise GpuQueueTimeout(f"GPU queue deadline ({wait}s) superata")
+            if ev["t"] == "start":
+                ev = await asyncio.wait_for(events.get(), timeout=self.idle_timeout)
+            if ev["t"] == "error":
+                raise RuntimeError(ev.get("d", "GPU worker error"))
+            if ev["t"] == "body":
+                self.waiters.pop(job_id, None)
+                return Upstream(p["id"], body=json.loads(ev["d"]))
+        except BaseException:
+            self.waiters.pop(job_id, None)
+            self._cancel(job_id, wait)
+            raise
+        return Upstream(p["id"], chunks=self._stream(job_id, events, ev["d"]))
+
+    async def _stream(self, job_id, events, first):
+        finished = False
+        try:
+            yield first
+            while True:
+                ev = await asyncio.wait_for(events.get(), timeout=self.idle_timeout)
+                if ev["t"] == "done":
+                    finished = True
+                    return
+                if ev["t"] == "error":
+                    finished = True
+                    raise RuntimeError(ev.get("d", "GPU worker error"))
+                yield ev["d"]
+        finally:
+            self.waiters.pop(job_id, None)
+            if not finished:
+                self._cancel(job_id, self.idle_timeout)  # Client disconnesso: il worker può fermarsi
+
+    async def refresh_length(self):
+        pipe = self.redis.pipeline(transaction=False)
+        for prio in PRIORITIES:
+            pipe.llen(queue_key(prio))
+        for prio, n in zip(PRIORITIES, await pipe.execute()):
+            gpu_queue_length.labels(prio).set(n)
+
+
+async def _enumerate(chunks):
+    i = 0
+    async for chunk in chunks:
+        yield i, chunk
+        i += 1
+
+
+class GpuQueueWorker:
+    """
+    Drains gpu_queue:high before gpu_queue:low while gpu_status is VERDE,
+    running at most `concurrency` inferences at once, and streams the
+    results back to the requesting process. Expired or cancelled jobs
+    are skipped.
+    """
+    def __init__(self, redis_client, providers, client_for, concurrency=2, reply_maxlen=10000, blocking_client=None):
+        self.redis = redis_client
+        self.blocking = blocking_client or redis_client  # Per il BLPOP (vedi GpuQueue)
+        self.providers = providers      # callable -> {id: provider}
+        self.client_for = client_for    # provider -> client SDK
+        self.concurrency = concurrency
+        self.reply_maxlen = reply_maxlen
+        self.running = set()
+
+    async def _reply(self, job, t, d=None):
+        fields = {"id": job["id"], "t": t}
+        if d is not None:
+            fields["d"] = d
+        await self.redis.xadd(job["reply_to"], fields, maxlen=self.reply_maxlen, approximate=True)
+
+    async def _run(self, job):
+        prio = job.get("priority", "high")
+        if time.time() > job["deadline"] or await self.redis.exists(f"gpu_cancel:{job['id']}"):
+            gpu_queue_events.labels(prio, "skipped").inc()
+            return
+        gpu_queue_wait.labels(prio).observe(time.time() - job["enqueued_at"])
+        await self._reply(job, "start")
+        try:
+            p = self.providers()[job["provider"]]
+            result = await call_provider(self.client_for(p), p, job["messages"], job["stream"], job["model"])
+            if result.is_stream:
+                try:
+                    async for i, chunk in _enumerate(result.chunks):
+                        if i % 32 == 31 and await self.redis.exists(f"gpu_cancel:{job['id']}"):
+                            gpu_queue_events.labels(prio, "cancelled").inc()
+                            return  # Il client si è disconnesso: si libera la GPU
+                        await self._reply(job, "chunk", chunk)
+                finally:
+                    await result.aclose()
+                await self._reply(job, "done")
+            else:
+                await self._reply(job, "body", json.dumps(result.body))
+            gpu_queue_events.labels(prio, "served").inc()
+        except Exception as e:
+            gpu_queue_events.labels(prio, "error").inc()
+            try:
+                await self._reply(job, "error", str(e))
+            except Exception:
+                pass  # Il richiedente scadrà per timeout
+
+    async def run(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            await slots.acquire()
+            try:
+                if await self.redis.get("gpu_status") != "VERDE":
+                    slots.release()
+                    await asyncio.sleep(1)
+                    continue
+                item = await self.blocking.blpop([queue_key(p) for p in PRIORITIES], timeout=1)
+                if item and await self.redis.get("gpu_status") != "VERDE":
+                    # La GPU è diventata rossa durante l'attesa: il job torna in testa alla coda
+                    await self.redis.lpush(item[0], item[1])
+                    item = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"GPU Worker Redis Error: {e}")
+                slots.release()
+                await asyncio.sleep(1)
+                continue
+            if not item:
+                slots.release()
+                continue
+            task = asyncio.get_running_loop().create_task(self._run(json.loads(item[1])))
+            self.running.add(task)
+            task.add_done_callback(lambda t: (self.running.discard(t), slots.release()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Standalone GPU queue worker (local inference on the Ollama provider).")
+    parser.add_argument("command", choices=["worker"])
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--state", default=None, help="state.json with api_providers (default: infrastructure/state.json)")
+    args = parser.parse_args(argv)
+
+    from pathlib import Path
+    from redis.asyncio import Redis
+    from .providers import ProviderPool
+    state_file = args.state or Path(__file__).resolve().parents[1] / "infrastructure" / "state.json"
+    with open(state_file, 'r') as f:
+        providers = json.load(f)["api_providers"]
+    pool = ProviderPool()
+    worker = GpuQueueWorker(Redis(host=args.redis_host, port=6379, db=0, decode_responses=True),
+                            lambda: providers, pool.get, args.concurrency)
+    print(f"🎮 GPU worker avviato (concorrenza {args.concurrency}).")
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import time
+import asyncio
+from prometheus_client import Counter
+from .upstream import discard
+
+hedge_events = Counter('neural_home_hedge_total', 'Hedged request events (fired/won/lost/budget_exhausted)', ['category', 'outcome'])
+
+
+def parse_hedge_config(spec):
+    """
+    "SIMPLE:0.95,CODING:0.99" -> {"SIMPLE": 0.95, "CODING": 0.99}.
+    The value is the latency percentile of the primary after which the hedge fires.
+    """
+    config = {}
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        cat, _, q = item.partition(":")
+        config[cat.upper()] = float(q) if q else 0.95
+    return config
+
+
+class HedgeBudget:
+    """
+    Token bucket that earns `ratio` tokens per request, so hedges stay below
+    that fraction of traffic and free-tier quotas are not doubled. earn() is
+    called once per routed request, not per waterfall attempt: a request
+    that falls through several providers must not mint extra hedges.
+    """
+    def __init__(self, ratio=0.1, burst=5):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def earn(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Hedger:
+    """
+    Runs the primary attempt and, if no first byte arrives within its observed
+    percentile latency, fires a hedge to the backup provider. The first success
+    wins and the loser is cancelled (or its stream closed).
+    """
+    def __init__(self, tracker, categories, budget, default_delay=2.0, min_delay=0.25):
+        self.tracker = tracker
+        self.categories = categories
+        self.budget = budget
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+
+    def hedge_delay(self, p_id, category):
+        q = self.categories.get(category)
+        if q is None:
+            return None
+        return max(self.min_delay, self.tracker.percentile(p_id, q, default=self.default_delay))
+
+    async def _timed(self, start, p):
+        t0 = time.perf_counter()
+        result = await start(p)
+        result.latency = time.perf_counter() - t0
+        self.tracker.observe(p["id"], result.latency)
+        return result
+
+    async def call(self, primary, backup, category, start, on_error):
+        """
+        start(p) opens the upstream call; on_error(p_id, e) is invoked for each
+        failed attempt. Raises the last error if no attempt succeeds. The
+        budget is earned by the caller, once per request.
+        """
+        delay = self.hedge_delay(primary["id"], category) if backup else None
+        tasks = {asyncio.create_task(self._timed(start, primary)): primary["id"]}
+        last_error = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    if self.budget.try_spend():
+                        hedge_events.labels(category, "fired").inc()
+                        tasks[asyncio.create_task(self._timed(start, backup))] = backup["id"]
+                    else:
+                        hedge_events.labels(category, "budget_exhausted").inc()
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if len(tasks) > 1:
+                            hedge_events.labels(category, "won" if tasks[task] != primary["id"] else "lost").inc()
+                        for other in pending:
+                            await discard(other)
+                        for other in done - {task}:
+                            await discard(other)
+                        return task.result()
+                    last_error = task.exception()
+                    on_error(tasks[task], last_error)
+            raise last_error
+        except asyncio.CancelledError:
+            for task in tasks:
+                await discard(task)
+            raise
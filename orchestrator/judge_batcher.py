@@ -0,0 +1,110 @@
+import asyncio
+from prometheus_client import Counter, Histogram
+
+judge_batch_size = Histogram('neural_home_judge_batch_size', 'Queries per judge call', buckets=(1, 2, 4, 8, 16, 32))
+judge_batch_retries = Counter('neural_home_judge_batch_retries_total', 'Queries re-asked one by one after a bad batch verdict', ['reason'])
+
+SINGLE_PROMPT = """
+    TASK: Analyze user intent and language.
+    QUERY: "{query}"
+
+    RESPOND ONLY JSON:
+    {{
+      "cat": "CODING" (tech, code, debug) or "SIMPLE" (chat, info),
+      "lang": "language_name" (e.g. Italian, English)
+    }}
+    """
+
+BATCH_PROMPT = """
+    TASK: Analyze user intent and language for EACH numbered query.
+    {queries}
+
+    RESPOND ONLY with a JSON array of {n} objects, in the same order:
+    [{{
+      "cat": "CODING" (tech, code, debug) or "SIMPLE" (chat, info),
+      "lang": "language_name" (e.g. Italian, English)
+    }}, ...]
+    """
+
+
+class JudgeBatcher:
+    """
+    Collects concurrent judge classifications for a short window (or up to
+    max_items) and sends them as one structured prompt, fanning the verdicts
+    back to the waiting requests. Identical queries share one slot.
+
+    judge_fn(prompt) -> parsed JSON must raise if every judge model fails.
+    If the batch answer fails or is malformed, the valid per-index verdicts
+    are kept (when the array has the right length) and only the remaining
+    queries are re-asked with the single-query prompt.
+    """
+    def __init__(self, judge_fn, window_ms=30, max_items=16):
+        self.judge_fn = judge_fn
+        self.window = window_ms / 1000.0
+        self.max_items = max_items
+        self._pending = {}  # query -> [futures]
+        self._timer = None
+
+    async def classify(self, query):
+        query = query[:500]
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(query, []).append(fut)
+        if len(self._pending) >= self.max_items:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush_now)
+        return await fut
+
+    def _flush_now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            asyncio.get_running_loop().create_task(self._run(batch))
+
+    async def _single(self, query, futures):
+        try:
+            verdict = await self.judge_fn(SINGLE_PROMPT.format(query=query))
+        except Exception as e:
+            self._resolve(futures, error=e)
+            return
+        self._resolve(futures, verdict)
+
+    @staticmethod
+    def _resolve(futures, verdict=None, error=None):
+        for fut in futures:
+            if not fut.done():
+                if error is not None:
+                    fut.set_exception(error)
+                else:
+                    fut.set_result(verdict)
+
+    async def _run(self, batch):
+        queries = list(batch)
+        judge_batch_size.observe(len(queries))
+        if len(queries) == 1:
+            await self._single(queries[0], batch[queries[0]])
+            return
+
+        listing = "\n    ".join(f'{i + 1}. "{q}"' for i, q in enumerate(queries))
+        try:
+            verdicts = await self.judge_fn(BATCH_PROMPT.format(queries=listing, n=len(queries)))
+        except Exception:
+            verdicts, reason = None, "error"
+        else:
+            reason = "length" if isinstance(verdicts, list) else "format"
+        if not isinstance(verdicts, list) or len(verdicts) != len(queries):
+            verdicts = [None] * len(queries)  # Indici non affidabili: si richiede tutto
+        else:
+            reason = "invalid"
+
+        retry = []
+        for query, verdict in zip(queries, verdicts):
+            if isinstance(verdict, dict) and verdict.get("cat"):
+                self._resolve(batch[query], verdict)
+            else:
+                retry.append(query)
+        if retry:
+            judge_batch_retries.labels(reason).inc(len(retry))
+            await asyncio.gather(*(self._single(q, batch[q]) for q in retry))
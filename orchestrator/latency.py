@@ -0,0 +1,19 @@
+from collections import deque, defaultdict
+
+
+class LatencyTracker:
+    """
+    Per-provider ring buffer of the last N first-byte latencies (seconds).
+    """
+    def __init__(self, window=100):
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+
+    def observe(self, p_id, seconds):
+        self.samples[p_id].append(seconds)
+
+    def percentile(self, p_id, q, default=None, min_samples=5):
+        data = self.samples.get(p_id)
+        if not data or len(data) < min_samples:
+            return default
+        ordered = sorted(data)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
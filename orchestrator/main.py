@@ -1,93 +1,186 @@
 import os
-import redis
+import asyncio
 import json
 import uvicorn
-import hashlib
-import uuid
 import time
+import math
+import threading
 from pathlib import Path
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from dotenv import load_dotenv
-from openai import OpenAI
-from google import genai
-from google.genai import types
-from .rate_limiter import RateLimiter
+from redis import asyncio as aioredis
+from .rate_limiter import RateLimiter, LeasedLimiter, parse_limits
+from .providers import ProviderPool, LazyClient, google_client as build_google_client, load_sdks
+from .cache import TwoTierCache, normalized_hash
+from .classifier import LocalClassifier, JudgeLog
+from .judge_batcher import JudgeBatcher
+from .upstream import call_provider, with_language, discard
+from .speculative import VerdictPredictor, speculative_events, speculative_wasted
+from .latency import LatencyTracker
+from .hedging import Hedger, HedgeBudget, parse_hedge_config
+from .response_cache import ResponseCache, cache_policy, cacheable, response_key
+from .near_dup import NearDupIndex
+from .singleflight import SingleFlight, flight_key, coalescable
+from .router import AdaptiveRouter, ProviderStats, static_route
+from .redis_ctx import RedisFlusher, fetch_request_context
+from .gpu_queue import GpuQueue, GpuQueueWorker, queue_priority
+from .concurrency import ConcurrencyLimiter, ConcurrencyShed
+from .sse import coalesce
+from .failover import StreamFailover
+from .timing import RequestTimer
+from .tracing import TraceBuffer, SamplingProfiler
+from .affinity import SessionAffinity
+from .state_watcher import StateWatcher
+from .shared_state import SharedState, ROUTING_MODES, deployment_namespace
+from .context import estimate_messages, fits, prompt_budget, parse_trim_policies, trim_policy, trim, context_excluded, context_trimmed, prompt_tokens_estimated
 from prometheus_fastapi_instrumentator import Instrumentator, metrics
-from prometheus_client import Gauge
+from prometheus_client import Gauge, multiprocess
 
 # --- CONFIGURAZIONE ---
+STARTED_AT = time.perf_counter()
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 load_dotenv(PROJECT_ROOT / ".env")
 
-STATE_FILE = PROJECT_ROOT / "infrastructure" / "state.json"
-CHECKSUM_FILE = PROJECT_ROOT / "infrastructure" / "state.json.checksum"
+STATE_FILE = Path(os.getenv("STATE_FILE", PROJECT_ROOT / "infrastructure" / "state.json"))
+CHECKSUM_FILE = STATE_FILE.with_name(STATE_FILE.name + ".checksum")
+# Namespace Redis dello stato condiviso: di default host + percorso di state.json (dev e benchmark restano separati)
+ORCHESTRATOR_DEPLOYMENT = deployment_namespace(STATE_FILE, os.getenv("ORCHESTRATOR_DEPLOYMENT"))
 
-# Globals (Cached)
-PROVIDERS = {}
-LAST_STATE_LOAD = 0
+STATE_INOTIFY = os.getenv("STATE_INOTIFY", "1") == "1"
+STATE_POLL_INTERVAL = float(os.getenv("STATE_POLL_INTERVAL", "2"))  # Senza inotify: controllo stat dei file
 
-def load_state_safe():
-    """
-    Implements Safe Read Protocol (Blueprint Sec 3.2).
-    Reads checksum, reads state, validates.
-    """
-    global PROVIDERS, LAST_STATE_LOAD
-    
-    # Reload every 60s max to avoid disk spam, unless forced
-    if time.time() - LAST_STATE_LOAD < 60 and PROVIDERS:
-        return
+provider_pool = ProviderPool()
 
-    try:
-        # 1. Read Checksum
-        with open(CHECKSUM_FILE, 'r') as f:
-            expected_checksum = f.read().strip()
-        
-        # 2. Read State
-        with open(STATE_FILE, 'r') as f:
-            content = f.read()
-        
-        # 3. Validate
-        real_checksum = hashlib.sha256(content.encode('utf-8')).hexdigest()
-        if real_checksum != expected_checksum:
-            print("⚠️ State file checksum mismatch! Retrying...")
-            time.sleep(1)
-            return load_state_safe() # Retry once
-            
-        state = json.loads(content)
-        
-        # 4. Update Config
-        if 'api_providers' in state:
-            # Add API Keys from env (they are NOT in state.json for security)
-            new_providers = state['api_providers']
-            # Enrichment
-            if "qwen_cloud" in new_providers: new_providers["qwen_cloud"]["key"] = os.getenv("DASHSCOPE_API_KEY")
-            if "groq" in new_providers: new_providers["groq"]["key"] = os.getenv("GROQ_API_KEY")
-            # Google Auth is implicit via genai.Client
-            
-            PROVIDERS = new_providers
-            LAST_STATE_LOAD = time.time()
-            print("✅ State loaded successfully.")
-            
-    except Exception as e:
-        print(f"❌ Error loading state: {e}")
-        # Fallback to hardcoded/previous if critical failure?
-        # For now, we trust state.json is there.
+def build_providers(state):
+    """api_providers from state.json, enriched with the API keys (they are NOT in state.json for security)."""
+    providers = {p_id: dict(p) for p_id, p in state['api_providers'].items()}
+    if "qwen_cloud" in providers: providers["qwen_cloud"]["key"] = os.getenv("DASHSCOPE_API_KEY")
+    if "groq" in providers: providers["groq"]["key"] = os.getenv("GROQ_API_KEY")
+    # Google Auth is implicit via genai.Client
+    return providers
+
+def on_state_swap(snap):
+    provider_pool.sync(snap.providers)
+    shared.publish_providers(snap)  # Avviso agli altri worker: rileggono e validano il proprio file
 
-# Load on startup
-load_state_safe()
+# Snapshot immutabile dei provider: ricaricato in background, le richieste leggono solo il riferimento.
+# Il primo caricamento avviene allo startup dell'app, non all'import.
+state = StateWatcher(STATE_FILE, CHECKSUM_FILE, build_providers, on_state_swap,
+                     use_inotify=STATE_INOTIFY, poll_interval=STATE_POLL_INTERVAL)
 
 # Modelli Giudice in ordine di preferenza (Gratis & Veloci)
 JUDGE_MODELS = ["models/gemma-3-4b-it", "models/gemini-2.0-flash-lite"]
+# Cache dei verdetti del giudice (LRU locale + Redis condiviso)
+JUDGE_CACHE_TTL = int(os.getenv("JUDGE_CACHE_TTL", "86400"))
+JUDGE_CACHE_SIZE = int(os.getenv("JUDGE_CACHE_SIZE", "4096"))
+# Classificatore locale: il giudice remoto viene usato solo sotto questa confidenza
+JUDGE_LOG_FILE = os.getenv("JUDGE_LOG_FILE", str(PROJECT_ROOT / "judge_decisions.jsonl"))  # Vuoto = nessun log delle query
+JUDGE_LOG_MAX_MB = float(os.getenv("JUDGE_LOG_MAX_MB", "50"))  # Oltre, rotazione in .1
+CLASSIFIER_MODEL_FILE = os.getenv("CLASSIFIER_MODEL_FILE", str(PROJECT_ROOT / "orchestrator" / "classifier_model.json"))
+CLASSIFIER_THRESHOLD = float(os.getenv("CLASSIFIER_THRESHOLD", "0.9"))
+# Micro-batching delle chiamate al giudice (finestra in ms o N richieste)
+JUDGE_BATCH_WINDOW_MS = int(os.getenv("JUDGE_BATCH_WINDOW_MS", "30"))
+JUDGE_BATCH_MAX = int(os.getenv("JUDGE_BATCH_MAX", "16"))
+# Dispatch speculativo: la chiamata upstream parte in parallelo al giudice
+SPECULATIVE_DISPATCH = os.getenv("SPECULATIVE_DISPATCH", "0") == "1"
+# Hedging: categoria -> percentile di latenza oltre il quale parte la richiesta di riserva
+# (es. "SIMPLE:0.95,CODING:0.99"; vuoto = disattivato)
+HEDGE_CATEGORIES = parse_hedge_config(os.getenv("HEDGE_CATEGORIES", ""))
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.1"))
+# Cache delle risposte identiche (solo temperature=0)
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+# Cache dei quasi-duplicati (MinHash/LSH, solo categoria SIMPLE)
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.9"))
+NEAR_DUP_MAX_ENTRIES = int(os.getenv("NEAR_DUP_MAX_ENTRIES", "5000"))
+# Router: "static" (catena if/else) oppure "adaptive" (score su quota/latenza/qualità, Blueprint Sec 4.2)
+ROUTER_POLICY = os.getenv("ROUTER_POLICY", "static")
+ROUTER_WEIGHTS = json.loads(os.getenv("ROUTER_WEIGHTS", "null"))
+ROUTER_LATENCY_CEILING_MS = float(os.getenv("ROUTER_LATENCY_CEILING_MS", "5000"))
+ROUTER_STATS_REFRESH = float(os.getenv("ROUTER_STATS_REFRESH", "2"))
+# Redis (client async con pool; le scritture non urgenti passano dal flusher)
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+# Redis lento o irraggiungibile: meglio degradare (GPU occupata, niente cache) che bloccare le richieste
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.5"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.5"))
+REDIS_FLUSH_INTERVAL_MS = int(os.getenv("REDIS_FLUSH_INTERVAL_MS", "50"))
+SHARED_STATE_REFRESH = float(os.getenv("SHARED_STATE_REFRESH", "5"))  # Rilettura di modalità/snapshot anche senza notifiche pub/sub
+# Rate limit: "nome:burst:per_minuto,..." (classi cheap/expensive; global e client aggiungono un bucket solo se presenti qui)
+RATE_LIMITS = parse_limits(os.getenv("RATE_LIMITS", ""))
+PROVIDER_RATE_LIMITS = parse_limits(os.getenv("PROVIDER_RATE_LIMITS", ""))
+LIMITER_LEASE_TTL = float(os.getenv("LIMITER_LEASE_TTL", "2"))
+LIMITER_LOCAL_SHARE = float(os.getenv("LIMITER_LOCAL_SHARE", "0.25"))  # Quota dei limiti globali per processo se Redis è giù (~1/worker)
+# Coda GPU (Blueprint Sec 4.2): le richieste per il provider locale passano da gpu_queue:high/low
+GPU_PROVIDER = "ollama"
+GPU_QUEUE_ENABLED = os.getenv("GPU_QUEUE_ENABLED", "1") == "1"
+GPU_QUEUE_CONCURRENCY = int(os.getenv("GPU_QUEUE_CONCURRENCY", "2"))  # Inferenze parallele del worker; 0 = worker esterno (python -m orchestrator.gpu_queue worker)
+GPU_QUEUE_DEADLINES = {"high": float(os.getenv("GPU_QUEUE_DEADLINE_HIGH", "15")), "low": float(os.getenv("GPU_QUEUE_DEADLINE_LOW", "120"))}
+# Concorrenza adattiva per provider (AIMD): oltre il limite si attende in coda, poi si passa al provider successivo
+CONCURRENCY_INITIAL = int(os.getenv("CONCURRENCY_INITIAL", "8"))
+CONCURRENCY_MAX = int(os.getenv("CONCURRENCY_MAX", "64"))
+CONCURRENCY_MAX_QUEUE = int(os.getenv("CONCURRENCY_MAX_QUEUE", "32"))
+CONCURRENCY_SPILL_MS = int(os.getenv("CONCURRENCY_SPILL_MS", "250"))  # Attesa di uno slot prima di passare al provider successivo
+CONCURRENCY_QUEUE_TIMEOUT = float(os.getenv("CONCURRENCY_QUEUE_TIMEOUT", "5"))  # Attesa sull'ultimo candidato prima del 503
+GPU_QUEUE_BATCH_CLIENTS = [c.strip().lower() for c in os.getenv("GPU_QUEUE_BATCH_CLIENTS", "aider").split(",") if c.strip()]
+# Streaming: accorpa i delta minuscoli arrivati entro la finestra (0 = passthrough puro)
+STREAM_COALESCE_MS = int(os.getenv("STREAM_COALESCE_MS", "0"))
+STREAM_COALESCE_CHARS = int(os.getenv("STREAM_COALESCE_CHARS", "64"))
+# Failover a metà stream: silenzio oltre il timeout o errore -> il provider successivo continua la risposta
+STREAM_CHUNK_TIMEOUT = float(os.getenv("STREAM_CHUNK_TIMEOUT", "30"))
+STREAM_FAILOVER_MAX = int(os.getenv("STREAM_FAILOVER_MAX", "2"))  # 0 = disattivato
+# Tracing in-process (/debug/traces): errori e le N più lente sempre, il resto campionato
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))
+TRACE_SLOWEST = int(os.getenv("TRACE_SLOWEST", "20"))
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"  # /debug/profile, solo su richiesta esplicita
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+# Finestra di contesto: margine sulla stima dei token e politica di taglio per client (none | drop_oldest | summarize)
+CONTEXT_SAFETY_MARGIN = float(os.getenv("CONTEXT_SAFETY_MARGIN", "1.1"))
+CONTEXT_TRIM_POLICIES = parse_trim_policies(os.getenv("CONTEXT_TRIM_POLICIES", "aider:drop_oldest"))
+CONTEXT_TRIM_DEFAULT = os.getenv("CONTEXT_TRIM_DEFAULT", "none")
+# Affinità di sessione: la conversazione resta sul provider che ha già il prefisso in cache (KV Ollama, prompt cache)
+AFFINITY_ENABLED = os.getenv("AFFINITY_ENABLED", "1") == "1"
+AFFINITY_IDLE_TTL = int(os.getenv("AFFINITY_IDLE_TTL", "900"))
 
 app = FastAPI()
-r = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
-limiter = RateLimiter(r)
-google_client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+r = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True, max_connections=REDIS_MAX_CONNECTIONS,
+                   socket_connect_timeout=REDIS_CONNECT_TIMEOUT, socket_timeout=REDIS_SOCKET_TIMEOUT)
+# Solo per XREAD/BLPOP della coda GPU, che bloccano più a lungo del socket_timeout
+r_blocking = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True, max_connections=4,
+                            socket_connect_timeout=REDIS_CONNECT_TIMEOUT)
+flusher = RedisFlusher(r, interval=REDIS_FLUSH_INTERVAL_MS / 1000.0)
+shared = SharedState(r, flusher, ORCHESTRATOR_DEPLOYMENT, state.hint, SHARED_STATE_REFRESH)  # Modalità di routing comune a tutti i worker del deployment
+limiter = LeasedLimiter(RateLimiter(r, RATE_LIMITS, PROVIDER_RATE_LIMITS), lease_ttl=LIMITER_LEASE_TTL, local_share=LIMITER_LOCAL_SHARE)
+judge_cache = TwoTierCache(r, flusher, "judge", ttl=JUDGE_CACHE_TTL, max_items=JUDGE_CACHE_SIZE)
+local_classifier = LocalClassifier.load(CLASSIFIER_MODEL_FILE)
+predictor = VerdictPredictor(local_classifier)
+judge_log = JudgeLog(JUDGE_LOG_FILE, max_bytes=int(JUDGE_LOG_MAX_MB * 1024 * 1024))
+latency_tracker = LatencyTracker()
+hedger = Hedger(latency_tracker, HEDGE_CATEGORIES, HedgeBudget(HEDGE_BUDGET_RATIO))
+response_cache = ResponseCache(r, flusher, ttl=RESPONSE_CACHE_TTL, max_items=RESPONSE_CACHE_SIZE)
+single_flight = SingleFlight()
+router_stats = ProviderStats(r, flusher)
+router = AdaptiveRouter(router_stats, ROUTER_WEIGHTS, ROUTER_LATENCY_CEILING_MS)
+near_dup_index = NearDupIndex(r, flusher, threshold=NEAR_DUP_THRESHOLD, max_entries=NEAR_DUP_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL)
+google_client = LazyClient(build_google_client)  # SDK importato e client creato al primo uso (o dal warm-up)
+gpu_queue = GpuQueue(r, flusher, GPU_QUEUE_DEADLINES, blocking_client=r_blocking) if GPU_QUEUE_ENABLED else None
+gpu_worker = GpuQueueWorker(r, lambda: state.providers, provider_pool.get, GPU_QUEUE_CONCURRENCY, blocking_client=r_blocking) if GPU_QUEUE_ENABLED and GPU_QUEUE_CONCURRENCY > 0 else None
+concurrency = ConcurrencyLimiter(CONCURRENCY_INITIAL, CONCURRENCY_MAX, CONCURRENCY_MAX_QUEUE)
+stream_failover = StreamFailover(STREAM_CHUNK_TIMEOUT, STREAM_FAILOVER_MAX)
+traces = TraceBuffer(TRACE_BUFFER_SIZE, TRACE_SAMPLE_RATE, TRACE_SLOWEST)
+profiler = SamplingProfiler(PROFILER_MAX_SECONDS)
+affinity = SessionAffinity(flusher, AFFINITY_IDLE_TTL) if AFFINITY_ENABLED else None
+background_tasks = []
+warm_at = None  # Fine del warm-up (perf_counter), per /ready
 
 # --- METRICHE CUSTOM ---
-gpu_gauge = Gauge('neural_home_gpu_status', 'GPU Status: 1=Green (Available), 0=Red (Busy/Cooldown)')
-limit_gauge = Gauge('neural_home_rate_limit_remaining', 'Remaining tokens/requests', ['provider', 'type'])
+# multiprocess_mode conta solo con PROMETHEUS_MULTIPROC_DIR (uvicorn --workers N)
+gpu_gauge = Gauge('neural_home_gpu_status', 'GPU Status: 1=Green (Available), 0=Red (Busy/Cooldown)', multiprocess_mode='livemostrecent')
+limit_gauge = Gauge('neural_home_rate_limit_remaining', 'Remaining tokens/requests', ['provider', 'type'], multiprocess_mode='livemostrecent')
+startup_gauge = Gauge('neural_home_startup_seconds', 'Seconds from module import to warm (state loaded, SDKs and clients ready)', multiprocess_mode='livemax')
 
 # Instrument globally (Middleware must be added here)
 instrumentator = Instrumentator().instrument(app)
@@ -96,10 +189,13 @@ instrumentator = Instrumentator().instrument(app)
 async def update_metrics_on_scrape(request: Request, call_next):
     # Update Gauge ONLY when Prometheus scrapes
     if request.url.path == "/metrics":
+        state.refresh_metrics()
         try:
-            status = r.get("gpu_status")
+            status = await r.get("gpu_status")
             val = 1 if status and status == "VERDE" else 0
             gpu_gauge.set(val)
+            if gpu_queue:
+                await gpu_queue.refresh_length()
         except Exception:
             pass
     return await call_next(request)
@@ -109,16 +205,59 @@ async def startup():
     # Expose endpoint
     instrumentator.expose(app)
     
+    flusher.start()
+    judge_log.start()
+    await state.reload()  # Lettura e checksum in un thread; poi il watcher tiene lo snapshot aggiornato
+    await shared.refresh()  # Modalità di routing (e rilettura del file se un altro worker ne ha visto uno più recente)
+    state.start()
+    shared.start()
+    background_tasks.append(asyncio.get_running_loop().create_task(warm_up()))
+    background_tasks.append(asyncio.get_running_loop().create_task(refresh_router_stats()))
+    if gpu_queue:
+        gpu_queue.start()
+    if gpu_worker:
+        background_tasks.append(asyncio.get_running_loop().create_task(gpu_worker.run()))
+    await near_dup_index.load()
+
     # Init GPU Metric
     try:
-        status = r.get("gpu_status")
+        status = await r.get("gpu_status")
         gpu_gauge.set(1 if status == "VERDE" else 0)
         print("📊 Metrics Initialized: GPU Status synced.")
     except Exception as e:
         print(f"⚠️ Metrics Init Failed: {e}")
 
-current_mode = "AUTO"
-manual_target_id = None
+@app.on_event("shutdown")
+async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    if gpu_queue:
+        await gpu_queue.stop()
+    await state.stop()
+    await shared.stop()
+    await flusher.stop()
+    await judge_log.stop()
+    await provider_pool.aclose()
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())  # Via i gauge "live" di questo worker
+
+async def warm_up():
+    # Il server accetta già connessioni: SDK importati in un thread, poi i client, senza bloccare il loop
+    global warm_at
+    try:
+        await asyncio.to_thread(load_sdks)
+        provider_pool.warm(state.providers)
+        google_client.get()
+    except Exception as e:
+        print(f"⚠️ Warm-up incompleto ({e}): i client verranno creati al primo uso.")
+    warm_at = time.perf_counter()
+    startup_gauge.set(warm_at - STARTED_AT)
+    print(f"🔥 Warm-up completato in {(warm_at - STARTED_AT) * 1000:.0f} ms dall'import.")
+
+async def refresh_router_stats():
+    while True:
+        await router_stats.refresh(state.providers)
+        await asyncio.sleep(ROUTER_STATS_REFRESH)
 
 # --- HELPERS ---
 def clean_user_query(query):
@@ -126,146 +265,403 @@ def clean_user_query(query):
     clean = query.split("To suggest changes")[0].split("Reply in English")[0].strip()
     return clean
 
-def get_sane_providers(gpu_ready):
-    sane = [p["id"] for p in PROVIDERS.values() if not r.exists(f"cooldown:{p['id']}")]
+def request_query(messages):
+    raw_query = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+    return clean_user_query(raw_query)
+
+def get_sane_providers(providers, gpu_ready, cooldowns):
+    sane = [p["id"] for p in providers.values() if p["id"] not in cooldowns]
     if not gpu_ready and "ollama" in sane:
         sane.remove("ollama")
     return sane
 
 def set_cooldown(p_id):
-    r.setex(f"cooldown:{p_id}", 60, "BLOCKED")
+    flusher.add(lambda pipe: pipe.setex(f"cooldown:{p_id}", 60, "BLOCKED"))
     print(f"⚠️  [COOLDOWN] {p_id} bloccato per 60s.")
 
 def log_success(p_id):
-    r.incr(f"stats:{p_id}:requests")
+    flusher.add(lambda pipe: pipe.incr(f"stats:{p_id}:requests"))
+    limiter.spend(p_id)
+
+def open_upstream(p, messages, is_stream, req_model, priority="high", slot_wait=0.0):
+    # Il provider locale passa dalla coda GPU (priorità, concorrenza, deadline)
+    if gpu_queue and p["id"] == GPU_PROVIDER:
+        return gpu_queue.submit(p, messages, is_stream, req_model, priority)
+    return concurrency.call(p["id"], slot_wait, lambda: call_provider(provider_pool.get(p), p, messages, is_stream, req_model))
+
+def provider_failed(p_id, e):
+    if isinstance(e, ConcurrencyShed):
+        print(f"🚦 {e}")
+        return  # Provider sano ma saturo: niente statistiche d'errore né cooldown
+    print(f"❌ Errore {p_id}: {e}")
+    limiter.spend(p_id)
+    router_stats.record(p_id, None, False)
+    if "429" in str(e) or "quota" in str(e).lower(): set_cooldown(p_id)
 
 # --- FASE 1: IL GIUDICE (ANALISTA PURO) ---
-def analyze_request(user_query):
-    prompt = f"""
-    TASK: Analyze user intent and language.
-    QUERY: "{user_query[:500]}"
-    
-    RESPOND ONLY JSON:
-    {{
-      "cat": "CODING" (tech, code, debug) or "SIMPLE" (chat, info),
-      "lang": "language_name" (e.g. Italian, English)
-    }}
-    """
+async def call_judge(prompt):
     for model_name in JUDGE_MODELS:
         try:
             # Usiamo Google nativo per il giudice (è il più stabile per istruzioni JSON)
-            res = google_client.models.generate_content(model=model_name, contents=prompt)
+            res = await google_client.models.generate_content(model=model_name, contents=prompt)
             clean_text = res.text.replace('```json', '').replace('```', '').strip()
             return json.loads(clean_text)
         except Exception as e:
             # print(f"Giudice {model_name} fallito: {e}") # Decommentare per debug
             continue
-    return {"cat": "SIMPLE", "lang": "Italian"} # Fallback
+    raise RuntimeError("Tutti i modelli giudice falliti.")
+
+async def summarize_history(transcript):
+    # Riassunto dei turni tagliati con il modello giudice a contesto lungo
+    prompt = f"Summarize this conversation in at most 300 words, keeping file names, decisions and open tasks:\n\n{transcript}"
+    res = await google_client.models.generate_content(model=JUDGE_MODELS[-1], contents=prompt)
+    return res.text
+
+judge_batcher = JudgeBatcher(call_judge, window_ms=JUDGE_BATCH_WINDOW_MS, max_items=JUDGE_BATCH_MAX)
+
+async def local_verdict(user_query, values=None):
+    """
+    Verdict available without calling the judge (cache or confident local
+    model). values: Redis keys already read in the request-context pipeline.
+    """
+    key = normalized_hash(user_query)
+    cached = judge_cache.lookup(key, values) if values is not None else await judge_cache.get(key)
+    if cached:
+        return cached
+
+    if local_classifier:
+        verdict, confidence = local_classifier.classify(user_query)
+        if verdict and confidence >= CLASSIFIER_THRESHOLD:
+            return verdict
+    return None
+
+async def ask_judge(user_query):
+    try:
+        verdict = await judge_batcher.classify(user_query)
+        verdict = {"cat": verdict.get("cat", "SIMPLE"), "lang": verdict.get("lang", "Italian")}
+    except Exception:
+        return {"cat": "SIMPLE", "lang": "Italian"} # Fallback
+    judge_cache.set(normalized_hash(user_query), verdict)
+    judge_log.add(user_query, verdict)
+    return verdict
+
+async def analyze_request(user_query):
+    return await local_verdict(user_query) or await ask_judge(user_query)
 
 # --- FASE 2: L'ORCHESTRATORE (DECISORE) ---
-def decide_routing(category, gpu_ready, sane_list):
-    # Priorità CODING
-    if category == "CODING":
-        if gpu_ready and "ollama" in sane_list: return "ollama"
-        if "qwen_cloud" in sane_list: return "qwen_cloud"
-        return sane_list[0]
-    
-    # Priorità SIMPLE (Speed & Free Tier)
-    if "groq" in sane_list: return "groq"
-    if "gemini-flash" in sane_list: return "gemini-flash"
-    
-    return sane_list[0]
+def decide_routing(providers, category, gpu_ready, sane_list, pinned=None):
+    if pinned in sane_list:
+        return pinned  # Sessione agganciata a un provider ancora sano
+    if ROUTER_POLICY == "adaptive":
+        ranked = router.rank(category, sane_list, providers)
+        if ranked: return ranked[0]
+    return static_route(category, gpu_ready, sane_list)
+
+def waterfall_order(providers, category, target_id, sane_list):
+    rest = [p for p in sane_list if p != target_id]
+    if ROUTER_POLICY == "adaptive":
+        ranked = router.rank(category, rest, providers)
+        rest = ranked + [p for p in rest if p not in ranked]
+    return [target_id] + rest
 
 # --- API CORE ---
 @app.post("/v1/chat/completions")
 async def chat_proxy(request: Request):
     body = await request.json()
-    full_messages = body.get("messages", [])
-    is_stream = body.get("stream", False)
     req_model = body.get("model", "qwen-max")
+    timer = RequestTimer(on_stream_end=lambda t, error: traces.finish(t, 200, error))
 
-    # 0. Rate Limiting Check
+    # 0. Snapshot dei provider (ricaricato in background: nessun I/O su disco qui)
+    providers = state.providers
+
+    # 0.1 Rate Limiting Check (dal lease locale) + stato Redis della richiesta, in parallelo
+    acquire = None
     if limiter:
         # Determine cost/type based on provider
         limit_type = "cheap"
         if "gpt-4" in req_model.lower() or "claude" in req_model.lower(): 
             limit_type = "expensive"
-        
-        if not limiter.check_limit("global_user", cost=1, limit_type=limit_type):
-            raise HTTPException(status_code=429, detail="Rate limit exceeded. Slow down.")
+        client_id = request.headers.get("x-client-id") or (request.client.host if request.client else "anon")
+        buckets = limiter.buckets(client_id, limit_type, providers)
+        acquire = limiter.acquire(buckets)
+
+    session_key = affinity.session_key(body, request.headers) if affinity else None
+    extra_keys = [SessionAffinity.redis_key(session_key)] if session_key else []
+    extra_keys.append(judge_cache.redis_key(normalized_hash(request_query(body.get("messages", [])))))  # Verdetto condiviso, nello stesso round-trip
+    with timer.stage("limiter"):
+        if acquire:
+            ctx, limit = await asyncio.gather(fetch_request_context(r, providers, extra_keys), acquire)
+            ctx.limit = limit
+        else:
+            ctx = await fetch_request_context(r, providers, extra_keys)
+    ctx.providers = providers
+    if session_key:
+        ctx.session = affinity.load(session_key, ctx.values.get(SessionAffinity.redis_key(session_key)))
+    if ctx.limit:
+        for name, left in ctx.limit.remaining.items():
+            if name != "client":  # Un'etichetta per client farebbe esplodere la cardinalità
+                limit_gauge.labels(name if name in providers else "all", "provider" if name in providers else name).set(left)
+    if ctx.limit and not ctx.limit.allowed:
+        timer.observe()
+        traces.finish(timer, 429)
+        raise HTTPException(status_code=429, detail="Rate limit exceeded. Slow down.",
+                            headers={"Retry-After": str(max(1, math.ceil(ctx.limit.retry_after)))})
+
+    # 0.5 Coalescenza delle richieste identiche in volo (una sola chiamata upstream), salvo no-cache
+    try:
+        if coalescable(request.headers):
+            result = await single_flight.do(flight_key(body, request.headers), lambda: route_request(body, request.headers, ctx, timer))
+        else:
+            result = await route_request(body, request.headers, ctx, timer)
+        timer.label(provider=result.p_id)
+        if not result.is_stream:
+            timer.observe_body(result.body)
+    except HTTPException as e:
+        traces.finish(timer, e.status_code, e.detail)
+        raise
+    except Exception as e:
+        traces.finish(timer, 500, repr(e))
+        raise
+    finally:
+        timer.observe()
+    if not timer.streaming:
+        traces.finish(timer)  # Gli stream si chiudono in timer.track
+    return result.to_response(headers={"Server-Timing": timer.header()})
+
+async def route_request(body, headers, ctx, timer):
+    providers = ctx.providers
+    routing = shared.routing  # Modalità letta una volta: un cambio a metà richiesta non la tocca
+    full_messages = body.get("messages", [])
+    is_stream = body.get("stream", False)
+    req_model = body.get("model", "qwen-max")
 
     # 1. Estrazione domanda pulita
-    raw_query = next((m["content"] for m in reversed(full_messages) if m["role"] == "user"), "")
-    user_query = clean_user_query(raw_query)
+    user_query = request_query(full_messages)
 
-    # 1.5 Refresh State
-    load_state_safe()
-
-    # 2. Analisi Giudice
-    analysis = analyze_request(user_query)
-    cat, lang = analysis.get("cat", "SIMPLE"), analysis.get("lang", "Italian")
-
-    # 3. Decisione Hardware
-    gpu_on = (r.get("gpu_status") == "VERDE")
+    # 2. Decisione Hardware
+    gpu_on = ctx.gpu_on
     gpu_gauge.set(1 if gpu_on else 0) # Update Metric
-    sane_list = get_sane_providers(gpu_on)
-    
-    if current_mode == "MANUAL":
-        target_id = manual_target_id
+    exhausted = ctx.limit.exhausted(providers) if ctx.limit else set()
+    sane_list = get_sane_providers(providers, gpu_on, ctx.cooldowns | exhausted)
+
+    # 2.5 Finestra di contesto: fuori i provider in cui la richiesta non entra (niente tentativi destinati a fallire)
+    max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+    prompt_tokens = estimate_messages(full_messages)
+    prompt_tokens_estimated.observe(prompt_tokens)
+    too_big = {p for p in sane_list if not fits(providers[p], prompt_tokens, max_tokens, CONTEXT_SAFETY_MARGIN)}
+    if too_big and len(too_big) == len(sane_list):
+        policy = trim_policy(headers, CONTEXT_TRIM_POLICIES, CONTEXT_TRIM_DEFAULT)
+        if policy != "none":
+            budget = max(prompt_budget(providers[p], max_tokens, CONTEXT_SAFETY_MARGIN) for p in sane_list)
+            full_messages = await trim(full_messages, budget, policy, summarize_history)
+            context_trimmed.labels(policy).inc()
+            print(f"✂️  [CONTEXT] ~{prompt_tokens} token -> ~{estimate_messages(full_messages)} ({policy})")
+            prompt_tokens = estimate_messages(full_messages)
+            too_big = {p for p in sane_list if not fits(providers[p], prompt_tokens, max_tokens, CONTEXT_SAFETY_MARGIN)}
+    for p in too_big:
+        context_excluded.labels(p).inc()
+    sane_list = [p for p in sane_list if p not in too_big]
+    if too_big and not sane_list and routing.mode == "AUTO":
+        raise HTTPException(status_code=413, detail=f"Richiesta troppo lunga (~{prompt_tokens} token) per i provider disponibili.")
+    if not sane_list and routing.mode == "AUTO":
+        raise HTTPException(status_code=503, detail="Nessun provider disponibile (cooldown o rate limit).")
+
+    pinned = ctx.session.pinned if ctx.session else None
+
+    # 3. Analisi Giudice (con dispatch speculativo verso il target più probabile)
+    spec, spec_target, guess = None, None, None
+    t = time.perf_counter()
+    analysis = await local_verdict(user_query, ctx.values)
+    if analysis is None:
+        if SPECULATIVE_DISPATCH and routing.mode == "AUTO" and sane_list:
+            guess = predictor.predict(user_query)
+            spec_target = decide_routing(providers, guess["cat"], gpu_on, sane_list, pinned)
+            p = providers[spec_target]
+            spec_priority = queue_priority(headers, guess["cat"], GPU_QUEUE_BATCH_CLIENTS)
+            # Il target finale non è ancora noto: attesa dello slot come per un candidato intermedio
+            spec = asyncio.create_task(open_upstream(p, with_language(full_messages, guess["lang"]), is_stream, req_model, spec_priority, CONCURRENCY_SPILL_MS / 1000))
+        try:
+            analysis = await ask_judge(user_query)
+        except BaseException:
+            if spec: await discard(spec)
+            raise
+    predictor.observe(analysis)
+    cat, lang = analysis.get("cat", "SIMPLE"), analysis.get("lang", "Italian")
+    timer.lap("judge", t)
+    timer.label(category=cat)
+
+    # 3.5 Le richieste batch attendono la GPU in coda anche se ora è occupata
+    t = time.perf_counter()
+    priority = queue_priority(headers, cat, GPU_QUEUE_BATCH_CLIENTS)
+    gpu_ready = gpu_on
+    if gpu_queue and not gpu_on and priority == "low" and GPU_PROVIDER in providers and GPU_PROVIDER not in ctx.cooldowns | exhausted \
+            and fits(providers[GPU_PROVIDER], prompt_tokens, max_tokens, CONTEXT_SAFETY_MARGIN):
+        gpu_ready = True
+        sane_list = sane_list + [GPU_PROVIDER]
+
+    if routing.mode == "MANUAL":
+        target_id = routing.target
     else:
-        target_id = decide_routing(cat, gpu_on, sane_list)
+        target_id = decide_routing(providers, cat, gpu_ready, sane_list, pinned)
+        if affinity: affinity.record_route(ctx.session, target_id)
 
     # 4. Imposizione Lingua (Modifica Payload)
-    lang_cmd = f"\n\n(SYSTEM OVERRIDE: User speaks {lang}. Respond ONLY in {lang}. Ignore previous instructions to use English.)"
-    full_messages[-1]["content"] += lang_cmd
+    full_messages = with_language(full_messages, lang)
+    timer.lap("routing", t)
+
+    # 4.5 Cache delle risposte (richieste deterministiche)
+    t = time.perf_counter()
+    cache_lookup, cache_store = cache_policy(body, headers)
+    resp_key = response_key(body, full_messages) if cache_store else None
+    entry = await response_cache.get(resp_key) if cache_lookup else None
+    if not entry and cache_lookup and cat == "SIMPLE":
+        entry = near_dup_index.lookup(full_messages, req_model)
+    timer.lap("cache", t)
+    if entry:
+        if spec:
+            speculative_events.labels("cache").inc()
+            await discard(spec)
+        print(f"\n═ CACHE: {cat} | {lang} -> {entry['provider']} ═")
+        timer.label(provider=entry["provider"])
+        return response_cache.to_upstream(entry, is_stream, req_model)
+
+    def remember(p_id, answer):
+        if not cacheable(answer):
+            return
+        response_cache.set(resp_key, p_id, answer)
+        if cat == "SIMPLE":
+            near_dup_index.add(full_messages, req_model, {"provider": p_id, "body": answer})
+
+    def switched(result):
+        log_success(result.p_id)
+        router_stats.record(result.p_id, result.latency, True)
+
+    def finish(result):
+        switched(result)
+        if affinity: affinity.remember(ctx.session, result.p_id, body.get("messages", []))
+        timer.lap("upstream", upstream_start)
+        timer.label(provider=result.p_id)
+        if result.is_stream:
+            result = stream_failover.wrap(
+                result, full_messages,
+                lambda tried: [providers[x] for x in attempts if x in providers and x not in failed | tried],
+                lambda x, msgs: open_upstream(x, msgs, True, req_model, priority, slot_wait(x["id"])),
+                on_error, switched)
+            result.chunks = timer.track(result.chunks)
+        if result.is_stream and STREAM_COALESCE_MS > 0:
+            result.chunks = coalesce(result.chunks, STREAM_COALESCE_MS, STREAM_COALESCE_CHARS)
+        if cache_store:
+            if result.is_stream:
+                result.chunks = response_cache.record(result.chunks, req_model, lambda answer: remember(result.p_id, answer))
+            else:
+                remember(result.p_id, result.body)
+        return result
 
     # 5. Esecuzione Waterfall
-    attempts = [target_id] + [p for p in sane_list if p != target_id]
-
-    for p_id in attempts:
-        p = PROVIDERS.get(p_id)
-        if not p: continue
+    attempts = waterfall_order(providers, cat, target_id, sane_list)
+
+    failed, shed = set(), []
+    def on_error(p_id, e):
+        failed.add(p_id)
+        if isinstance(e, ConcurrencyShed): shed.append(e.retry_after)
+        provider_failed(p_id, e)
+
+    # Sui candidati intermedi si attende poco uno slot (poi si scala al successivo), sull'ultimo fino al timeout
+    last_id = next((x for x in reversed(attempts) if x in providers), None)
+    def slot_wait(p_id):
+        return CONCURRENCY_QUEUE_TIMEOUT if p_id == last_id else CONCURRENCY_SPILL_MS / 1000
+
+    upstream_start = time.perf_counter()
+    hedger.budget.earn()  # Una volta per richiesta, non per tentativo del waterfall
+    if spec:
+        if spec_target == target_id and guess["lang"] == lang:
+            try:
+                result = await spec
+                speculative_events.labels("hit").inc()
+                print(f"\n═ ROUTING: {cat} | {lang} -> {providers[target_id]['name']} (GPU: {gpu_on}, speculativo) ═")
+                return finish(result)
+            except ConcurrencyShed as e:
+                # Saturo, non guasto: il target resta nel waterfall con la sua attesa normale
+                speculative_events.labels("error").inc()
+                shed.append(e.retry_after)
+                provider_failed(target_id, e)
+            except Exception as e:
+                speculative_events.labels("error").inc()
+                provider_failed(target_id, e)
+                attempts.remove(target_id)
+        else:
+            speculative_events.labels("miss").inc()
+            speculative_wasted.labels(spec_target).inc()
+            await discard(spec)
+
+    for idx, p_id in enumerate(attempts):
+        p = providers.get(p_id)
+        if not p or p_id in failed: continue
+        backup = next((providers[x] for x in attempts[idx + 1:] if x in providers and x not in failed), None)
         
         print(f"\n═ ROUTING: {cat} | {lang} -> {p['name']} (GPU: {gpu_on}) ═")
 
         try:
-            if p["type"] == "google":
-                prompt_final = full_messages[-1]["content"]
-                if is_stream:
-                    def generate():
-                        response = google_client.models.generate_content_stream(model=p["model"], contents=prompt_final)
-                        for chunk in response:
-                            yield f"data: {json.dumps({'id': str(uuid.uuid4()), 'object': 'chat.completion.chunk', 'model': req_model, 'choices': [{'index': 0, 'delta': {'content': chunk.text}, 'finish_reason': None}]})}\n\n"
-                        yield "data: [DONE]\n\n"
-                    log_success(p_id)
-                    return StreamingResponse(generate(), media_type="text/event-stream")
-                else:
-                    res = google_client.models.generate_content(model=p["model"], contents=prompt_final)
-                    log_success(p_id)
-                    return JSONResponse(content={"id": str(uuid.uuid4()), "object": "chat.completion", "model": req_model, "choices": [{"index": 0, "message": {"role": "assistant", "content": res.text}, "finish_reason": "stop"}]})
-            else:
-                client = OpenAI(api_key=p["key"], base_url=p["url"])
-                response = client.chat.completions.create(model=p["model"], messages=full_messages, stream=is_stream, timeout=40)
-                if is_stream:
-                    def generate():
-                        for chunk in response:
-                            d = chunk.model_dump(); d["model"] = req_model
-                            yield f"data: {json.dumps(d)}\n\n"
-                        yield "data: [DONE]\n\n"
-                    log_success(p_id)
-                    return StreamingResponse(generate(), media_type="text/event-stream")
-                else:
-                    d = response.model_dump(); d["model"] = req_model
-                    log_success(p_id)
-                    return JSONResponse(content=d)
-
-        except Exception as e:
-            print(f"❌ Errore {p_id}: {e}")
-            if "429" in str(e) or "quota" in str(e).lower(): set_cooldown(p_id)
+            result = await hedger.call(p, backup, cat, lambda x: open_upstream(x, full_messages, is_stream, req_model, priority, slot_wait(x["id"])), on_error)
+            return finish(result)
+        except Exception:
             continue
 
+    timer.lap("upstream", upstream_start)
+    if shed:
+        raise HTTPException(status_code=503, detail="Provider saturi, riprova più tardi.", headers={"Retry-After": str(min(shed))})
     raise HTTPException(status_code=503, detail="Tutti i provider falliti.")
 
+@app.get("/v1/router/stats")
+async def router_stats_endpoint():
+    await router_stats.refresh(state.providers)
+    return {"policy": ROUTER_POLICY, "providers": router.report(state.providers)}
+
+@app.get("/v1/router/mode")
+async def router_mode():
+    return shared.routing._asdict()
+
+@app.post("/v1/router/mode")
+async def set_router_mode(request: Request):
+    # Scritto in Redis e notificato: tutti i worker passano alla nuova modalità
+    body = await request.json()
+    mode, target = str(body.get("mode", "")).upper(), body.get("target")
+    if mode not in ROUTING_MODES:
+        raise HTTPException(status_code=400, detail=f"mode deve essere uno di: {', '.join(ROUTING_MODES)}.")
+    if mode == "MANUAL" and target not in state.providers:
+        raise HTTPException(status_code=400, detail=f"Provider sconosciuto: {target}.")
+    try:
+        routing = await shared.set_routing(mode, target)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Redis non disponibile, modalità invariata ({e}).")
+    print(f"🔀 [ROUTING] Modalità {routing.mode}{' -> ' + routing.target if routing.target else ''}")
+    return routing._asdict()
+
+@app.get("/ready")
+async def readiness():
+    # 200 quando lo stato è caricato e SDK/client sono pronti; 503 durante lo startup (per deploy e load balancer)
+    checks = {"state": state.snapshot is not None, "warm": warm_at is not None}
+    body = {"ready": all(checks.values()), "checks": checks, "providers": len(state.providers),
+            "startup_ms": round((warm_at - STARTED_AT) * 1000, 1) if warm_at else None}
+    return body if body["ready"] else JSONResponse(status_code=503, content=body)
+
+@app.get("/debug/traces")
+async def debug_traces(kind: str = "all", limit: int = 50):
+    return traces.snapshot(kind, limit)
+
+@app.get("/debug/profile")
+async def debug_profile(seconds: float = 10, interval_ms: float = 5, format: str = "json"):
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler disattivato (PROFILER_ENABLED=1).")
+    try:
+        # Il campionatore gira in un thread e osserva lo stack del thread dell'event loop
+        profile = await asyncio.to_thread(profiler.run, threading.get_ident(), seconds, interval_ms / 1000)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if format == "collapsed":
+        return PlainTextResponse(profile.collapsed())
+    return profile.to_dict()
+
 @app.get("/v1/models")
 async def list_models():
     return {"data": [{"id": "qwen-max", "object": "model"}]}
@@ -0,0 +1,210 @@
+import sys
+import json
+import time
+import uuid
+import random
+import hashlib
+import logging
+import argparse
+from array import array
+from collections import OrderedDict, defaultdict
+from prometheus_client import Gauge
+from .cache import cache_events
+
+near_dup_size = Gauge('neural_home_near_dup_entries', 'Entries in the near-duplicate LSH index', multiprocess_mode='livemax')
+
+MAX_SIGNED_CHARS = 8000  # Oltre questa lunghezza si firma solo la coda del prompt
+ENTRY_KEY = "neardup:entry:{}"      # Una chiave per voce, con EX ttl: Redis le scade da solo
+INDEX_KEY = "neardup:index"         # zset id -> expires_at, per load(); potato per scadenza e dimensione
+LEGACY_KEY = "neardup:entries"      # Vecchio hash senza TTL
+
+
+def shingles(text, k=5):
+    norm = " ".join(text.lower().split())[-MAX_SIGNED_CHARS:]
+    if len(norm) <= k:
+        return {norm}
+    return {norm[i:i + k] for i in range(len(norm) - k + 1)}
+
+
+def minhash(text, num_perm=128):
+    """
+    One-permutation MinHash: each shingle is hashed once, its top bits pick a
+    bin and the bin keeps the minimum of the low bits. Empty bins borrow the
+    next non-empty bin (rotation densification), so signing is O(shingles).
+    """
+    bins = [None] * num_perm
+    for sh in shingles(text):
+        h = int.from_bytes(hashlib.blake2b(sh.encode('utf-8'), digest_size=8).digest(), 'big')
+        b, v = h % num_perm, h >> 32
+        if bins[b] is None or v < bins[b]:
+            bins[b] = v
+    if all(v is None for v in bins):
+        return array('Q', [0] * num_perm)
+    sig = array('Q')
+    for i in range(num_perm):
+        j, dist = i, 0
+        while bins[j] is None:
+            j, dist = (j + 1) % num_perm, dist + 1
+        sig.append(bins[j] + dist * 0x9E3779B1)
+    return sig
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity between two signatures."""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def prompt_text(messages):
+    return "\n".join(f"{m.get('role')}: {m.get('content') or ''}" for m in messages)
+
+
+class NearDupIndex:
+    """
+    LSH banded index over MinHash signatures of the prompts sent upstream.
+    Bounded to max_entries (LRU eviction) and mirrored to Redis so the index
+    survives restarts (writes go through the flusher). Entries use the same
+    {"provider", "body"} format as the response cache.
+
+    Redis is shared by all workers, so local evictions never delete there:
+    each entry is its own key with EX ttl, and the id index is trimmed by
+    expiry (ZREMRANGEBYSCORE) and to the newest max_entries on every add.
+    """
+    def __init__(self, redis_client, flusher, threshold=0.9, max_entries=5000, num_perm=128, bands=32, ttl=3600):
+        assert num_perm % bands == 0
+        self.redis = redis_client
+        self.flusher = flusher
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.ttl = ttl
+        self.entries = OrderedDict()       # id -> (signature, model, entry, expires_at)
+        self.buckets = defaultdict(list)   # hash(band, rows) -> [id]
+
+    def _band_keys(self, sig):
+        return [hash((i, *sig[i * self.rows:(i + 1) * self.rows])) for i in range(self.bands)]
+
+    def _insert(self, eid, sig, model, entry, expires_at):
+        self.entries[eid] = (sig, model, entry, expires_at)
+        for key in self._band_keys(sig):
+            self.buckets[key].append(eid)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+            cache_events.labels("near_dup", "lsh", "eviction").inc()
+        near_dup_size.set(len(self.entries))
+
+    def _remove(self, eid):
+        sig = self.entries.pop(eid)[0]
+        for key in self._band_keys(sig):
+            bucket = self.buckets.get(key)
+            if bucket and eid in bucket:
+                bucket.remove(eid)
+                if not bucket:
+                    del self.buckets[key]
+
+    def lookup(self, messages, model):
+        sig = minhash(prompt_text(messages), self.num_perm)
+        now = time.time()
+        candidates = set()
+        for key in self._band_keys(sig):
+            candidates.update(self.buckets.get(key, ()))
+        best, best_sim = None, self.threshold
+        for eid in candidates:
+            c_sig, c_model, entry, expires_at = self.entries[eid]
+            if expires_at < now:
+                self._remove(eid)
+                continue
+            if c_model != model:
+                continue
+            sim = similarity(sig, c_sig)
+            if sim >= best_sim:
+                best, best_sim = eid, sim
+        if best is None:
+            cache_events.labels("near_dup", "lsh", "miss").inc()
+            return None
+        cache_events.labels("near_dup", "lsh", "hit").inc()
+        self.entries.move_to_end(best)
+        return self.entries[best][2]
+
+    def add(self, messages, model, entry):
+        sig = minhash(prompt_text(messages), self.num_perm)
+        eid = uuid.uuid4().hex
+        expires_at = time.time() + self.ttl
+        self._insert(eid, sig, model, entry, expires_at)
+        raw = json.dumps({"sig": sig.tolist(), "model": model, "entry": entry, "expires_at": expires_at})
+        def op(pipe):
+            pipe.set(ENTRY_KEY.format(eid), raw, ex=self.ttl)
+            pipe.zadd(INDEX_KEY, {eid: expires_at})
+            pipe.zremrangebyscore(INDEX_KEY, "-inf", time.time())
+            pipe.zremrangebyrank(INDEX_KEY, 0, -self.max_entries - 1)
+        self.flusher.add(op)
+
+    async def load(self):
+        """Rebuilds the in-process index from Redis (e.g. at startup)."""
+        try:
+            ids = await self.redis.zrangebyscore(INDEX_KEY, time.time(), "+inf")
+            ids = ids[-self.max_entries:]
+            raw = await self.redis.mget([ENTRY_KEY.format(eid) for eid in ids]) if ids else []
+        except Exception as e:
+            logging.error(f"NearDup Redis Error: {e}")
+            return
+        self.flusher.add(lambda pipe: pipe.delete(LEGACY_KEY))
+        now = time.time()
+        for eid, v in zip(ids, raw):  # Ordinati per scadenza: i più vecchi escono per primi dall'LRU
+            if v is None:
+                continue  # Già scaduta in Redis
+            d = json.loads(v)
+            if d["expires_at"] < now or len(d["sig"]) != self.num_perm:
+                continue
+            self._insert(eid, array('Q', d["sig"]), d["model"], d["entry"], d["expires_at"])
+
+
+class _NullFlusher:
+    def add(self, op): pass
+
+
+def bench(sizes, lookups=200, seed=7):
+    """Lookup latency vs index size on synthetic prompts."""
+    import tracemalloc
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(5000)]
+    def prompt():
+        return [{"role": "user", "content": " ".join(rng.choice(words) for _ in range(rng.randint(20, 120)))}]
+    results = []
+    for size in sizes:
+        prompts = [prompt() for _ in range(size)]
+        tracemalloc.start()
+        index = NearDupIndex(None, _NullFlusher(), max_entries=size)
+        for p in prompts:
+            index.add(p, "m", {"provider": "bench", "body": {}})
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        timings, hits = [], 0
+        for i in range(lookups):
+            if i % 2:
+                q = [{"role": "user", "content": rng.choice(prompts)[0]["content"] + " ok"}]  # quasi-duplicato
+            else:
+                q = prompt()
+            t0 = time.perf_counter()
+            hits += index.lookup(q, "m") is not None
+            timings.append((time.perf_counter() - t0) * 1000)
+        timings.sort()
+        results.append({"entries": size, "p50_ms": round(timings[len(timings) // 2], 3), "p95_ms": round(timings[int(len(timings) * 0.95)], 3),
+                        "hit_rate": hits / lookups, "index_mb": round(mem / 1e6, 1)})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Near-duplicate index benchmark (lookup latency vs index size).")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--sizes", default="1000,5000,10000")
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args(argv)
+    for row in bench([int(x) for x in args.sizes.split(",")], args.lookups):
+        print(json.dumps(row))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import os
+import asyncio
+import httpx
+
+# Limiti del pool HTTP per provider (keep-alive tra una richiesta e l'altra)
+POOL_MAX_CONNECTIONS = int(os.getenv("PROVIDER_POOL_MAX_CONNECTIONS", "50"))
+POOL_MAX_KEEPALIVE = int(os.getenv("PROVIDER_POOL_MAX_KEEPALIVE", "20"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("PROVIDER_POOL_KEEPALIVE_EXPIRY", "60"))
+# Un client sostituito resta vivo per le richieste ancora in corso
+RETIRE_GRACE_SECONDS = 120
+
+
+def load_sdks():
+    """
+    Imports the provider SDKs, the slowest part of a cold start (~1s).
+    Modules are imported only once, so running this in a worker thread
+    at startup keeps the event loop free and the first request fast.
+    """
+    import openai  # noqa: F401
+    from google import genai  # noqa: F401
+
+
+class LazyClient:
+    """Builds the wrapped SDK client (and imports its SDK) on first use."""
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+
+    def get(self):
+        if self._client is None:
+            self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def google_client(api_key=None):
+    from google import genai
+    return genai.Client(api_key=api_key or os.getenv("GOOGLE_API_KEY")).aio
+
+
+class ProviderPool:
+    """
+    Async client pool, one client per provider id.
+    Clients keep their HTTP connections alive across requests and are rebuilt
+    only when a provider's type/url/key changes in state.json. They are
+    built on first use (or by warm()), so importing the pool costs nothing.
+    """
+    def __init__(self):
+        self._clients = {}  # p_id -> (fingerprint, client)
+
+    @staticmethod
+    def _fingerprint(p):
+        return (p.get("type"), p.get("url"), p.get("key"))
+
+    def _build(self, p):
+        if p.get("type") == "google":
+            return google_client(p.get("key"))
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        http_client = DefaultAsyncHttpxClient(limits=httpx.Limits(
+            max_connections=POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=POOL_MAX_KEEPALIVE,
+            keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+        ))
+        return AsyncOpenAI(api_key=p.get("key") or "EMPTY", base_url=p.get("url"), http_client=http_client)
+
+    def sync(self, providers):
+        """
+        Aligns the pool with the provider config. Clients of removed
+        providers, or whose fingerprint changed, are retired; the new ones
+        are built lazily by get().
+        """
+        for p_id in list(self._clients):
+            p = providers.get(p_id)
+            if p is None or self._fingerprint(p) != self._clients[p_id][0]:
+                self._retire(self._clients.pop(p_id)[1])
+                if p is not None:
+                    print(f"🔁 [POOL] Client {p_id} ricreato (url/key cambiati).")
+
+    def warm(self, providers):
+        """Builds every missing client ahead of the first request."""
+        for p in providers.values():
+            self.get(p)
+
+    def get(self, p):
+        fp = self._fingerprint(p)
+        current = self._clients.get(p["id"])
+        if current and current[0] == fp:
+            return current[1]
+        client = self._build(p)
+        self._clients[p["id"]] = (fp, client)
+        if current:
+            self._retire(current[1])
+            print(f"🔁 [POOL] Client {p['id']} ricreato (url/key cambiati).")
+        return client
+
+    def _retire(self, client):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # Nessun loop attivo: ci pensa il GC
+        loop.call_later(RETIRE_GRACE_SECONDS, lambda: loop.create_task(self._close(client)))
+
+    @staticmethod
+    async def _close(client):
+        try:
+            await (client.aclose() if hasattr(client, "aclose") else client.close())
+        except Exception:
+            pass
+
+    async def aclose(self):
+        for _, client in self._clients.values():
+            await self._close(client)
+        self._clients.clear()
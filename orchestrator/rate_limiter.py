@@ -1,14 +1,46 @@
 
 import time
+import math
+import asyncio
 import logging
-from redis import Redis
+from redis.asyncio import Redis
+from redis.exceptions import NoScriptError
+
+
+def parse_limits(spec):
+    """
+    "expensive:50:5,groq:30:30" -> {"expensive": (50, 5), "groq": (30, 30)}.
+    Values are (burst tokens, replenish rate per minute).
+    """
+    limits = {}
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        name, burst, per_min = item.split(":")
+        limits[name] = (float(burst), float(per_min))
+    return limits
+
+
+class LimitResult:
+    """Outcome of a multi-bucket check: remaining tokens per bucket name."""
+    def __init__(self, allowed=True, retry_after=0.0, remaining=None):
+        self.allowed = allowed
+        self.retry_after = retry_after
+        self.remaining = remaining or {}
+
+    def exhausted(self, names):
+        return {n for n in names if n in self.remaining and self.remaining[n] < 1}
+
 
 class RateLimiter:
     """
     Distributed Token Bucket Rate Limiter using Redis.
     Reference: Neural-Home Infrastructure Blueprint v3.0 - Sec 4.3
+
+    Every request checks several buckets atomically in one EVALSHA: its
+    limit type plus the candidate providers (cost 0: only reported,
+    consumed once the provider is actually called). A cross-type "global"
+    bucket and a per-client bucket are added only when configured in limits.
     """
-    def __init__(self, redis_client: Redis):
+    def __init__(self, redis_client: Redis, limits=None, provider_limits=None):
         self.redis = redis_client
         # Default Limits: (tokens, replenish_rate_per_minute)
         self.default_limits = {
@@ -16,55 +48,336 @@ class RateLimiter:
             "expensive": (50, 5),       # 50 burst, 1/12sec (e.g. GPT-4)
             "cheap": (2000, 120)        # 2000 burst, 2/sec (e.g. Ollama)
         }
+        self.default_limits.update(limits or {})
+        # Bucket opzionali (solo da RATE_LIMITS): tetto comune a tutti i tipi, e per client
+        self.shared_buckets = [name for name in ("global", "client") if name in (limits or {})]
+        self.provider_limits = dict(provider_limits or {})
+        self._script = redis_client.register_script(self.LUA_SCRIPT)
+
+    # Redis Lua Script for Atomicity
+    # KEYS: one HASH per bucket (fields: tokens, ts)
+    # ARGV[1]: current_timestamp
+    # ARGV[3i-1], ARGV[3i], ARGV[3i+1]: max_tokens, rate_per_sec, cost of bucket i
+    # Returns {allowed, retry_after_ms, remaining_1, ..., remaining_n}
+    LUA_SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local tokens = {}
+    local last_ts = {}
+    local allowed = 1
+    local retry_after = 0
+
+    for i = 1, #KEYS do
+        local max_tokens = tonumber(ARGV[3 * i - 1])
+        local rate = tonumber(ARGV[3 * i])
+        local cost = tonumber(ARGV[3 * i + 1])
+        local state = redis.call('hmget', KEYS[i], 'tokens', 'ts')
+        local current = tonumber(state[1]) or max_tokens
+        last_ts[i] = tonumber(state[2]) or now
+
+        -- Replenish tokens (ts never moves back: clocks of different processes may disagree)
+        tokens[i] = math.min(max_tokens, current + math.max(0, now - last_ts[i]) * rate)
+        if tokens[i] < cost then
+            allowed = 0
+            retry_after = math.max(retry_after, (cost - tokens[i]) / rate)
+        end
+    end
+
+    local result = {allowed, math.ceil(retry_after * 1000)}
+    for i = 1, #KEYS do
+        local max_tokens = tonumber(ARGV[3 * i - 1])
+        local rate = tonumber(ARGV[3 * i])
+        if allowed == 1 then
+            -- Consume (all or nothing); the key expires once the bucket would be full again
+            tokens[i] = tokens[i] - tonumber(ARGV[3 * i + 1])
+            redis.call('hset', KEYS[i], 'tokens', tokens[i], 'ts', math.max(now, last_ts[i]))
+            redis.call('expire', KEYS[i], math.ceil(max_tokens / rate) + 1)
+        end
+        result[i + 2] = math.floor(tokens[i])
+    end
+    return result
+    """
+
+    def _bucket(self, name, key, limits, cost):
+        max_tokens, rate_per_min = limits
+        return name, key, max_tokens, rate_per_min / 60.0, cost
+
+    def buckets(self, client_id, limit_type, providers=()):
+        """Bucket specs (name, key, max_tokens, rate_per_sec, cost) for one request."""
+        specs = [self._bucket(limit_type, f"ratelimit:type:{limit_type}", self.default_limits.get(limit_type, self.default_limits["global"]), 1)]
+        if "global" in self.shared_buckets and limit_type != "global":
+            specs.append(self._bucket("global", "ratelimit:global", self.default_limits["global"], 1))
+        if "client" in self.shared_buckets:
+            specs.append(self._bucket("client", f"ratelimit:client:{client_id}", self.default_limits["client"], 1))
+        for p_id in providers:
+            if p_id in self.provider_limits:
+                specs.append(self.provider_bucket(p_id, 0))
+        return specs
+
+    def provider_bucket(self, p_id, cost=1):
+        return self._bucket(p_id, f"ratelimit:provider:{p_id}", self.provider_limits[p_id], cost)
 
-    def check_limit(self, key: str, cost: int = 1, limit_type: str = "global") -> bool:
+    def _args(self, specs):
+        keys = [s[1] for s in specs]
+        args = [time.time()]
+        for _, _, max_tokens, rate, cost in specs:
+            args += [max_tokens, rate, cost]
+        return keys, args
+
+    def queue_check(self, pipe, specs):
         """
-        Consumes tokens from the bucket. Returns True if allowed, False if limited.
+        Queues the multi-bucket check on a pipeline shared with other reads.
+        Returns a parser for the corresponding reply (LimitResult, or an
+        awaitable of it when the script has to be reloaded first).
         """
-        max_tokens, rate_per_min = self.default_limits.get(limit_type, self.default_limits["global"])
-        rate_per_sec = rate_per_min / 60.0
-        
-        bucket_key = f"limiter:{key}:{limit_type}"
-        last_check_key = f"limiter:{key}:{limit_type}:ts"
-        
-        # Redis Lua Script for Atomicity
-        # ARGV[1]: max_tokens
-        # ARGV[2]: rate_per_sec
-        # ARGV[3]: current_timestamp
-        # ARGV[4]: cost
-        lua_script = """
-        local bucket_key = KEYS[1]
-        local ts_key = KEYS[2]
-        local max_tokens = tonumber(ARGV[1])
-        local rate = tonumber(ARGV[2])
-        local now = tonumber(ARGV[3])
-        local cost = tonumber(ARGV[4])
-
-        local current_tokens = tonumber(redis.call('get', bucket_key) or max_tokens)
-        local last_ts = tonumber(redis.call('get', ts_key) or now)
-
-        -- Replenish tokens
-        local delta = math.max(0, now - last_ts)
-        local new_tokens = math.min(max_tokens, current_tokens + (delta * rate))
-
-        if new_tokens >= cost then
-            -- Consume
-            redis.call('set', bucket_key, new_tokens - cost)
-            redis.call('set', ts_key, now)
-            -- Set expiry to avoid stale keys (e.g. 1 hour)
-            redis.call('expire', bucket_key, 3600)
-            redis.call('expire', ts_key, 3600)
-            return 1 -- Allowed
-        else
-            return 0 -- Rejected
-        end
+        keys, args = self._args(specs)
+        pipe.evalsha(self._script.sha, len(keys), *keys, *args)
+        return lambda reply: self._parse(specs, reply)
+
+    def _parse(self, specs, reply):
+        if isinstance(reply, NoScriptError):
+            # Redis riavviato o SCRIPT FLUSH: si ricarica lo script e si ripete
+            return self._retry(specs)
+        if isinstance(reply, Exception):
+            logging.error(f"Rate Limiter Error: {reply}")
+            # Fail open (allow request) if Redis fails
+            return LimitResult()
+        allowed, retry_ms, *remaining = reply
+        return LimitResult(bool(allowed), retry_ms / 1000.0, {s[0]: left for s, left in zip(specs, remaining)})
+
+    async def _retry(self, specs):
+        keys, args = self._args(specs)
+        try:
+            reply = await self._script(keys, args)
+        except Exception as e:
+            reply = e
+        return self._parse(specs, reply)
+
+    async def check(self, specs) -> LimitResult:
+        """Checks and consumes all the buckets in one call."""
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            parse = self.queue_check(pipe, specs)
+            reply = (await pipe.execute(raise_on_error=False))[0]
+        except Exception as e:
+            return self._parse(specs, e)
+        result = parse(reply)
+        if not isinstance(result, LimitResult):
+            result = await result
+        return result
+
+    async def check_limit(self, key: str, cost: int = 1, limit_type: str = "global") -> bool:
         """
-        
+        Consumes tokens from a single bucket. Returns True if allowed, False if limited.
+        """
+        limits = self.default_limits.get(limit_type, self.default_limits["global"])
+        result = await self.check([self._bucket(limit_type, f"ratelimit:{key}:{limit_type}", limits, cost)])
+        return result.allowed
+
+
+class TokenBucket:
+    """In-process token bucket (fallback when Redis is unreachable)."""
+    def __init__(self, max_tokens, rate_per_sec):
+        self.max_tokens = max_tokens
+        self.rate = rate_per_sec
+        self.tokens = max_tokens
+        self.ts = time.monotonic()
+
+    def peek(self, now):
+        self.tokens = min(self.max_tokens, self.tokens + max(0.0, now - self.ts) * self.rate)
+        self.ts = now
+        return self.tokens
+
+
+class Lease:
+    __slots__ = ("tokens", "expires_at", "remaining", "retry_at")
+
+    def __init__(self):
+        self.tokens = 0.0       # Token concessi da Redis e non ancora usati
+        self.expires_at = 0.0
+        self.remaining = 0      # Token rimasti nel bucket Redis all'ultimo lease
+        self.retry_at = 0.0     # Bucket Redis vuoto: niente nuovi lease prima di questo istante
+
+
+class LeasedLimiter:
+    """
+    Two-level limiter: each process leases blocks of tokens from the Redis
+    buckets (one EVALSHA for all the buckets that need it) and admits
+    requests from the local lease. Leases are topped up in the background
+    below half a block and expire after lease_ttl; leftovers go back to
+    Redis on the next lease. Block size is what a bucket refills in one
+    lease_ttl, so idle processes hoard at most that much.
+
+    Leased tokens leave Redis before they are used, so the global limits
+    hold exactly while Redis is up (outstanding leases included). When
+    Redis is down, each process falls back to a local bucket scaled by
+    local_share (e.g. 1/workers): over a window the admissions stay within
+    limit + workers * local_share * limit (see test_rate_limiter.py).
+    """
+    LEASE_SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local result = {}
+    for i = 1, #KEYS do
+        local max_tokens = tonumber(ARGV[4 * i - 2])
+        local rate = tonumber(ARGV[4 * i - 1])
+        local want = tonumber(ARGV[4 * i])
+        local give_back = tonumber(ARGV[4 * i + 1])
+        local state = redis.call('hmget', KEYS[i], 'tokens', 'ts')
+        local current = tonumber(state[1]) or max_tokens
+        local last_ts = tonumber(state[2]) or now
+
+        local tokens = math.min(max_tokens, current + math.max(0, now - last_ts) * rate + give_back)
+        local grant = math.max(0, math.min(want, math.floor(tokens)))
+        tokens = tokens - grant
+        redis.call('hset', KEYS[i], 'tokens', tokens, 'ts', math.max(now, last_ts))
+        redis.call('expire', KEYS[i], math.ceil(max_tokens / rate) + 1)
+
+        result[3 * i - 2] = grant
+        result[3 * i - 1] = math.floor(tokens)
+        result[3 * i] = math.ceil(math.max(0, 1 - tokens) / rate * 1000)
+    end
+    return result
+    """
+
+    def __init__(self, limiter, lease_ttl=2.0, max_block=50, local_share=0.25, retry_redis=1.0, lease_timeout=0.25):
+        self.limiter = limiter
+        self.lease_timeout = lease_timeout
+        self.lease_ttl = lease_ttl
+        self.max_block = max_block
+        self.local_share = local_share
+        self.retry_redis = retry_redis
+        self.leases = {}       # key -> Lease
+        self.fallback = {}     # key -> TokenBucket
+        self.degraded = False  # Redis irraggiungibile: si usano i bucket locali
+        self.probe_at = 0.0    # Prossimo tentativo di lease verso Redis (in background)
+        self._pending = {}     # key -> Task del lease in corso
+        self._script = limiter.redis.register_script(self.LEASE_SCRIPT)
+
+    # Delegati verso il limiter Redis (stessa interfaccia)
+    def buckets(self, client_id, limit_type, providers=()):
+        return self.limiter.buckets(client_id, limit_type, providers)
+
+    def _block(self, spec):
+        # Quanto il bucket ricarica in un lease_ttl, o il 5% del burst se maggiore
+        _, _, max_tokens, rate, cost = spec
+        return max(1, cost, min(self.max_block, math.ceil(max(rate * self.lease_ttl, max_tokens * 0.05))))
+
+    def _fresh(self, spec, now):
+        lease = self.leases.get(spec[1])
+        if lease is None or now >= lease.expires_at:
+            return False
+        return lease.tokens >= max(1, spec[4]) or now < lease.retry_at
+
+    async def _lease(self, specs):
+        now = time.monotonic()
+        keys, args, returned = [], [time.time()], set()
+        for spec in specs:
+            lease = self.leases.setdefault(spec[1], Lease())
+            give_back = 0
+            if now >= lease.expires_at and lease.tokens > 0:
+                give_back = lease.tokens
+                returned.add(spec[1])
+            keys.append(spec[1])
+            args += [spec[2], spec[3], self._block(spec), give_back]
         try:
-            result = self.redis.eval(lua_script, 2, bucket_key, last_check_key, 
-                                   max_tokens, rate_per_sec, time.time(), cost)
-            return bool(result)
+            reply = await self._script(keys, args)
         except Exception as e:
-            logging.error(f"Rate Limiter Error: {e}")
-            # Fail open (allow request) if Redis fails
-            return True
+            self._degrade(e)
+            return
+        if self.degraded:
+            print("✅ Rate limiter: Redis di nuovo raggiungibile.")
+            self.degraded = False
+        now = time.monotonic()
+        for i, spec in enumerate(specs):
+            grant, left, retry_ms = reply[3 * i:3 * i + 3]
+            lease = self.leases.setdefault(spec[1], Lease())
+            if spec[1] in returned:
+                lease.tokens = 0.0  # Già restituiti con give_back
+            lease.tokens += grant
+            lease.expires_at = now + self.lease_ttl
+            lease.remaining = left
+            lease.retry_at = now + retry_ms / 1000.0 if lease.tokens < max(1, spec[4]) else 0.0
+
+    def _degrade(self, reason):
+        if not self.degraded:
+            logging.error(f"Rate Limiter Error (passo ai bucket locali): {reason}")
+        self.degraded = True
+        self.probe_at = time.monotonic() + self.retry_redis
+
+    def _start_lease(self, specs):
+        specs = [s for s in specs if s[1] not in self._pending]
+        if not specs:
+            return
+        task = asyncio.get_running_loop().create_task(self._lease(specs))
+        for spec in specs:
+            self._pending[spec[1]] = task
+        task.add_done_callback(lambda t: [self._pending.pop(s[1], None) for s in specs if self._pending.get(s[1]) is t])
+
+    def _admit_local(self, specs, now):
+        buckets = []
+        for spec in specs:
+            b = self.fallback.get(spec[1])
+            if b is None:
+                b = self.fallback[spec[1]] = TokenBucket(spec[2] * self.local_share, spec[3] * self.local_share)
+            buckets.append((spec, b, b.peek(now)))
+        short = [(spec, b, t) for spec, b, t in buckets if t < spec[4]]
+        if short:
+            return LimitResult(False, max((spec[4] - t) / b.rate for spec, b, t in short),
+                               {spec[0]: math.floor(t) for spec, b, t in buckets})
+        for spec, b, _ in buckets:
+            b.tokens -= spec[4]
+        return LimitResult(True, 0.0, {spec[0]: math.floor(b.tokens) for spec, b, _ in buckets})
+
+    async def acquire(self, specs) -> LimitResult:
+        """Checks and consumes all the buckets; Redis is only contacted when a lease runs out."""
+        now = time.monotonic()
+        if self.degraded:
+            if now >= self.probe_at:
+                self._start_lease(specs)
+            return self._admit_local(specs, now)
+        for _ in range(3):  # Con molte richieste concorrenti un solo blocco può non bastare
+            stale = [s for s in specs if not self._fresh(s, now)]
+            if not stale:
+                break
+            self._start_lease(stale)
+            tasks = {self._pending[s[1]] for s in stale if s[1] in self._pending}
+            if tasks:
+                _, waiting = await asyncio.wait(tasks, timeout=self.lease_timeout)
+                if waiting:
+                    # Redis lento: il lease prosegue in background, intanto si usano i bucket locali
+                    self._degrade(f"lease oltre {self.lease_timeout}s")
+            now = time.monotonic()
+            if self.degraded:
+                return self._admit_local(specs, now)
+
+        leases = [(spec, self.leases.setdefault(spec[1], Lease())) for spec in specs]
+        short = [(spec, lease) for spec, lease in leases if lease.tokens < spec[4]]
+        if short:
+            retry = max(max(lease.retry_at - now, 0.0) or 1.0 / spec[3] for spec, lease in short)
+            return LimitResult(False, retry, self._remaining(leases))
+        for spec, lease in leases:
+            lease.tokens -= spec[4]
+        low = [spec for spec, lease in leases if lease.tokens < self._block(spec) / 2 and now >= lease.retry_at]
+        if low:
+            self._start_lease(low)  # Rabbocco in background
+        if len(self.leases) > 10000:
+            self.leases = {k: v for k, v in self.leases.items() if v.expires_at > now}
+        return LimitResult(True, 0.0, self._remaining(leases))
+
+    @staticmethod
+    def _remaining(leases):
+        return {spec[0]: max(0, math.floor(lease.remaining + lease.tokens)) for spec, lease in leases}
+
+    def spend(self, p_id):
+        """Consumes one provider token once the provider has actually been called."""
+        if p_id not in self.limiter.provider_limits:
+            return
+        spec = self.limiter.provider_bucket(p_id)
+        now = time.monotonic()
+        if self.degraded:
+            self._admit_local([spec], now)
+            return
+        lease = self.leases.setdefault(spec[1], Lease())
+        lease.tokens -= 1  # Può andare in debito: lo ripaga il prossimo lease
+        if lease.tokens < self._block(spec) / 2 and now >= lease.retry_at:
+            self._start_lease([spec])
+
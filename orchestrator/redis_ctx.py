@@ -0,0 +1,99 @@
+import asyncio
+import inspect
+import logging
+
+
+class RedisFlusher:
+    """
+    Batches fire-and-forget Redis writes (stats, cooldowns, cache fills) into
+    one pipeline per interval, so they never add a round-trip to a request.
+    An op is a callable receiving the pipeline; it may be a coroutine function.
+    """
+    def __init__(self, redis_client, interval=0.05, max_batch=500):
+        self.redis = redis_client
+        self.interval = interval
+        self.max_batch = max_batch
+        self.ops = []
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def add(self, op):
+        self.ops.append(op)
+        if len(self.ops) >= self.max_batch:
+            self._wake.set()
+
+    async def flush(self):
+        ops, self.ops = self.ops, []
+        if not ops:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for op in ops:
+                res = op(pipe)
+                if inspect.isawaitable(res):
+                    await res
+            await pipe.execute(raise_on_error=False)
+        except Exception as e:
+            logging.error(f"Redis Flusher Error ({len(ops)} ops persi): {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+class RequestContext:
+    """Redis state a request needs, fetched in a single round-trip."""
+    def __init__(self, gpu_on=False, cooldowns=(), values=None):
+        self.gpu_on = gpu_on
+        self.cooldowns = set(cooldowns)
+        self.values = values or {}  # Chiavi extra richieste dal chiamante (es. affinità di sessione)
+        self.limit = None  # LimitResult, impostato dal chiamante
+        self.session = None
+        self.providers = {}  # Snapshot dei provider letto all'arrivo della richiesta
+
+
+async def fetch_request_context(redis_client, provider_ids, extra_keys=()):
+    """
+    One pipeline: gpu_status, every cooldown flag and any extra keys. If
+    Redis is down the request proceeds with the GPU considered busy and no cooldowns.
+    """
+    provider_ids, extra_keys = list(provider_ids), list(extra_keys)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.get("gpu_status")
+    for p_id in provider_ids:
+        pipe.exists(f"cooldown:{p_id}")
+    for key in extra_keys:
+        pipe.get(key)
+    try:
+        res = await pipe.execute(raise_on_error=False)
+    except Exception as e:
+        logging.error(f"Request Context Redis Error: {e}")
+        return RequestContext()
+
+    gpu = res[0] if not isinstance(res[0], Exception) else None
+    flags = res[1:1 + len(provider_ids)]
+    extra = res[1 + len(provider_ids):]
+    return RequestContext(
+        gpu_on=(gpu == "VERDE"),
+        cooldowns=[p for p, f in zip(provider_ids, flags) if f and not isinstance(f, Exception)],
+        values={k: v for k, v in zip(extra_keys, extra) if v is not None and not isinstance(v, Exception)},
+    )
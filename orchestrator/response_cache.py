@@ -0,0 +1,120 @@
+import json
+import uuid
+import hashlib
+from prometheus_client import Counter
+from .cache import TwoTierCache
+from .upstream import Upstream
+from .sse import loads
+
+response_cache_hits = Counter('neural_home_response_cache_hits_total', 'Responses served from cache', ['provider'])
+
+# Parametri che cambiano la risposta (oltre a messages e model)
+KEY_PARAMS = ("model", "temperature", "top_p", "max_tokens", "stop", "tools", "tool_choice", "response_format", "seed")
+CACHEABLE_FINISH = ("stop", "length")
+
+
+def cache_policy(body, headers):
+    """
+    Returns (lookup, store). Only deterministic requests (temperature=0) are
+    cacheable, and never tool-calling ones (the answer is an action, not
+    text); clients opt out with Cache-Control: no-cache (skip lookup) or
+    no-store (skip both).
+    """
+    if body.get("temperature") != 0 or body.get("n", 1) != 1:
+        return False, False
+    if body.get("tools") or body.get("functions"):
+        return False, False
+    cc = headers.get("cache-control", "").lower()
+    if "no-store" in cc:
+        return False, False
+    return "no-cache" not in cc, True
+
+
+def cacheable(body):
+    """Only plain text answers that ended normally can be replayed (no tool calls, no content filter)."""
+    try:
+        choice = body["choices"][0]
+    except (KeyError, IndexError, TypeError):
+        return False
+    message = choice.get("message") or {}
+    return choice.get("finish_reason") in CACHEABLE_FINISH and not message.get("tool_calls") and not message.get("function_call")
+
+
+def response_key(body, messages):
+    """Canonical hash of the request, computed on the messages actually sent upstream."""
+    canonical = {k: body.get(k) for k in KEY_PARAMS}
+    canonical["messages"] = messages
+    raw = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Exact-match cache of completions. Entries are {"provider", "body"} with body
+    in chat.completion format; streamed answers are assembled before storing
+    and replayed as SSE chunks to streaming clients.
+    """
+    def __init__(self, redis_client, flusher, ttl=3600, max_items=512):
+        self.store = TwoTierCache(redis_client, flusher, "response", ttl=ttl, max_items=max_items)
+
+    async def get(self, key):
+        entry = await self.store.get(key)
+        if entry and not cacheable(entry.get("body")):
+            return None  # Voce scritta prima del filtro (es. tool call): meglio un miss che una risposta vuota
+        if entry:
+            response_cache_hits.labels(entry["provider"]).inc()
+        return entry
+
+    def set(self, key, p_id, body):
+        if cacheable(body):
+            self.store.set(key, {"provider": p_id, "body": body})
+
+    def to_upstream(self, entry, is_stream, req_model):
+        if is_stream:
+            return Upstream(entry["provider"], chunks=self.replay(entry, req_model))
+        return Upstream(entry["provider"], body={**entry["body"], "model": req_model})
+
+    @staticmethod
+    def replay(entry, req_model):
+        """SSE replay of a cached completion (text answers only, see cacheable)."""
+        choice = entry["body"]["choices"][0]
+        content = choice["message"].get("content") or ""
+        finish = choice.get("finish_reason") or "stop"
+        cid = f"chatcmpl-{uuid.uuid4().hex}"
+        def frame(delta, finish):
+            return f"data: {json.dumps({'id': cid, 'object': 'chat.completion.chunk', 'model': req_model, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}]})}\n\n"
+        async def generate():
+            yield frame({"role": "assistant", "content": content}, None)
+            yield frame({}, finish)
+            yield "data: [DONE]\n\n"
+        return generate()
+
+    @staticmethod
+    def record(chunks, req_model, on_complete):
+        """
+        Passes the stream through and hands the assembled answer to
+        on_complete(body) once it completes. Streams with tool calls or an
+        abnormal finish_reason are not stored.
+        """
+        async def generate():
+            parts, finish, done, tools = [], None, False, False
+            async for chunk in chunks:
+                yield chunk
+                for line in chunk.splitlines():
+                    if not line.startswith("data: "):
+                        continue
+                    if line == "data: [DONE]":
+                        done = True
+                        continue
+                    try:
+                        choice = loads(line[6:])["choices"][0]
+                    except (ValueError, KeyError, IndexError):
+                        continue
+                    delta = choice.get("delta") or {}
+                    tools = tools or bool(delta.get("tool_calls") or delta.get("function_call"))
+                    parts.append(delta.get("content") or "")
+                    finish = choice.get("finish_reason") or finish
+            if done and not tools and finish in CACHEABLE_FINISH:
+                on_complete({"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "model": req_model,
+                                     "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(parts)}, "finish_reason": finish}]})
+        return generate()
@@ -0,0 +1,264 @@
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+from collections import deque, defaultdict
+
+# Pesi per categoria (Blueprint Sec 4.2: 50% quota, 30% latenza, 20% qualità)
+DEFAULT_WEIGHTS = {
+    "CODING": {"quota": 0.3, "latency": 0.2, "quality": 0.5},
+    "SIMPLE": {"quota": 0.5, "latency": 0.3, "quality": 0.2},
+}
+LATENCY_CEILING_MS = 5000  # Oltre questa p95 il provider viene scartato
+STATS_WINDOW = 100
+EWMA_ALPHA = 0.2
+
+# KEYS[1]=stats hash, KEYS[2]=latency list, KEYS[3]=quota hash
+# ARGV: latency_ms (vuoto se errore), ok(1/0), alpha, window, now, quota_expire_at
+RECORD_LUA = """
+local alpha = tonumber(ARGV[3])
+local ok = tonumber(ARGV[2])
+local err = tonumber(redis.call('hget', KEYS[1], 'error_rate') or '0')
+redis.call('hset', KEYS[1], 'error_rate', (1 - alpha) * err + alpha * (1 - ok), 'updated_at', ARGV[5])
+redis.call('hincrby', KEYS[1], 'requests', 1)
+if ARGV[1] ~= '' then
+    local ms = tonumber(ARGV[1])
+    local ewma = tonumber(redis.call('hget', KEYS[1], 'ewma_ms') or ms)
+    redis.call('hset', KEYS[1], 'ewma_ms', (1 - alpha) * ewma + alpha * ms)
+    redis.call('lpush', KEYS[2], ms)
+    redis.call('ltrim', KEYS[2], 0, tonumber(ARGV[4]) - 1)
+end
+redis.call('hincrby', KEYS[3], 'requests_made', 1)
+redis.call('hset', KEYS[3], 'last_request_timestamp', ARGV[5])
+redis.call('expireat', KEYS[3], ARGV[6])
+return 1
+"""
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def quota_key(p_id, now=None):
+    """HASH api_quota:{provider}:{date} (Blueprint Sec 4.2), reset at midnight UTC."""
+    day = datetime.fromtimestamp(now or time.time(), timezone.utc)
+    midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc) + timedelta(days=1)
+    return f"api_quota:{p_id}:{day.strftime('%Y-%m-%d')}", int(midnight.timestamp())
+
+
+class ProviderStats:
+    """
+    Rolling per-provider statistics shared through Redis: latency EWMA,
+    last-N latency ring buffer (p50/p95), error-rate EWMA and daily quota usage.
+    Updates go through the flusher; reads come from a snapshot that a
+    background task refreshes, so routing never waits on Redis.
+    """
+    def __init__(self, redis_client, flusher, window=STATS_WINDOW, alpha=EWMA_ALPHA):
+        self.redis = redis_client
+        self.flusher = flusher
+        self.window = window
+        self.alpha = alpha
+        self._record = redis_client.register_script(RECORD_LUA)
+        self._data = {}
+
+    def record(self, p_id, latency_s, ok):
+        now = time.time()
+        q_key, expire_at = quota_key(p_id, now)
+        latency_ms = "" if latency_s is None else round(latency_s * 1000, 1)
+        self.flusher.add(lambda pipe: self._record(keys=[f"router:stats:{p_id}", f"router:latency:{p_id}", q_key],
+                                                   args=[latency_ms, 1 if ok else 0, self.alpha, self.window, now, expire_at],
+                                                   client=pipe))
+
+    def snapshot(self, p_ids):
+        return {p: self._data[p] for p in p_ids if p in self._data}
+
+    async def refresh(self, p_ids):
+        p_ids = list(p_ids)
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for p_id in p_ids:
+                pipe.hgetall(f"router:stats:{p_id}")
+                pipe.lrange(f"router:latency:{p_id}", 0, -1)
+                pipe.hget(quota_key(p_id)[0], "requests_made")
+            res = await pipe.execute()
+        except Exception as e:
+            print(f"⚠️ Router stats error: {e}")
+            return
+        self._data = {p_id: stats_entry(res[3 * i], [float(x) for x in res[3 * i + 1]], res[3 * i + 2])
+                      for i, p_id in enumerate(p_ids)}
+
+
+def stats_entry(h, latencies, quota_used):
+    return {
+        "ewma_ms": float(h["ewma_ms"]) if h.get("ewma_ms") else None,
+        "p50_ms": percentile(latencies, 0.5),
+        "p95_ms": percentile(latencies, 0.95),
+        "error_rate": float(h.get("error_rate") or 0),
+        "requests": int(h.get("requests") or 0),
+        "quota_used": int(quota_used or 0),
+    }
+
+
+class LocalStats:
+    """In-memory ProviderStats with the same interface, used by the simulator."""
+    def __init__(self, window=STATS_WINDOW, alpha=EWMA_ALPHA):
+        self.alpha = alpha
+        self.h = defaultdict(dict)
+        self.lat = defaultdict(lambda: deque(maxlen=window))
+        self.used = defaultdict(int)
+
+    def record(self, p_id, latency_s, ok):
+        h = self.h[p_id]
+        h["error_rate"] = (1 - self.alpha) * float(h.get("error_rate", 0)) + self.alpha * (0 if ok else 1)
+        h["requests"] = int(h.get("requests", 0)) + 1
+        self.used[p_id] += 1
+        if latency_s is not None:
+            ms = latency_s * 1000
+            h["ewma_ms"] = (1 - self.alpha) * float(h.get("ewma_ms", ms)) + self.alpha * ms
+            self.lat[p_id].appendleft(ms)
+
+    def snapshot(self, p_ids):
+        return {p: stats_entry(self.h[p], list(self.lat[p]), self.used[p]) for p in p_ids}
+
+
+class AdaptiveRouter:
+    """
+    Score-based routing (Blueprint Sec 4.2):
+      score = quota_ratio * w_quota + min(1, 1000 / latency_ms) * w_latency + quality / 10 * w_quality
+    scaled by (1 - error_rate). Providers whose p95 exceeds the latency ceiling
+    or whose daily quota is exhausted are filtered out.
+    """
+    def __init__(self, stats, weights=None, latency_ceiling_ms=LATENCY_CEILING_MS):
+        self.stats = stats
+        self.weights = weights or DEFAULT_WEIGHTS
+        self.latency_ceiling_ms = latency_ceiling_ms
+
+    def score(self, p, s, category):
+        w = self.weights.get(category, self.weights.get("SIMPLE", DEFAULT_WEIGHTS["SIMPLE"]))
+        if s.get("p95_ms") and s["p95_ms"] > self.latency_ceiling_ms:
+            return None
+        quota = p.get("daily_quota")
+        quota_ratio = max(0.0, 1 - s.get("quota_used", 0) / quota) if quota else 1.0
+        if quota and quota_ratio <= 0:
+            return None
+        latency = s.get("ewma_ms")
+        latency_score = min(1.0, 1000.0 / latency) if latency else 0.5
+        score = quota_ratio * w["quota"] + latency_score * w["latency"] + p.get("quality", 5) / 10 * w["quality"]
+        return score * (1 - s.get("error_rate", 0))
+
+    def rank(self, category, sane_list, providers):
+        """Sane providers ordered by score (filtered ones excluded)."""
+        snap = self.stats.snapshot([p for p in sane_list if p in providers])
+        scored = []
+        for p_id in sane_list:
+            if p_id not in providers:
+                continue
+            sc = self.score(providers[p_id], snap.get(p_id, {}), category)
+            if sc is not None:
+                scored.append((sc, p_id))
+        return [p_id for _, p_id in sorted(scored, key=lambda x: -x[0])]
+
+    def report(self, providers, categories=("CODING", "SIMPLE")):
+        snap = self.stats.snapshot(list(providers))
+        return {p_id: {**snap.get(p_id, {}), "scores": {c: self.score(p, snap.get(p_id, {}), c) for c in categories}}
+                for p_id, p in providers.items()}
+
+
+def static_route(category, gpu_ready, sane_list):
+    # Priorità CODING
+    if category == "CODING":
+        if gpu_ready and "ollama" in sane_list: return "ollama"
+        if "qwen_cloud" in sane_list: return "qwen_cloud"
+        return sane_list[0]
+
+    # Priorità SIMPLE (Speed & Free Tier)
+    if "groq" in sane_list: return "groq"
+    if "gemini-flash" in sane_list: return "gemini-flash"
+
+    return sane_list[0]
+
+
+# --- SIMULAZIONE ---
+def load_samples(redis_client, p_ids):
+    """Recorded latencies (ms) and error rates from Redis, per provider."""
+    samples = {}
+    for p_id in p_ids:
+        lat = [float(x) for x in redis_client.lrange(f"router:latency:{p_id}", 0, -1)]
+        err = float(redis_client.hget(f"router:stats:{p_id}", "error_rate") or 0)
+        if lat:
+            samples[p_id] = {"latencies_ms": lat, "error_rate": err}
+    return samples
+
+
+def simulate(providers, samples, policy, requests=2000, coding_share=0.5, gpu_ready=True, weights=None, seed=1):
+    """
+    Replays recorded latencies: each simulated request is routed by the policy,
+    and the chosen provider answers with a latency drawn from its samples.
+    """
+    rng = random.Random(seed)
+    sane = [p for p in providers if p in samples and (gpu_ready or p != "ollama")]
+    stats = LocalStats()
+    router = AdaptiveRouter(stats, weights)
+    latencies, load, errors = [], defaultdict(int), 0
+    for _ in range(requests):
+        cat = "CODING" if rng.random() < coding_share else "SIMPLE"
+        if policy == "adaptive":
+            ranked = router.rank(cat, sane, providers)
+            target = ranked[0] if ranked else static_route(cat, gpu_ready, sane)
+        else:
+            target = static_route(cat, gpu_ready, sane)
+        s = samples[target]
+        load[target] += 1
+        if rng.random() < s["error_rate"]:
+            errors += 1
+            stats.record(target, None, False)
+            continue
+        ms = rng.choice(s["latencies_ms"])
+        latencies.append(ms)
+        stats.record(target, ms / 1000, True)
+    return {"policy": policy, "requests": requests, "errors": errors,
+            "mean_ms": round(sum(latencies) / max(1, len(latencies)), 1),
+            "p50_ms": round(percentile(latencies, 0.5) or 0, 1), "p95_ms": round(percentile(latencies, 0.95) or 0, 1), "load": dict(load)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded provider latencies to compare routing policies.")
+    parser.add_argument("command", choices=["simulate", "export"])
+    parser.add_argument("--samples", help="JSON {provider: {latencies_ms: [...], error_rate: x}}; default: read from Redis")
+    parser.add_argument("--state", default=None, help="state.json with api_providers (default: infrastructure/state.json)")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--coding-share", type=float, default=0.5)
+    parser.add_argument("--gpu-off", action="store_true")
+    parser.add_argument("--redis-host", default="localhost")
+    args = parser.parse_args(argv)
+
+    from pathlib import Path
+    state_file = args.state or Path(__file__).resolve().parents[1] / "infrastructure" / "state.json"
+    with open(state_file, 'r') as f:
+        providers = json.load(f)["api_providers"]
+
+    if args.samples:
+        with open(args.samples, 'r') as f:
+            samples = json.load(f)
+    else:
+        import redis
+        samples = load_samples(redis.Redis(host=args.redis_host, port=6379, db=0, decode_responses=True), providers)
+
+    if args.command == "export":
+        print(json.dumps(samples, indent=2))
+        return 0
+    if not samples:
+        print("❌ Nessuna latenza registrata: usa --samples o lascia girare l'orchestratore.")
+        return 1
+    for policy in ("static", "adaptive"):
+        print(json.dumps(simulate(providers, samples, policy, args.requests, args.coding_share, not args.gpu_off)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
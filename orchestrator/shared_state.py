@@ -0,0 +1,137 @@
+import os
+import socket
+import asyncio
+import hashlib
+import logging
+from collections import namedtuple
+from prometheus_client import Counter
+
+# Chiavi per deployment (vedi deployment_namespace)
+CHANNEL = "orchestrator:{ns}:events"
+ROUTING_KEY = "orchestrator:{ns}:routing"      # hash: mode, target
+PROVIDERS_KEY = "orchestrator:{ns}:providers"  # hash: checksum, mtime (solo un avviso: ogni worker rilegge il proprio file)
+ROUTING_MODES = ("AUTO", "MANUAL")
+
+shared_events = Counter('neural_home_shared_state_total', 'Cross-worker state updates', ['kind', 'outcome'])
+
+
+class Routing(namedtuple("Routing", "mode target")):
+    __slots__ = ()
+
+
+def deployment_namespace(state_file, name=None):
+    """
+    Explicit name (ORCHESTRATOR_DEPLOYMENT, to share one namespace across
+    hosts) or host + state file path, so a dev instance or a benchmark on
+    the same Redis never touches production's routing.
+    """
+    if name:
+        return name
+    return hashlib.sha256(f"{socket.gethostname()}:{os.path.abspath(state_file)}".encode("utf-8")).hexdigest()[:12]
+
+
+class SharedState:
+    """
+    State every worker of one deployment must agree on, kept in Redis
+    under its namespace: the routing mode and manual target, and the
+    checksum/mtime of the last state.json a worker loaded. Requests read
+    the local copy only; a pub/sub listener refreshes it when any worker
+    publishes a change, and a periodic refresh covers missed messages
+    (Redis restarts, dropped subscriptions).
+
+    Provider maps never travel through Redis: async on_providers(checksum,
+    mtime) only hints that a newer file exists, and the worker re-reads
+    and validates its own copy (StateWatcher.hint).
+    """
+    def __init__(self, redis_client, flusher, namespace, on_providers=None, refresh_interval=5.0):
+        self.redis = redis_client
+        self.flusher = flusher
+        self.namespace = namespace
+        self.channel = CHANNEL.format(ns=namespace)
+        self.routing_key = ROUTING_KEY.format(ns=namespace)
+        self.providers_key = PROVIDERS_KEY.format(ns=namespace)
+        self.on_providers = on_providers
+        self.refresh_interval = refresh_interval
+        self.routing = Routing("AUTO", None)
+        self._task = None
+
+    async def set_routing(self, mode, target=None):
+        """Writes the routing mode for all workers. Raises on Redis errors: the change must not stay local."""
+        routing = Routing(mode, target if mode == "MANUAL" else None)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(self.routing_key, mapping={"mode": routing.mode, "target": routing.target or ""})
+        pipe.publish(self.channel, "routing")
+        await pipe.execute()
+        self.routing = routing
+        shared_events.labels("routing", "published").inc()
+        return routing
+
+    def publish_providers(self, snapshot):
+        """Announces a snapshot loaded from disk (fire-and-forget, through the flusher)."""
+        payload = {"checksum": snapshot.checksum, "mtime": repr(snapshot.mtime)}
+        def op(pipe):
+            pipe.hset(self.providers_key, mapping=payload)
+            pipe.publish(self.channel, "providers")
+        self.flusher.add(op)
+        shared_events.labels("providers", "published").inc()
+
+    async def refresh(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self.routing_key)
+        pipe.hgetall(self.providers_key)
+        try:
+            routing, providers = await pipe.execute()
+        except Exception as e:
+            logging.error(f"Shared State Redis Error: {e}")
+            return
+
+        mode = routing.get("mode")
+        if mode in ROUTING_MODES:
+            current = Routing(mode, routing.get("target") or None)
+            if current != self.routing:
+                print(f"🔀 [SHARED] Routing: {current.mode}{' -> ' + current.target if current.target else ''}")
+                self.routing = current
+                shared_events.labels("routing", "applied").inc()
+
+        if providers.get("checksum") and self.on_providers:
+            try:
+                mtime = float(providers.get("mtime") or 0)
+            except ValueError as e:
+                logging.error(f"Shared State: mtime non valido in Redis ({e})")
+                return
+            if await self.on_providers(providers["checksum"], mtime):
+                shared_events.labels("providers", "applied").inc()
+
+    async def _listen(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(self.channel)
+            await self.refresh()  # Quanto è cambiato prima della sottoscrizione
+            while True:
+                await pubsub.get_message(timeout=self.refresh_interval)
+                await self.refresh()  # Su notifica, o ogni refresh_interval se non arriva nulla
+        finally:
+            await pubsub.aclose()
+
+    async def _run(self):
+        while True:
+            try:
+                await self._listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Shared State: sottoscrizione persa ({e}), riprovo.")
+                await asyncio.sleep(min(self.refresh_interval, 5.0))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,129 @@
+import json
+import asyncio
+import hashlib
+from prometheus_client import Counter
+from .upstream import Upstream
+
+coalesced_requests = Counter('neural_home_coalesced_requests_total', 'Requests attached to an identical in-flight request', ['kind'])
+
+
+# Header che cambiano il percorso della richiesta: affinità, priorità GPU, taglio del contesto, cache, client batch
+ROUTING_HEADERS = ("cache-control", "x-session-id", "x-priority", "x-context-trim", "x-client-id", "user-agent")
+
+
+def flight_key(body, headers=None):
+    """Body plus the routing-relevant headers: followers must be routed exactly like the leader."""
+    raw = json.dumps(body, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    h = hashlib.sha256(raw.encode('utf-8'))
+    for name in ROUTING_HEADERS:
+        h.update(f"\n{name}:{(headers or {}).get(name) or ''}".encode('utf-8'))
+    return h.hexdigest()
+
+
+def coalescable(headers):
+    """Cache-Control no-cache / no-store asks for a fresh answer: never attach to another request."""
+    cc = (headers.get("cache-control") or "").lower()
+    return "no-cache" not in cc and "no-store" not in cc
+
+
+class FanOut:
+    """
+    Shared buffer for one upstream stream. A background pump appends chunks;
+    every subscriber replays the already-emitted prefix and then follows live.
+    The pump is cancelled if all subscribers disconnect before the end.
+    """
+    def __init__(self, upstream, on_done):
+        self.upstream = upstream
+        self.buffer = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self._changed = asyncio.Condition()
+        self._on_done = on_done
+        self._task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        try:
+            async for chunk in self.upstream.chunks:
+                self.buffer.append(chunk)
+                async with self._changed:
+                    self._changed.notify_all()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._on_done()
+            await self.upstream.aclose()
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def subscribe(self):
+        self.subscribers += 1
+        i = 0
+        try:
+            while True:
+                while i < len(self.buffer):
+                    yield self.buffer[i]
+                    i += 1
+                if self.done:
+                    if self.error and not isinstance(self.error, asyncio.CancelledError):
+                        raise self.error
+                    return
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self.done or len(self.buffer) > i)
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self._task.cancel()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical requests onto one execution of fn().
+    Non-stream results are shared directly; streams go through a FanOut and
+    stay joinable until the upstream stream ends.
+    """
+    def __init__(self):
+        self.flights = {}  # key -> Future[(p_id, body | FanOut)]
+
+    def _release(self, key, fut):
+        if self.flights.get(key) is fut:
+            del self.flights[key]
+
+    @staticmethod
+    def _view(shared):
+        p_id, payload = shared
+        if isinstance(payload, FanOut):
+            return Upstream(p_id, chunks=payload.subscribe())
+        return Upstream(p_id, body=payload)
+
+    async def do(self, key, fn):
+        fut = self.flights.get(key)
+        if fut is not None:
+            shared = await asyncio.shield(fut)
+            if shared is not None:
+                coalesced_requests.labels("stream" if isinstance(shared[1], FanOut) else "body").inc()
+                return self._view(shared)
+            # Il leader è stato cancellato: si procede in autonomia
+
+        fut = asyncio.get_running_loop().create_future()
+        self.flights[key] = fut
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            self._release(key, fut)
+            fut.set_result(None)
+            raise
+        except Exception as e:
+            self._release(key, fut)
+            fut.set_exception(e)
+            fut.exception()  # Segna l'eccezione come letta se non ci sono follower
+            raise
+
+        if result.is_stream:
+            shared = (result.p_id, FanOut(result, lambda: self._release(key, fut)))
+        else:
+            self._release(key, fut)
+            shared = (result.p_id, result.body)
+        fut.set_result(shared)
+        return self._view(shared)
@@ -0,0 +1,33 @@
+from collections import Counter, deque
+from prometheus_client import Counter as PromCounter
+
+speculative_events = PromCounter('neural_home_speculative_total', 'Speculative dispatch outcomes (hit/miss/error/cache)', ['outcome'])
+speculative_wasted = PromCounter('neural_home_speculative_wasted_total', 'Upstream calls started speculatively and then discarded', ['provider'])
+
+CODING_KEYWORDS = ('code', 'python', 'function', 'class', 'bug', 'error', 'fix', 'def ', 'import ',
+                   'traceback', 'exception', 'refactor', 'test', 'script', 'funzione', 'errore', 'codice')
+
+
+class VerdictPredictor:
+    """
+    Guesses the judge verdict before the judge answers, so the upstream call
+    to the most probable target can start concurrently.
+    Uses the local classifier when trained, otherwise the keyword heuristic
+    (as in Strategy.classify_intent) plus the most frequent recent language.
+    """
+    def __init__(self, classifier=None, history=50):
+        self.classifier = classifier
+        self.recent_langs = deque(maxlen=history)
+
+    def observe(self, verdict):
+        self.recent_langs.append(verdict.get("lang", "Italian"))
+
+    def predict(self, query):
+        if self.classifier:
+            verdict, _ = self.classifier.classify(query)
+            if verdict:
+                return verdict
+        lower_query = query.lower()
+        cat = "CODING" if any(k in lower_query for k in CODING_KEYWORDS) else "SIMPLE"
+        lang = Counter(self.recent_langs).most_common(1)[0][0] if self.recent_langs else "Italian"
+        return {"cat": cat, "lang": lang}
@@ -0,0 +1,212 @@
+import re
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+    loads = orjson.loads
+    ENCODER = "orjson"
+except ImportError:  # Fallback: encoder standard, più lento
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+    loads = json.loads
+    ENCODER = "json"
+
+DONE = "data: [DONE]\n\n"
+MODEL_RE = re.compile(r'"model"\s*:\s*"(?:[^"\\]|\\.)*"')
+ID_RE = re.compile(r'"id"\s*:\s*"(?:[^"\\]|\\.)*"')
+
+
+def completion_id():
+    return f"chatcmpl-{uuid.uuid4().hex}"
+
+
+async def passthrough(lines, req_model):
+    """
+    Forwards upstream SSE `data:` lines as frames, rewriting only the model
+    name in place (no parse / re-encode). [DONE] is forwarded only if the
+    upstream sent it: a stream ending without it was cut off, and callers
+    (StreamFailover, the response cache) must be able to tell.
+    """
+    field = '"model":' + dumps(req_model)
+    repl = lambda m: field
+    async for line in lines:
+        if not line.startswith("data:"):
+            continue  # Righe vuote, commenti keep-alive
+        if line[5:].strip() == "[DONE]":
+            yield DONE
+            continue
+        yield MODEL_RE.sub(repl, line, 1) + "\n\n"
+
+
+def restamp(frame, cid):
+    """Same frame under another completion id (stitching a second provider into one stream)."""
+    return ID_RE.sub(lambda m: '"id":' + dumps(cid), frame, 1)
+
+
+class ChunkFramer:
+    """Builds chat.completion.chunk frames for providers without an OpenAI stream (one id per stream)."""
+    def __init__(self, req_model):
+        self.prefix = '{"id":' + dumps(completion_id()) + ',"object":"chat.completion.chunk","created":' + str(int(time.time())) + ',"model":' + dumps(req_model) + ',"choices":'
+
+    def frame(self, delta, finish=None):
+        return "data: " + self.prefix + dumps([{"index": 0, "delta": delta, "finish_reason": finish}]) + "}\n\n"
+
+
+def _mergeable(frame):
+    """Parsed chunk if it is a plain content delta, else None."""
+    if not frame.startswith("data: {"):
+        return None
+    try:
+        d = loads(frame[6:])
+        choice, = d["choices"]
+    except (ValueError, KeyError, TypeError):
+        return None
+    delta = choice.get("delta") or {}
+    if choice.get("finish_reason") or any(v for k, v in delta.items() if k not in ("content", "role")):
+        return None
+    return d
+
+
+def _merged(parsed):
+    first = parsed[0]
+    first["choices"][0]["delta"]["content"] = "".join(p["choices"][0]["delta"].get("content") or "" for p in parsed)
+    return "data: " + dumps(first) + "\n\n"
+
+
+async def coalesce(chunks, window_ms=20, max_chars=64):
+    """
+    Merges consecutive small content deltas that arrive within window_ms of
+    the first one (up to max_chars) into a single frame. Anything else
+    (role/tool calls, finish, [DONE]) flushes the pending frames and passes through.
+    """
+    queue = asyncio.Queue()
+    end = object()
+
+    async def pump():
+        try:
+            async for chunk in chunks:
+                await queue.put(chunk)
+            await queue.put(end)
+        except Exception as e:
+            await queue.put(e)
+
+    task = asyncio.get_running_loop().create_task(pump())
+    pending, size = [], 0
+    try:
+        item = await queue.get()
+        while True:
+            if isinstance(item, Exception):
+                raise item
+            if item is end:
+                if pending:
+                    yield _merged(pending)
+                return
+            parsed = _mergeable(item)
+            if parsed is None:
+                if pending:
+                    yield _merged(pending)
+                    pending, size = [], 0
+                yield item
+                item = await queue.get()
+                continue
+            if not pending:
+                flush_at = time.monotonic() + window_ms / 1000.0
+            pending.append(parsed)
+            size += len(parsed["choices"][0]["delta"].get("content") or "")
+            remaining = flush_at - time.monotonic()
+            if size >= max_chars or remaining <= 0:
+                yield _merged(pending)
+                pending, size = [], 0
+                item = await queue.get()
+                continue
+            try:
+                item = await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                yield _merged(pending)
+                pending, size = [], 0
+                item = await queue.get()
+    finally:
+        task.cancel()
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+
+
+# --- MICROBENCHMARK ---
+def _sample_line(i):
+    return ('data: {"id":"chatcmpl-abc123","object":"chat.completion.chunk","created":1700000000,"model":"llama-3.1-8b-instant",'
+            '"system_fingerprint":"fp_123","choices":[{"index":0,"delta":{"content":"tok%d "},"logprobs":null,"finish_reason":null}],'
+            '"x_groq":{"id":"req_01"}}' % i)
+
+
+def bench(n=20000):
+    """Per-chunk CPU cost (µs) of the old SDK round-trip vs the streaming engine."""
+    lines = [_sample_line(i) for i in range(n)]
+    results = {}
+
+    from openai.types.chat import ChatCompletionChunk
+    try:
+        from openai._models import construct_type
+        parse = lambda raw: construct_type(type_=ChatCompletionChunk, value=json.loads(raw))
+    except ImportError:
+        parse = lambda raw: ChatCompletionChunk.model_validate(json.loads(raw))
+
+    t0 = time.perf_counter()
+    for line in lines:
+        d = parse(line[6:]).model_dump(); d["model"] = "qwen-max"
+        f"data: {json.dumps(d)}\n\n"
+    results["sdk_roundtrip_us"] = (time.perf_counter() - t0) / n * 1e6
+
+    async def feed():
+        for line in lines:
+            yield line
+            yield ""
+
+    async def drain(gen):
+        async for _ in gen:
+            pass
+
+    t0 = time.perf_counter()
+    asyncio.run(drain(passthrough(feed(), "qwen-max")))
+    results["passthrough_us"] = (time.perf_counter() - t0) / n * 1e6
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        f"data: {json.dumps({'id': str(uuid.uuid4()), 'object': 'chat.completion.chunk', 'model': 'qwen-max', 'choices': [{'index': 0, 'delta': {'content': 'tok '}, 'finish_reason': None}]})}\n\n"
+    results["google_old_us"] = (time.perf_counter() - t0) / n * 1e6
+
+    framer = ChunkFramer("qwen-max")
+    t0 = time.perf_counter()
+    for i in range(n):
+        framer.frame({"content": "tok "})
+    results["google_framer_us"] = (time.perf_counter() - t0) / n * 1e6
+
+    async def frames():
+        async for f in passthrough(feed(), "qwen-max"):
+            yield f
+    t0 = time.perf_counter()
+    asyncio.run(drain(coalesce(frames(), window_ms=1000, max_chars=64)))
+    results["coalesce_us"] = (time.perf_counter() - t0) / n * 1e6
+
+    results["json_encoder"] = ENCODER
+    return {k: round(v, 2) if isinstance(v, float) else v for k, v in results.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-chunk CPU cost of the SSE streaming engine.")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--chunks", type=int, default=20000)
+    args = parser.parse_args(argv)
+    print(json.dumps(bench(args.chunks)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import struct
+import asyncio
+import hashlib
+import ctypes
+import ctypes.util
+from collections import namedtuple
+from types import MappingProxyType
+from prometheus_client import Counter, Gauge, Histogram
+
+# inotify(7): eventi sulla directory, così si vedono anche i rename atomici dello scanner
+IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x08, 0x40, 0x80, 0x100, 0x200
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+state_reload_seconds = Histogram('neural_home_state_reload_seconds', 'Time to read, validate and swap in state.json (off the request path)',
+                                 buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+state_reload_failures = Counter('neural_home_state_reload_failures_total', 'state.json reloads rejected (the previous snapshot stays live)', ['reason'])
+state_age = Gauge('neural_home_state_age_seconds', 'Age of the live state snapshot (since state.json was written)', multiprocess_mode='livemax')
+
+EMPTY = MappingProxyType({})
+
+
+class StateError(Exception):
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class StateSnapshot(namedtuple("StateSnapshot", "providers checksum mtime loaded_at source")):
+    """
+    Validated, read-only view of state.json. Requests keep the reference
+    they read at arrival; a reload builds a new snapshot and swaps it in.
+    source is "file" (the only origin: other workers just send hints).
+    """
+    __slots__ = ()
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class Inotify:
+    """Minimal inotify binding through libc (no extra dependency). Linux only: raises OSError elsewhere."""
+    def __init__(self, directory, mask=WATCH_MASK):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError) as e:
+            raise OSError(f"inotify non disponibile: {e}")
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 fallita")
+        if add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"inotify_add_watch fallita su {directory}")
+
+    def read_names(self):
+        """Names of the entries touched since the last read (non-blocking)."""
+        names = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        off = 0
+        while off + EVENT_HEADER.size <= len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, off)
+            off += EVENT_HEADER.size
+            names.add(data[off:off + length].rstrip(b"\0").decode("utf-8", "replace"))
+            off += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StateWatcher:
+    """
+    Keeps the live provider snapshot in sync with state.json off the
+    request path. A background task wakes on inotify events (or polls the
+    files' stat when inotify is unavailable), reads and checksums the file
+    in a worker thread and swaps the snapshot in with a single assignment.
+    A mismatched checksum (scanner mid-write) keeps the old snapshot: the
+    scanner's final rename triggers the next reload.
+
+    build(state) -> {id: provider} turns the parsed JSON into the provider
+    map; on_swap(snapshot) runs on every accepted reload.
+    """
+    def __init__(self, state_file, checksum_file, build, on_swap=None, use_inotify=True, poll_interval=2.0, safety_interval=30.0, debounce=0.2):
+        self.state_file = str(state_file)
+        self.checksum_file = str(checksum_file)
+        self.build = build
+        self.on_swap = on_swap
+        self.use_inotify = use_inotify
+        self.poll_interval = poll_interval
+        self.safety_interval = safety_interval  # Controllo stat anche con inotify (eventi persi, mount remoti)
+        self.debounce = debounce
+        self.snapshot = None
+        self._stamp = None
+        self._event = None
+        self._task = None
+        self._inotify = None
+
+    @property
+    def providers(self):
+        return self.snapshot.providers if self.snapshot else EMPTY
+
+    def refresh_metrics(self):
+        """Updates the age gauge (called on scrape: set_function is not available in multiprocess mode)."""
+        state_age.set(time.time() - self.snapshot.mtime if self.snapshot else float("nan"))
+
+    def _files_stamp(self):
+        stamp = []
+        for path in (self.state_file, self.checksum_file):
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def read(self):
+        """Blocking read + validation (Safe Read Protocol, Blueprint Sec 3.2). Raises StateError."""
+        try:
+            with open(self.checksum_file, "r") as f:
+                expected = f.read().strip()
+            with open(self.state_file, "rb") as f:
+                mtime = os.fstat(f.fileno()).st_mtime
+                content = f.read()
+        except OSError as e:
+            raise StateError("io", str(e))
+        real = hashlib.sha256(content).hexdigest()
+        if real != expected:
+            raise StateError("checksum", "checksum di state.json non corrispondente (scrittura in corso?)")
+        try:
+            providers = self.build(json.loads(content))
+        except ValueError as e:
+            raise StateError("parse", str(e))
+        except (KeyError, TypeError, AttributeError) as e:
+            raise StateError("invalid", f"api_providers mancante o malformato ({e!r})")
+        return StateSnapshot(freeze(providers), real, mtime, time.time(), "file")
+
+    def _accept(self, snap):
+        if self.snapshot and snap.checksum == self.snapshot.checksum:
+            return False
+        self.snapshot = snap  # Swap atomico: chi ha letto il riferimento precedente lo tiene fino a fine richiesta
+        if self.on_swap:
+            self.on_swap(snap)
+        print(f"✅ State loaded successfully ({len(snap.providers)} provider, {snap.checksum[:12]}, {snap.source}).")
+        return True
+
+    async def hint(self, checksum, mtime):
+        """
+        Another worker loaded a newer state.json (see SharedState): re-reads
+        the local files if they changed since the last read. Only what
+        validates here goes live; the hint itself is never trusted.
+        Returns True if the hinted checksum is now live.
+        """
+        if self.snapshot and (checksum == self.snapshot.checksum or mtime <= self.snapshot.mtime):
+            return False
+        if self._files_stamp() != self._stamp:
+            await self.reload()
+        return bool(self.snapshot) and self.snapshot.checksum == checksum
+
+    def _failed(self, e):
+        state_reload_failures.labels(e.reason).inc()
+        keep = "snapshot precedente mantenuto" if self.snapshot else "nessun provider caricato"
+        print(f"❌ Error loading state [{e.reason}]: {e} ({keep})")
+
+    def load(self):
+        """Synchronous load, for startup and the CLI tools. Returns True if a new snapshot went live."""
+        self._stamp = self._files_stamp()
+        t = time.perf_counter()
+        try:
+            snap = self.read()
+        except StateError as e:
+            self._failed(e)
+            return False
+        finally:
+            state_reload_seconds.observe(time.perf_counter() - t)
+        return self._accept(snap)
+
+    async def reload(self):
+        self._stamp = self._files_stamp()
+        t = time.perf_counter()
+        try:
+            snap = await asyncio.to_thread(self.read)
+        except StateError as e:
+            self._failed(e)
+            return False
+        finally:
+            state_reload_seconds.observe(time.perf_counter() - t)
+        return self._accept(snap)
+
+    def _watch(self):
+        if not self.use_inotify:
+            return
+        try:
+            self._inotify = Inotify(os.path.dirname(os.path.abspath(self.state_file)))
+        except OSError as e:
+            print(f"⚠️ [STATE] {e}: polling ogni {self.poll_interval}s.")
+            return
+        names = {os.path.basename(self.state_file), os.path.basename(self.checksum_file)}
+        def on_readable():
+            if self._inotify and self._inotify.read_names() & names:
+                self._event.set()
+        asyncio.get_running_loop().add_reader(self._inotify.fd, on_readable)
+
+    async def _run(self):
+        self._watch()
+        if self._files_stamp() != self._stamp:
+            await self.reload()  # Scritture tra il caricamento iniziale e l'attivazione del watch
+        while True:
+            timeout = self.safety_interval if self._inotify else self.poll_interval
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout=timeout)
+                await asyncio.sleep(self.debounce)  # Lo scanner scrive checksum e rename in rapida successione
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+            if self._files_stamp() != self._stamp:
+                await self.reload()
+
+    def start(self):
+        if self._task is None:
+            self._event = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._inotify:
+            asyncio.get_running_loop().remove_reader(self._inotify.fd)
+            self._inotify.close()
+            self._inotify = None
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,112 @@
+import time
+from contextlib import contextmanager
+from prometheus_client import Histogram
+from .sse import DONE
+
+stage_seconds = Histogram('neural_home_stage_seconds', 'Time spent in each request stage', ['stage', 'provider', 'category'],
+                          buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+ttft_seconds = Histogram('neural_home_ttft_seconds', 'Time from request arrival to the first streamed token', ['provider', 'category'],
+                         buckets=(0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30, 60))
+stream_seconds = Histogram('neural_home_stream_duration_seconds', 'Time from first to last streamed chunk', ['provider', 'category'],
+                           buckets=(0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300))
+tokens_per_second = Histogram('neural_home_tokens_per_second', 'Generation speed (stream chunks or completion tokens per second)', ['provider', 'category'],
+                              buckets=(1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000))
+request_seconds = Histogram('neural_home_request_duration_seconds', 'End-to-end request time, up to the last streamed chunk for streams', ['provider', 'category', 'mode'],
+                            buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300))
+
+
+class RequestTimer:
+    """
+    Per-request stage stopwatch. Stages are exported as histograms once the
+    provider and category are known, and as a Server-Timing header; spans
+    (name, offset, duration) feed the trace buffer. on_stream_end(timer,
+    error) runs when a tracked stream finishes.
+    """
+    def __init__(self, on_stream_end=None):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.spans = []
+        self.provider = "none"
+        self.category = "none"
+        self.streaming = False
+        self.on_stream_end = on_stream_end
+        self._observed = False
+        self._total_observed = False
+
+    def lap(self, name, since):
+        now = time.perf_counter()
+        self.stages[name] = self.stages.get(name, 0.0) + now - since
+        self.spans.append((name, since - self.start, now - since))
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    @contextmanager
+    def stage(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.lap(name, t)
+
+    def label(self, provider=None, category=None):
+        if provider: self.provider = provider
+        if category: self.category = category
+
+    def header(self):
+        """Server-Timing value, e.g. `state;dur=0.1, limiter;dur=1.3, ..., total;dur=812.4` (ms)."""
+        parts = [f"{name};dur={secs * 1000:.1f}" for name, secs in self.stages.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+    def observe(self):
+        if self._observed:
+            return
+        self._observed = True
+        for name, secs in self.stages.items():
+            stage_seconds.labels(name, self.provider, self.category).observe(secs)
+        if not self.streaming:
+            self.observe_total()
+
+    def observe_total(self):
+        """Whole request: at response time for plain answers, when the stream ends for streams."""
+        if self._total_observed:
+            return
+        self._total_observed = True
+        request_seconds.labels(self.provider, self.category, "stream" if self.streaming else "json").observe(self.elapsed())
+
+    def observe_body(self, body):
+        """Tokens/sec of a non-stream answer from the usage block, over the upstream stage."""
+        tokens = ((body or {}).get("usage") or {}).get("completion_tokens")
+        secs = self.stages.get("upstream")
+        if tokens and secs:
+            tokens_per_second.labels(self.provider, self.category).observe(tokens / secs)
+
+    def track(self, chunks):
+        """Wraps a stream: TTFT from request arrival, duration and chunks/sec up to the last chunk."""
+        self.streaming = True
+        async def tracked():
+            first = last = None
+            n, error = 0, None
+            try:
+                async for chunk in chunks:
+                    if chunk != DONE:
+                        last = time.perf_counter()
+                        n += 1
+                        if first is None:
+                            first = last
+                            ttft_seconds.labels(self.provider, self.category).observe(first - self.start)
+                    yield chunk
+            except BaseException as e:
+                error = repr(e) if isinstance(e, Exception) else "client disconnected"
+                raise
+            finally:
+                if first is not None:
+                    self.spans.append(("stream", first - self.start, last - first))
+                    if last > first:
+                        stream_seconds.labels(self.provider, self.category).observe(last - first)
+                        tokens_per_second.labels(self.provider, self.category).observe((n - 1) / (last - first))
+                self.observe_total()
+                if self.on_stream_end:
+                    self.on_stream_end(self, error)
+        return tracked()
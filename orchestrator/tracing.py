@@ -0,0 +1,130 @@
+import sys
+import time
+import uuid
+import heapq
+import random
+import threading
+from collections import deque, Counter as Tally
+
+
+class TraceBuffer:
+    """
+    Bounded in-process trace store. Successful requests are sampled at
+    `sample_rate` into a ring buffer; errors always go to their own ring,
+    and the slowest `slowest` requests are kept regardless of sampling.
+    """
+    def __init__(self, size=200, sample_rate=0.1, slowest=20):
+        self.sample_rate = sample_rate
+        self.slowest_n = slowest
+        self.recent = deque(maxlen=size)
+        self.errors = deque(maxlen=size)
+        self._slowest = []  # min-heap (durata, seq, trace)
+        self._seq = 0
+        self.seen = 0
+
+    def finish(self, timer, status=200, error=None):
+        """Turns a finished RequestTimer into a trace and keeps it if it is sampled, an error or among the slowest."""
+        self.seen += 1
+        duration = timer.elapsed()
+        trace = {
+            "id": uuid.uuid4().hex[:16],
+            "ts": time.time() - duration,
+            "duration_ms": round(duration * 1000, 2),
+            "status": status,
+            "provider": timer.provider,
+            "category": timer.category,
+            "stream": timer.streaming,
+            "error": error,
+            "spans": [{"name": n, "start_ms": round(o * 1000, 2), "duration_ms": round(d * 1000, 2)} for n, o, d in timer.spans],
+        }
+        if error or status >= 500:
+            self.errors.append(trace)
+        elif random.random() < self.sample_rate:
+            self.recent.append(trace)
+
+        self._seq += 1
+        item = (duration, self._seq, trace)
+        if len(self._slowest) < self.slowest_n:
+            heapq.heappush(self._slowest, item)
+        elif self._slowest and duration > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+        return trace
+
+    def snapshot(self, kind="all", limit=50):
+        out = {}
+        if kind in ("all", "recent"):
+            out["recent"] = list(self.recent)[-limit:][::-1]
+        if kind in ("all", "errors"):
+            out["errors"] = list(self.errors)[-limit:][::-1]
+        if kind in ("all", "slowest"):
+            out["slowest"] = [t for _, _, t in sorted(self._slowest, key=lambda x: -x[0])][:limit]
+        return {"seen": self.seen, "sample_rate": self.sample_rate, **out}
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{code.co_name}:{code.co_firstlineno}"
+
+
+class SamplingProfiler:
+    """
+    Statistical CPU profiler: a side thread samples the stack of the
+    target thread (the event loop) every `interval` seconds. No tracing
+    hooks are installed, so the overhead stays in the sampler thread.
+    """
+    def __init__(self, max_seconds=60):
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+
+    @property
+    def busy(self):
+        return self._lock.locked()
+
+    def run(self, thread_id, seconds, interval=0.005, max_depth=64):
+        """Blocking: samples thread_id for `seconds` and returns the aggregated stacks."""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("Profilazione già in corso")
+        try:
+            stacks = Tally()
+            samples = 0
+            seconds = min(seconds, self.max_seconds)
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                frame = sys._current_frames().get(thread_id)
+                if frame is not None:
+                    stack = []
+                    while frame is not None and len(stack) < max_depth:
+                        stack.append(_frame_label(frame))
+                        frame = frame.f_back
+                    stacks[tuple(reversed(stack))] += 1
+                    samples += 1
+                time.sleep(interval)
+            return Profile(stacks, samples, seconds, interval)
+        finally:
+            self._lock.release()
+
+
+class Profile:
+    def __init__(self, stacks, samples, seconds, interval):
+        self.stacks = stacks
+        self.samples = samples
+        self.seconds = seconds
+        self.interval = interval
+
+    def collapsed(self):
+        """Brendan Gregg's folded format (flamegraph.pl, speedscope)."""
+        return "\n".join(f"{';'.join(stack)} {n}" for stack, n in self.stacks.most_common())
+
+    def top(self, limit=30):
+        own, total = Tally(), Tally()
+        for stack, n in self.stacks.items():
+            if stack:
+                own[stack[-1]] += n
+            for label in set(stack):
+                total[label] += n
+        pct = lambda n: round(100.0 * n / max(1, self.samples), 2)
+        return [{"function": f, "self_pct": pct(n), "total_pct": pct(total[f])} for f, n in own.most_common(limit)]
+
+    def to_dict(self, limit=30):
+        return {"samples": self.samples, "seconds": self.seconds, "interval_ms": self.interval * 1000, "top": self.top(limit)}
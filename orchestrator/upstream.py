@@ -0,0 +1,127 @@
+import uuid
+from fastapi.responses import JSONResponse, StreamingResponse
+from .sse import ChunkFramer, passthrough
+from .context import content_text
+
+
+class Upstream:
+    """
+    Outcome of a provider call: either a full completion body (non-stream)
+    or an already-open SSE stream. Streams that end up unused (speculation
+    miss, lost hedge) must be released with aclose().
+    """
+    def __init__(self, p_id, body=None, chunks=None, closer=None):
+        self.p_id = p_id
+        self.body = body
+        self.chunks = chunks
+        self.latency = None  # Tempo al primo byte (s), se misurato
+        self._closer = closer
+
+    @property
+    def is_stream(self):
+        return self.chunks is not None
+
+    async def aclose(self):
+        if self._closer:
+            try:
+                await self._closer()
+            except Exception:
+                pass
+            self._closer = None
+
+    def to_response(self, headers=None):
+        if self.is_stream:
+            return StreamingResponse(self.chunks, media_type="text/event-stream", headers=headers)
+        return JSONResponse(content=self.body, headers=headers)
+
+
+async def discard(task):
+    """Cancels a pending upstream task, or releases its stream if it already opened."""
+    if not task.done():
+        task.cancel()
+        try:
+            await task
+        except BaseException:
+            pass
+        return
+    if not task.cancelled() and task.exception() is None:
+        await task.result().aclose()
+
+
+def with_language(messages, lang):
+    """Copy of messages with the language override appended to the last turn."""
+    lang_cmd = f"\n\n(SYSTEM OVERRIDE: User speaks {lang}. Respond ONLY in {lang}. Ignore previous instructions to use English.)"
+    out = [dict(m) for m in messages]
+    if out:
+        out[-1]["content"] = (out[-1].get("content") or "") + lang_cmd
+    return out
+
+
+def google_contents(messages):
+    """
+    Whole conversation as Gemini contents (user/model turns). System and
+    tool messages become tagged user text; consecutive turns of the same
+    role are merged into one with several parts.
+    """
+    contents = []
+    for m in messages:
+        role, text = m.get("role"), content_text(m.get("content"))
+        if not text:
+            continue
+        if role != "assistant" and role != "user":
+            text = f"[{role}] {text}"
+        g_role = "model" if role == "assistant" else "user"
+        if contents and contents[-1]["role"] == g_role:
+            contents[-1]["parts"].append({"text": text})
+        else:
+            contents.append({"role": g_role, "parts": [{"text": text}]})
+    return contents
+
+
+async def _prefetch(gen):
+    """Waits for the first chunk, so failures before the first token reach the waterfall."""
+    first = await gen.__anext__()
+    async def chained():
+        yield first
+        async for chunk in gen:
+            yield chunk
+    return chained()
+
+
+async def call_provider(client, p, messages, is_stream, req_model):
+    """
+    Opens the upstream call on a pooled client. Returns once the full body
+    (or the first stream chunk) is available; errors propagate to the waterfall.
+    """
+    if p["type"] == "google":
+        prompt_final = google_contents(messages)  # Tutta la conversazione (system, override lingua, risposta parziale in failover)
+        if is_stream:
+            response = await client.models.generate_content_stream(model=p["model"], contents=prompt_final)
+            framer = ChunkFramer(req_model)
+            async def generate():
+                async for chunk in response:
+                    yield framer.frame({"content": chunk.text})
+                yield framer.frame({}, "stop")
+                yield "data: [DONE]\n\n"
+            return Upstream(p["id"], chunks=await _prefetch(generate()), closer=getattr(response, "aclose", None))
+        res = await client.models.generate_content(model=p["model"], contents=prompt_final)
+        return Upstream(p["id"], body={"id": str(uuid.uuid4()), "object": "chat.completion", "model": req_model, "choices": [{"index": 0, "message": {"role": "assistant", "content": res.text}, "finish_reason": "stop"}]})
+
+    if is_stream:
+        # SSE grezzo: le righe vanno al client così come arrivano, cambia solo il nome del modello
+        response = await client.chat.completions.with_streaming_response.create(model=p["model"], messages=messages, stream=True, timeout=40).__aenter__()
+        async def lines():
+            try:
+                async for line in response.iter_lines():
+                    yield line
+            finally:
+                await response.close()
+        try:
+            chunks = await _prefetch(passthrough(lines(), req_model))
+        except BaseException:
+            await response.close()
+            raise
+        return Upstream(p["id"], chunks=chunks, closer=response.close)
+    response = await client.chat.completions.create(model=p["model"], messages=messages, stream=False, timeout=40)
+    d = response.model_dump(); d["model"] = req_model
+    return Upstream(p["id"], body=d)
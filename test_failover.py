@@ -0,0 +1,48 @@
+import sys
+import asyncio
+# Aggiungiamo il percorso corrente per sicurezza
+sys.path.append('.')
+from orchestrator.failover import continuation, CONTINUE_PROMPT
+from orchestrator.upstream import call_provider, with_language
+
+# Client Gemini finto: registra cosa riceverebbe il provider
+class FakeStream:
+    def __init__(self):
+        self.sent = False
+    def __aiter__(self):
+        return self
+    async def __anext__(self):
+        if self.sent:
+            raise StopAsyncIteration
+        self.sent = True
+        return type("Chunk", (), {"text": "...continua"})()
+
+class FakeModels:
+    contents = None
+    async def generate_content_stream(self, model, contents, **k):
+        FakeModels.contents = contents
+        return FakeStream()
+
+client = type("Client", (), {"models": FakeModels()})()
+gemini = {"id": "gemini-flash", "type": "google", "model": "gemini-2.0-flash"}
+
+messages = [
+    {"role": "system", "content": "Sei un assistente di programmazione."},
+    {"role": "user", "content": "Spiegami le closure in Python"},
+]
+# Come in failover: override lingua, risposta parziale e richiesta di continuare
+cont = continuation(with_language(messages, "Italian"), "Una closure è una funzione che")
+
+async def main():
+    up = await call_provider(client, gemini, cont, True, "qwen-max")
+    await up.aclose()
+    texts = [part["text"] for turn in FakeModels.contents for part in turn["parts"]]
+    print(f'📨 Turni inviati a {gemini["id"]}: {[turn["role"] for turn in FakeModels.contents]}')
+    assert any("Spiegami le closure in Python" in t for t in texts), "Manca la domanda originale dell'utente"
+    assert any("Sei un assistente" in t for t in texts), "Manca il system prompt"
+    assert any("Respond ONLY in Italian" in t for t in texts), "Manca l'override della lingua"
+    assert any("Una closure è una funzione che" in t for t in texts), "Manca la risposta parziale"
+    assert texts[-1] == CONTINUE_PROMPT
+    print("✅ La continuazione porta con sé tutta la conversazione.")
+
+asyncio.run(main())
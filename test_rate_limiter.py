@@ -0,0 +1,99 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+# Aggiungiamo il percorso corrente per sicurezza
+sys.path.append('.')
+from orchestrator.rate_limiter import RateLimiter, LeasedLimiter
+
+# Più "worker" (un LeasedLimiter ciascuno, come i processi uvicorn) martellano lo stesso bucket.
+# Redis su: le ammissioni non superano il limite globale (burst + rate * secondi).
+# Redis giù a metà prova: limite globale + workers * local_share * limite (bucket locali).
+
+
+def fake_clients(workers):
+    import fakeredis  # Con lupa per gli script Lua
+    server = fakeredis.FakeServer()
+    return server, [fakeredis.FakeAsyncRedis(server=server, decode_responses=True) for _ in range(workers)]
+
+
+def real_clients(address, workers):
+    from redis.asyncio import Redis
+    host, _, port = address.partition(":")
+    return None, [Redis(host=host, port=int(port or 6379), db=0, decode_responses=True, socket_connect_timeout=0.5) for _ in range(workers)]
+
+
+async def hammer(limiter, spec, end, stats):
+    while time.monotonic() < end:
+        if (await limiter.acquire([spec])).allowed:
+            stats["admitted"] += 1
+        else:
+            await asyncio.sleep(0.001)
+        stats["degraded"] = stats["degraded"] or limiter.degraded
+
+
+async def verify(workers=4, seconds=4.0, burst=100, per_min=1200, share=0.25, redis_down_at=None, redis=None):
+    server, clients = real_clients(redis, workers) if redis else fake_clients(workers)
+    limits = (burst, per_min)
+    limiters = [LeasedLimiter(RateLimiter(c, {"verify": limits}), local_share=share) for c in clients]
+    spec = limiters[0].limiter._bucket("verify", f"ratelimit:verify:{time.time()}", limits, 1)
+    stats = [{"admitted": 0, "degraded": False} for _ in limiters]
+
+    async def cut():
+        await asyncio.sleep(redis_down_at)
+        server.connected = False  # Redis irraggiungibile per tutti i worker
+
+    end = time.monotonic() + seconds
+    tasks = [hammer(l, spec, end, s) for l, s in zip(limiters, stats)]
+    if redis_down_at is not None and server is not None:
+        tasks.append(cut())
+    await asyncio.gather(*tasks)
+
+    admitted = sum(s["admitted"] for s in stats)
+    degraded = any(s["degraded"] for s in stats)
+    limit = burst + per_min / 60.0 * seconds
+    # Quanto passa da Redis (lease compresi) resta nel limite; da Redis giù ogni worker ha il suo bucket locale
+    bound = limit + workers * share * limit if degraded else limit
+    return {"workers": workers, "seconds": seconds, "redis": "down" if degraded else "up", "admitted": admitted,
+            "per_worker": [s["admitted"] for s in stats], "limit": round(limit, 1), "bound": round(bound, 1),
+            "over_admission": max(0, admitted - int(bound))}
+
+
+def test_redis_up():
+    res = asyncio.run(verify(seconds=2.0))
+    print(json.dumps(res))
+    assert res["redis"] == "up" and res["over_admission"] == 0
+
+
+def test_redis_down():
+    res = asyncio.run(verify(seconds=2.0, redis_down_at=1.0))
+    print(json.dumps(res))
+    assert res["redis"] == "down" and res["over_admission"] == 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Leased rate limiter against the global limit, with several workers.")
+    parser.add_argument("--redis", default=None, help="host:port di un Redis reale (default: fakeredis in-process; solo scenario 'up')")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=4)
+    parser.add_argument("--burst", type=float, default=100)
+    parser.add_argument("--per-minute", type=float, default=1200)
+    parser.add_argument("--local-share", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    failed = False
+    scenarios = [None] if args.redis else [None, args.seconds / 2]
+    for down_at in scenarios:
+        res = asyncio.run(verify(args.workers, args.seconds, args.burst, args.per_minute, args.local_share, down_at, args.redis))
+        print(json.dumps(res))
+        if res["over_admission"]:
+            print(f"❌ Redis {res['redis']}: bound superato di {res['over_admission']} richieste.")
+            failed = True
+        else:
+            print(f"✅ Redis {res['redis']}: {res['admitted']} ammesse, bound {res['bound']}.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
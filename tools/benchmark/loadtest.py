@@ -0,0 +1,389 @@
+"""
+Load test for the orchestrator. Boots orchestrator.main:app in its own
+process against stub providers (tools.benchmark.stubs) and a fake Redis
+(or a real one with --redis), drives mixed streaming/non-streaming load
+and reports throughput, latency and TTFT percentiles and the gateway's
+CPU and memory. Baselines live in baselines.json next to this file.
+
+    python -m tools.benchmark.loadtest run                       # tutti gli scenari
+    python -m tools.benchmark.loadtest run -s mixed --check      # exit 1 se regressione
+    python -m tools.benchmark.loadtest run -s mixed --save-baseline
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+import httpx
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+BASELINES_FILE = Path(__file__).with_name("baselines.json")
+
+# Latenze dei provider simulati: cloud "tipico", giudice veloce
+SCENARIOS = {
+    "mixed": {
+        "concurrency": 32, "duration": 20, "stream_ratio": 0.5,
+        "openai": {"latency": 0.3, "ttft": 0.2, "tokens": 40, "token_interval": 0.005},
+        "gemini": {"latency": 0.05, "ttft": 0.15, "tokens": 40, "token_interval": 0.005},
+    },
+    "streaming": {
+        "concurrency": 64, "duration": 20, "stream_ratio": 1.0,
+        "openai": {"latency": 0.3, "ttft": 0.2, "tokens": 200, "token_interval": 0.002},
+        "gemini": {"latency": 0.05, "ttft": 0.15, "tokens": 200, "token_interval": 0.002},
+    },
+    "faults": {
+        "concurrency": 32, "duration": 20, "stream_ratio": 0.5,
+        "openai": {"latency": 0.3, "ttft": 0.2, "tokens": 40, "token_interval": 0.005, "error_rate": 0.05, "rate_429": 0.02},
+        "gemini": {"latency": 0.05, "ttft": 0.15, "tokens": 40, "token_interval": 0.005, "error_rate": 0.05},
+    },
+}
+
+# Metrica -> direzione buona; le regressioni si misurano rispetto alla baseline
+METRICS = {
+    "throughput_rps": "higher",
+    "latency_p50_ms": "lower",
+    "latency_p95_ms": "lower",
+    "latency_p99_ms": "lower",
+    "ttft_p50_ms": "lower",
+    "ttft_p95_ms": "lower",
+    "cpu_ms_per_request": "lower",
+    "rss_peak_mb": "lower",
+    "error_rate": "lower",
+}
+ABSOLUTE_SLACK = {"error_rate": 0.01, "rss_peak_mb": 10.0}
+
+GATEWAY_ENV = {
+    "GPU_QUEUE_ENABLED": "0",
+    "RATE_LIMITS": "global:1000000:1000000,cheap:1000000:1000000,expensive:1000000:1000000,client:1000000:1000000",
+    "GROQ_API_KEY": "stub", "DASHSCOPE_API_KEY": "stub", "GOOGLE_API_KEY": "stub",
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ProcStats:
+    """CPU time and RSS of a process from /proc (the gateway runs on Linux)."""
+    TICK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.TICK  # utime + stime
+
+    def rss_mb(self):
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+        return 0.0
+
+
+class Stack:
+    """Stub providers, (fake) Redis and the gateway, each in its own process."""
+    def __init__(self, scenario, redis=None, extra_env=None, workers=1):
+        self.scenario = scenario
+        self.redis = redis
+        self.extra_env = extra_env or {}
+        self.workers = workers
+        self.procs = []
+        self.tmp = tempfile.TemporaryDirectory(prefix="nh-bench-")
+
+    def _spawn(self, args, log, env=None):
+        out = open(Path(self.tmp.name) / log, "w")
+        proc = subprocess.Popen([sys.executable, "-m", *args], cwd=PROJECT_ROOT, env=env, stdout=out, stderr=subprocess.STDOUT)
+        self.procs.append(proc)
+        return proc
+
+    def _stub(self, kind):
+        port = free_port()
+        args = ["tools.benchmark.stubs", kind, "--port", str(port), "--seed", "1"]
+        for k, v in self.scenario[kind].items():
+            args += [f"--{k.replace('_', '-')}", str(v)]
+        self._spawn(args, f"stub_{kind}.log")
+        return f"http://127.0.0.1:{port}"
+
+    def _write_state(self, openai_url):
+        providers = {
+            "qwen_cloud": {"id": "qwen_cloud", "name": "Stub Qwen", "url": f"{openai_url}/v1", "model": "qwen-max", "type": "openai", "quality": 7.0},
+            "groq": {"id": "groq", "name": "Stub Groq", "url": f"{openai_url}/v1", "model": "llama-3.3-70b-versatile", "type": "openai", "quality": 7.0},
+            "gemini-flash": {"id": "gemini-flash", "name": "Stub Gemini", "model": "gemini-2.0-flash", "type": "google", "quality": 8.0},
+        }
+        content = json.dumps({"api_providers": providers}, indent=2)
+        state = Path(self.tmp.name) / "state.json"
+        state.write_text(content)
+        state.with_name("state.json.checksum").write_text(hashlib.sha256(content.encode("utf-8")).hexdigest())
+        return state
+
+    def start(self):
+        openai_url, gemini_url = self._stub("openai"), self._stub("gemini")
+        if self.redis:
+            redis_host, _, redis_port = self.redis.partition(":")
+            redis_port = redis_port or "6379"
+        else:
+            redis_host, redis_port = "127.0.0.1", str(free_port())
+            self._spawn(["tools.benchmark.loadtest", "fake-redis", "--port", redis_port], "redis.log")
+
+        self.gateway_env = {**os.environ, **GATEWAY_ENV,
+               "STATE_FILE": str(self._write_state(openai_url)),
+               "REDIS_HOST": redis_host, "REDIS_PORT": redis_port,
+               "GOOGLE_GEMINI_BASE_URL": gemini_url,
+               "JUDGE_LOG_FILE": str(Path(self.tmp.name) / "judge_decisions.jsonl"),
+               "CLASSIFIER_MODEL_FILE": str(Path(self.tmp.name) / "no_classifier.json"),
+               **self.extra_env}
+        self.spawn_gateway()
+        self._wait_ready()
+        return self
+
+    def spawn_gateway(self):
+        port = free_port()
+        args, env = ["uvicorn", "orchestrator.main:app", "--host", "127.0.0.1", "--port", str(port),
+                     "--log-level", "warning", "--no-access-log"], self.gateway_env
+        if self.workers > 1:
+            # Metriche aggregate tra i worker: directory vuota a ogni avvio
+            metrics_dir = Path(tempfile.mkdtemp(prefix="prom-", dir=self.tmp.name))
+            args += ["--workers", str(self.workers)]
+            env = {**env, "PROMETHEUS_MULTIPROC_DIR": str(metrics_dir)}
+        self.gateway = self._spawn(args, "gateway.log", env)
+        self.url = f"http://127.0.0.1:{port}"
+        return self.gateway
+
+    def stop_gateway(self):
+        self.procs.remove(self.gateway)
+        self.gateway.terminate()
+        try:
+            self.gateway.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.gateway.kill()
+
+    def _wait_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.gateway.poll() is not None:
+                break
+            try:
+                if httpx.get(f"{self.url}/ready", timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"Gateway non pronto; log:\n{self.log('gateway.log')[-2000:]}")
+
+    def log(self, name):
+        return (Path(self.tmp.name) / name).read_text(errors="replace")
+
+    def stop(self):
+        for proc in reversed(self.procs):
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        self.tmp.cleanup()
+
+    def __enter__(self):
+        try:
+            return self.start()
+        except BaseException:
+            self.stop()
+            raise
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+async def _one(client, stream, tag):
+    """(status, latency s, ttft s or None, complete)"""
+    body = {"model": "qwen-max", "stream": stream,
+            "messages": [{"role": "user", "content": f"bench {tag} {uuid.uuid4().hex}: explain the difference between a list and a tuple"}]}
+    t0 = time.perf_counter()
+    if not stream:
+        resp = await client.post("/v1/chat/completions", json=body)
+        return resp.status_code, time.perf_counter() - t0, None, resp.status_code == 200
+    ttft, done = None, False
+    async with client.stream("POST", "/v1/chat/completions", json=body) as resp:
+        async for line in resp.aiter_lines():
+            if ttft is None and line.startswith("data: {"):
+                ttft = time.perf_counter() - t0
+            elif line == "data: [DONE]":
+                done = True
+        return resp.status_code, time.perf_counter() - t0, ttft, done
+
+
+async def drive(url, concurrency, duration, stream_ratio, warmup=2.0, on_tick=None):
+    """Closed-loop load: `concurrency` clients issuing requests back to back for `duration` seconds after warmup."""
+    samples = []
+    start = time.monotonic()
+    measure_from, deadline = start + warmup, start + warmup + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, timeout=120, limits=limits) as client:
+        async def worker(w):
+            i = 0
+            while time.monotonic() < deadline:
+                stream = random.random() < stream_ratio
+                t = time.monotonic()
+                try:
+                    res = await _one(client, stream, f"{w}-{i}")
+                except httpx.HTTPError:
+                    res = (0, time.monotonic() - t, None, False)
+                if t >= measure_from:
+                    samples.append((stream,) + res)
+                i += 1
+
+        async def ticker():
+            while time.monotonic() < deadline:
+                if on_tick: on_tick(time.monotonic() >= measure_from)
+                await asyncio.sleep(0.5)
+
+        await asyncio.gather(ticker(), *(worker(w) for w in range(concurrency)))
+    return samples
+
+
+def summarize(samples, duration, cpu_seconds, rss_peak):
+    ok = [s for s in samples if s[1] == 200 and s[4]]
+    statuses = {}
+    for s in samples:
+        statuses[str(s[1])] = statuses.get(str(s[1]), 0) + 1
+    lat = [s[2] * 1000 for s in ok]
+    ttft = [s[3] * 1000 for s in ok if s[0] and s[3] is not None]
+    r = lambda v: round(v, 2) if v is not None else None
+    return {
+        "requests": len(samples),
+        "ok": len(ok),
+        "streams": sum(1 for s in samples if s[0]),
+        "statuses": statuses,
+        "error_rate": r(1 - len(ok) / max(1, len(samples))),
+        "throughput_rps": r(len(ok) / duration),
+        "latency_p50_ms": r(percentile(lat, 0.50)),
+        "latency_p95_ms": r(percentile(lat, 0.95)),
+        "latency_p99_ms": r(percentile(lat, 0.99)),
+        "ttft_p50_ms": r(percentile(ttft, 0.50)),
+        "ttft_p95_ms": r(percentile(ttft, 0.95)),
+        "cpu_ms_per_request": r(cpu_seconds * 1000 / max(1, len(samples))),
+        "cpu_util": r(cpu_seconds / duration),
+        "rss_peak_mb": r(rss_peak),
+    }
+
+
+def run_scenario(name, redis=None, duration=None, concurrency=None, extra_env=None):
+    sc = SCENARIOS[name]
+    duration = duration or sc["duration"]
+    concurrency = concurrency or sc["concurrency"]
+    print(f"🏁 Scenario {name}: {concurrency} client, {duration}s, stream {int(sc['stream_ratio'] * 100)}%")
+    with Stack(sc, redis, extra_env) as stack:
+        proc = ProcStats(stack.gateway.pid)
+        mark = {"cpu": None, "rss": 0.0}
+
+        def tick(measuring):
+            if measuring and mark["cpu"] is None:
+                mark["cpu"] = proc.cpu_seconds()
+            mark["rss"] = max(mark["rss"], proc.rss_mb())
+
+        samples = asyncio.run(drive(stack.url, concurrency, duration, sc["stream_ratio"], on_tick=tick))
+        cpu = proc.cpu_seconds() - (mark["cpu"] if mark["cpu"] is not None else 0.0)
+        report = summarize(samples, duration, cpu, mark["rss"])
+    report.update({"scenario": name, "concurrency": concurrency, "duration": duration})
+    return report
+
+
+def compare(report, baseline, tolerance, metrics=METRICS, absolute_slack=ABSOLUTE_SLACK):
+    """List of (metric, baseline, current, regressed?) for the metrics both sides have."""
+    rows = []
+    for metric, better in metrics.items():
+        base, cur = baseline.get(metric), report.get(metric)
+        if base is None or cur is None:
+            continue
+        slack = absolute_slack.get(metric, 0.0)
+        if better == "higher":
+            regressed = cur < base * (1 - tolerance) - slack
+        else:
+            regressed = cur > base * (1 + tolerance) + slack
+        rows.append((metric, base, cur, regressed))
+    return rows
+
+
+def load_baselines():
+    if BASELINES_FILE.exists():
+        return json.loads(BASELINES_FILE.read_text())
+    return {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Orchestrator load test against stub providers.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="Run one or more scenarios")
+    run.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS), help="Default: all")
+    run.add_argument("--duration", type=float, default=None)
+    run.add_argument("--concurrency", type=int, default=None)
+    run.add_argument("--redis", default=None, help="host:port of a real Redis (default: fakeredis in a subprocess)")
+    run.add_argument("--env", action="append", default=[], help="KEY=VALUE passed to the gateway (e.g. STREAM_COALESCE_MS=20)")
+    run.add_argument("--save-baseline", action="store_true")
+    run.add_argument("--check", action="store_true", help="Exit 1 if a metric regressed beyond --tolerance")
+    run.add_argument("--tolerance", type=float, default=0.25)
+    run.add_argument("--out", default=None, help="Write the JSON report here")
+    fake = sub.add_parser("fake-redis", help=argparse.SUPPRESS)
+    fake.add_argument("--port", type=int, required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == "fake-redis":
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            print("❌ fakeredis (con lupa per gli script Lua) non installato: usa --redis host:port.")
+            return 1
+        server = TcpFakeServer(("127.0.0.1", args.port), server_type="redis")
+        server.serve_forever()
+        return 0
+
+    extra_env = dict(kv.split("=", 1) for kv in args.env)
+    baselines = load_baselines()
+    reports, failed = {}, False
+    for name in args.scenario or sorted(SCENARIOS):
+        report = reports[name] = run_scenario(name, args.redis, args.duration, args.concurrency, extra_env)
+        print(json.dumps(report, indent=2))
+        if args.check:
+            if name not in baselines:
+                print(f"⚠️  Nessuna baseline per {name}")
+                continue
+            for metric, base, cur, regressed in compare(report, baselines[name], args.tolerance):
+                flag = "❌" if regressed else "✅"
+                print(f"{flag} {name:<10} {metric:<20} baseline {base:>10} -> {cur:>10}")
+                failed |= regressed
+
+    if args.out:
+        Path(args.out).write_text(json.dumps(reports, indent=2))
+    if args.save_baseline:
+        baselines.update(reports)
+        BASELINES_FILE.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"💾 Baseline salvata in {BASELINES_FILE}")
+    if failed:
+        print("❌ Regressione rispetto alla baseline.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Worker scaling benchmark. Runs the gateway with uvicorn --workers N
+(Prometheus multiprocess mode, shared state in the fake Redis) for each
+worker count, drives the "mixed" load-test scenario with a client count
+proportional to N and reports throughput, latency, CPU per request and
+scaling efficiency (throughput(N) / (N * throughput(1))).
+
+    python -m tools.benchmark.scaling run                    # 1, 2, 4 ... fino ai core disponibili
+    python -m tools.benchmark.scaling run -w 1 -w 2 -w 4 --duration 30 --check
+
+The load generator and the stubs are single processes: on small boxes they
+compete with the workers for CPU, so efficiency is only meaningful while
+N stays below the core count (minus one or two for the driver).
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+from pathlib import Path
+from .loadtest import SCENARIOS, ProcStats, Stack, drive, summarize
+
+SCENARIO = "mixed"
+
+
+class ProcTree:
+    """CPU time and RSS of the gateway master plus its uvicorn workers (direct children)."""
+    def __init__(self, pid):
+        self.pid = pid
+
+    def pids(self):
+        pids = [self.pid]
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == self.pid:
+                        pids.append(int(entry))
+            except (OSError, ValueError, IndexError):
+                pass
+        return pids
+
+    def _sum(self, read):
+        total = 0.0
+        for pid in self.pids():
+            try:
+                total += read(ProcStats(pid))
+            except OSError:
+                pass  # Worker terminato nel frattempo
+        return total
+
+    def cpu_seconds(self):
+        return self._sum(ProcStats.cpu_seconds)
+
+    def rss_mb(self):
+        return self._sum(ProcStats.rss_mb)
+
+
+def default_worker_counts():
+    cores, counts, n = os.cpu_count() or 1, [1], 2
+    while n <= cores:
+        counts.append(n)
+        n *= 2
+    return counts
+
+
+def run_workers(workers, duration, clients_per_worker, redis=None):
+    sc = SCENARIOS[SCENARIO]
+    concurrency = clients_per_worker * workers
+    print(f"🏁 {workers} worker: {concurrency} client, {duration}s")
+    with Stack(sc, redis, workers=workers) as stack:
+        tree = ProcTree(stack.gateway.pid)
+        mark = {"cpu": None, "rss": 0.0}
+
+        def tick(measuring):
+            if measuring and mark["cpu"] is None:
+                mark["cpu"] = tree.cpu_seconds()
+            mark["rss"] = max(mark["rss"], tree.rss_mb())
+
+        # Warmup più lungo: ogni worker fa il proprio warm-up degli SDK
+        samples = asyncio.run(drive(stack.url, concurrency, duration, sc["stream_ratio"], warmup=5.0, on_tick=tick))
+        cpu = tree.cpu_seconds() - (mark["cpu"] if mark["cpu"] is not None else 0.0)
+    return {"workers": workers, "concurrency": concurrency, "duration": duration,
+            **summarize(samples, duration, cpu, mark["rss"])}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Orchestrator throughput scaling across uvicorn workers.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    cmd = sub.add_parser("run", help="Run the scaling sweep")
+    cmd.add_argument("-w", "--workers", type=int, action="append", help="Worker counts (default: 1, 2, 4 ... up to the cores)")
+    cmd.add_argument("--duration", type=float, default=20)
+    cmd.add_argument("--clients-per-worker", type=int, default=SCENARIOS[SCENARIO]["concurrency"])
+    cmd.add_argument("--redis", default=None, help="host:port of a real Redis (default: fakeredis in a subprocess)")
+    cmd.add_argument("--check", action="store_true", help="Exit 1 if efficiency drops below --min-efficiency (worker counts <= cores only)")
+    cmd.add_argument("--min-efficiency", type=float, default=0.6)
+    cmd.add_argument("--out", default=None, help="Write the JSON report here")
+    args = parser.parse_args(argv)
+
+    cores = os.cpu_count() or 1
+    counts = sorted(set(args.workers or default_worker_counts()))
+    results = [run_workers(n, args.duration, args.clients_per_worker, args.redis) for n in counts]
+    base = next((r["throughput_rps"] for r in results if r["workers"] == 1), None)
+    for r in results:
+        r["efficiency"] = round(r["throughput_rps"] / (r["workers"] * base), 2) if base else None
+
+    report = {"cores": cores, "scenario": SCENARIO, "results": results}
+    print(json.dumps(report, indent=2))
+    print(f"\n{'workers':>8} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'cpu ms/req':>11} {'efficiency':>11}")
+    for r in results:
+        print(f"{r['workers']:>8} {r['throughput_rps']:>8} {r['latency_p50_ms']!s:>9} {r['latency_p95_ms']!s:>9} "
+              f"{r['cpu_ms_per_request']:>11} {r['efficiency']!s:>11}")
+    if any(r["workers"] > cores for r in results):
+        print(f"⚠️  Solo {cores} core: i conteggi oltre non possono scalare.")
+
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, indent=2))
+    if args.check:
+        low = [r for r in results if r["workers"] <= cores and r["efficiency"] is not None and r["efficiency"] < args.min_efficiency]
+        for r in low:
+            print(f"❌ {r['workers']} worker: efficienza {r['efficiency']} < {args.min_efficiency}")
+        if low:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
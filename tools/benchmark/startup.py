@@ -0,0 +1,138 @@
+"""
+Cold-start benchmark for the orchestrator. Measures the import time of
+orchestrator.main in a fresh interpreter and, for repeated gateway
+restarts against the load-test stubs and fake Redis, the time until the
+port answers, until /ready turns 200 and until the first chat request is
+served. The baseline lives under "startup" in baselines.json.
+
+    python -m tools.benchmark.startup run
+    python -m tools.benchmark.startup run --runs 10 --check
+    python -m tools.benchmark.startup run --save-baseline
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+import httpx
+from .loadtest import PROJECT_ROOT, BASELINES_FILE, GATEWAY_ENV, Stack, compare, load_baselines
+
+# Provider simulati istantanei: si misura il gateway, non i provider
+SCENARIO = {
+    "openai": {"latency": 0.0, "ttft": 0.0, "tokens": 5, "token_interval": 0.0},
+    "gemini": {"latency": 0.0, "ttft": 0.0, "tokens": 5, "token_interval": 0.0},
+}
+SDK_MODULES = ("openai", "google.genai")
+
+METRICS = {
+    "import_ms": "lower",
+    "listening_ms": "lower",
+    "ready_ms": "lower",
+    "first_request_ms": "lower",
+}
+ABSOLUTE_SLACK = {"import_ms": 100.0, "listening_ms": 150.0, "ready_ms": 150.0, "first_request_ms": 150.0}
+
+IMPORT_PROBE = f"""
+import sys, time, json
+t = time.perf_counter()
+import orchestrator.main
+elapsed = time.perf_counter() - t
+print(json.dumps({{"import_ms": elapsed * 1000, "eager": [m for m in {SDK_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import():
+    """Import time of orchestrator.main in a fresh interpreter, plus the SDKs it imported eagerly."""
+    env = {**os.environ, **GATEWAY_ENV, "GOOGLE_API_KEY": ""}
+    out = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=PROJECT_ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+async def measure_boot(stack):
+    """(Re)starts the gateway and times port open, /ready and the first served chat request (ms)."""
+    body = {"model": "qwen-max", "messages": [{"role": "user", "content": "startup probe: say hello"}]}
+    marks = {}
+    t0 = time.perf_counter()
+    stack.spawn_gateway()
+    async with httpx.AsyncClient(base_url=stack.url, timeout=30) as client:
+        async def poll(name, send):
+            while stack.gateway.poll() is None:
+                try:
+                    if (await send()).status_code == 200:
+                        marks[name] = round((time.perf_counter() - t0) * 1000, 1)
+                        return
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.01)
+            raise RuntimeError(f"Gateway terminato; log:\n{stack.log('gateway.log')[-2000:]}")
+
+        await asyncio.wait_for(asyncio.gather(
+            poll("listening_ms", lambda: client.get("/v1/models")),
+            poll("ready_ms", lambda: client.get("/ready")),
+            poll("first_request_ms", lambda: client.post("/v1/chat/completions", json=body)),
+        ), timeout=60)
+    stack.stop_gateway()
+    return marks
+
+
+def run(runs):
+    imports = [measure_import() for _ in range(runs)]
+    with Stack(SCENARIO) as stack:
+        stack.stop_gateway()  # Avviato (e già scaldato) da Stack.start: le misure partono da un processo nuovo
+        boots = [asyncio.run(measure_boot(stack)) for _ in range(runs)]
+
+    report = {"runs": runs, "eager_sdk_imports": sorted({m for i in imports for m in i["eager"]})}
+    report["import_ms"] = round(statistics.median(i["import_ms"] for i in imports), 1)
+    for metric in ("listening_ms", "ready_ms", "first_request_ms"):
+        values = [b[metric] for b in boots]
+        report[metric] = round(statistics.median(values), 1)
+        report[metric.replace("_ms", "_max_ms")] = max(values)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Orchestrator cold-start benchmark.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    cmd = sub.add_parser("run", help="Measure import and boot times")
+    cmd.add_argument("--runs", type=int, default=5)
+    cmd.add_argument("--save-baseline", action="store_true")
+    cmd.add_argument("--check", action="store_true", help="Exit 1 on regression or if a provider SDK is imported eagerly")
+    cmd.add_argument("--tolerance", type=float, default=0.25)
+    cmd.add_argument("--out", default=None, help="Write the JSON report here")
+    args = parser.parse_args(argv)
+
+    report = run(args.runs)
+    print(json.dumps(report, indent=2))
+    baselines = load_baselines()
+    failed = False
+    if args.check:
+        if report["eager_sdk_imports"]:
+            print(f"❌ SDK importati all'import del modulo: {', '.join(report['eager_sdk_imports'])}")
+            failed = True
+        if "startup" not in baselines:
+            print("⚠️  Nessuna baseline per startup")
+        else:
+            for metric, base, cur, regressed in compare(report, baselines["startup"], args.tolerance, METRICS, ABSOLUTE_SLACK):
+                flag = "❌" if regressed else "✅"
+                print(f"{flag} {metric:<18} baseline {base:>10} -> {cur:>10}")
+                failed |= regressed
+
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, indent=2))
+    if args.save_baseline:
+        baselines["startup"] = report
+        BASELINES_FILE.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"💾 Baseline salvata in {BASELINES_FILE}")
+    if failed:
+        print("❌ Regressione dell'avvio a freddo.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+Stand-in providers for the load test: an OpenAI-compatible and a
+Gemini-compatible server with configurable latency, time to first token,
+stream length, error and 429 rates. The Gemini stub also answers the
+judge prompts (single and batched) with a valid verdict.
+
+    python -m tools.benchmark.stubs openai --port 9201 --ttft 0.2 --rate-429 0.01
+    python -m tools.benchmark.stubs gemini --port 9202 --latency 0.05
+"""
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+VERDICTS = ({"cat": "SIMPLE", "lang": "English"}, {"cat": "CODING", "lang": "English"})
+
+
+class StubConfig:
+    def __init__(self, latency=0.3, ttft=0.2, tokens=40, token_interval=0.01, error_rate=0.0, rate_429=0.0, jitter=0.2):
+        self.latency = latency                # Risposta completa (non-stream)
+        self.ttft = ttft                      # Attesa prima del primo token (stream)
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.jitter = jitter
+
+    def wait(self, secs):
+        return asyncio.sleep(max(0.0, secs * (1 + random.uniform(-self.jitter, self.jitter))))
+
+    def fault(self):
+        """(status, message) of an injected failure, or None."""
+        x = random.random()
+        if x < self.rate_429:
+            return 429, "Rate limit reached (stub)"
+        if x < self.rate_429 + self.error_rate:
+            return 500, "Internal error (stub)"
+        return None
+
+    def text(self):
+        return " ".join(f"tok{i}" for i in range(self.tokens))
+
+
+def openai_app(cfg):
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        fault = cfg.fault()
+        if fault:
+            await cfg.wait(cfg.ttft)
+            return JSONResponse(status_code=fault[0], content={"error": {"message": fault[1], "code": fault[0]}})
+        cid, model = f"chatcmpl-stub{random.getrandbits(48):x}", body.get("model", "stub")
+        if not body.get("stream"):
+            await cfg.wait(cfg.latency)
+            return {"id": cid, "object": "chat.completion", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": cfg.text()}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 10, "completion_tokens": cfg.tokens, "total_tokens": 10 + cfg.tokens}}
+
+        async def generate():
+            await cfg.wait(cfg.ttft)
+            for i in range(cfg.tokens):
+                d = {"id": cid, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": {"content": f"tok{i} "}, "finish_reason": None}]}
+                yield f"data: {json.dumps(d)}\n\n"
+                await cfg.wait(cfg.token_interval)
+            d = {"id": cid, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(d)}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return app
+
+
+def _judge_answer(prompt):
+    """Verdicts for the judge prompts (one object, or a JSON array for a batch)."""
+    n = re.search(r"JSON array of (\d+)", prompt)
+    pick = lambda i: VERDICTS[(len(prompt) + i) % 2]
+    if n:
+        return json.dumps([pick(i) for i in range(int(n.group(1)))])
+    if "RESPOND ONLY JSON" in prompt:
+        return json.dumps(pick(0))
+    return None
+
+
+def gemini_app(cfg):
+    app = FastAPI()
+
+    def candidate(text, finish=None):
+        c = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+        if finish:
+            c["finishReason"] = finish
+        return {"candidates": [c]}
+
+    @app.post("/{version}/models/{target:path}")
+    async def generate(version: str, target: str, request: Request):
+        body = await request.json()
+        prompt = "".join(p.get("text", "") for c in body.get("contents", []) for p in c.get("parts", []))
+        judge = _judge_answer(prompt)
+        fault = None if judge else cfg.fault()
+        if fault:
+            await cfg.wait(cfg.ttft)
+            return JSONResponse(status_code=fault[0], content={"error": {"code": fault[0], "message": fault[1], "status": "UNAVAILABLE"}})
+        if target.endswith(":streamGenerateContent"):
+            async def stream():
+                await cfg.wait(cfg.ttft)
+                for i in range(cfg.tokens):
+                    yield f"data: {json.dumps(candidate(f'tok{i} '))}\n\n"
+                    await cfg.wait(cfg.token_interval)
+                yield f"data: {json.dumps(candidate('', 'STOP'))}\n\n"
+            return StreamingResponse(stream(), media_type="text/event-stream")
+        await cfg.wait(cfg.latency)
+        return candidate(judge or cfg.text(), "STOP")
+
+    return app
+
+
+APPS = {"openai": openai_app, "gemini": gemini_app}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stub provider for the orchestrator load test.")
+    parser.add_argument("kind", choices=sorted(APPS))
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    cfg = StubConfig(args.latency, args.ttft, args.tokens, args.token_interval, args.error_rate, args.rate_429, args.jitter)
+    uvicorn.run(APPS[args.kind](cfg), host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -23,33 +23,49 @@ STATE_HISTORY_DIR = INFRASTRUCTURE_DIR / "state_history"
 
 # Default Providers Configuration (Source of Truth for connection details)
 # In V4 this could be discovered via network scan or config file
+# quality: rating 0-10 used by the adaptive router (Blueprint Sec 4.2); daily_quota: free-tier requests/day
+# context_window / max_output: token limits used to skip providers a request cannot fit (Blueprint: 32K local/Qwen, 1M Gemini)
 DEFAULT_PROVIDERS = {
     "ollama": {
         "id": "ollama", 
         "name": "GPU Locale (RTX)", 
         "url": "http://192.168.1.139:11434/v1", 
         "model": "qwen2.5:14b-instruct-q6_K", 
-        "type": "openai"
+        "type": "openai",
+        "quality": 6.0,
+        "context_window": 32768,
+        "max_output": 8192
     },
     "qwen_cloud": {
         "id": "qwen_cloud", 
         "name": "Alibaba Qwen Max", 
         "url": "https://dashscope-intl.aliyuncs.com/compatible-mode/v1", 
         "model": "qwen-max", 
-        "type": "openai"
+        "type": "openai",
+        "quality": 7.0,
+        "context_window": 32768,
+        "max_output": 8192
     },
     "gemini-flash": {
         "id": "gemini-flash", 
         "name": "Gemini 2.5 Flash", 
         "model": "gemini-2.0-flash", 
-        "type": "google"
+        "type": "google",
+        "quality": 8.0,
+        "daily_quota": 1500,
+        "context_window": 1048576,
+        "max_output": 8192
     },
     "groq": {
         "id": "groq", 
         "name": "Groq (Llama 3.3)", 
         "url": "https://api.groq.com/openai/v1", 
         "model": "llama-3.3-70b-versatile", 
-        "type": "openai"
+        "type": "openai",
+        "quality": 7.0,
+        "daily_quota": 1000,
+        "context_window": 131072,
+        "max_output": 32768
     }
 }
 
@@ -14,21 +14,43 @@ if [ ! -f "$UVICORN" ]; then
     exit 1
 fi
 
+# Worker count (see README "Scaling"): routing mode and provider snapshot are shared via Redis
+WORKERS="${ORCHESTRATOR_WORKERS:-1}"
+EXTRA_ARGS=()
+
 # Kill existing (be careful but firm)
 pkill -f "uvicorn orchestrator.main:app" || true
 
+if [ "$WORKERS" -gt 1 ]; then
+    # Prometheus multiprocess mode: one metrics dir per deployment, wiped on every start
+    export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-$PROJECT_DIR/.prometheus_multiproc}"
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+    EXTRA_ARGS+=(--workers "$WORKERS")
+    if [ "${GPU_QUEUE_CONCURRENCY:-2}" != "0" ]; then
+        echo "Warning: each worker runs its own GPU queue consumer. Set GPU_QUEUE_CONCURRENCY=0 and run 'python -m orchestrator.gpu_queue worker' once."
+    fi
+fi
+
 # Start with nohup
-nohup "$UVICORN" orchestrator.main:app --host 0.0.0.0 --port 8000 > "$PROJECT_DIR/orchestrator.log" 2>&1 < /dev/null &
+nohup "$UVICORN" orchestrator.main:app --host 0.0.0.0 --port 8000 "${EXTRA_ARGS[@]}" > "$PROJECT_DIR/orchestrator.log" 2>&1 < /dev/null &
 PID=$!
 
-echo "Orchestrator started with PID $PID. Logs in $PROJECT_DIR/orchestrator.log"
-sleep 3
+echo "Orchestrator started with PID $PID ($WORKERS worker). Logs in $PROJECT_DIR/orchestrator.log"
 
-if ps -p $PID > /dev/null; then
-  echo "Process is running (PID $PID)."
-  exit 0
-else
-  echo "Process died immediately. Last 20 lines of log:"
-  tail -n 20 "$PROJECT_DIR/orchestrator.log"
-  exit 1
-fi
+# Wait for readiness (state loaded, SDKs warm) instead of a fixed sleep
+for i in $(seq 1 60); do
+  if ! ps -p $PID > /dev/null; then
+    echo "Process died immediately. Last 20 lines of log:"
+    tail -n 20 "$PROJECT_DIR/orchestrator.log"
+    exit 1
+  fi
+  if curl -sf http://127.0.0.1:8000/ready > /dev/null; then
+    echo "Process is ready (PID $PID)."
+    exit 0
+  fi
+  sleep 0.5
+done
+
+echo "Process is running (PID $PID) but not ready after 30s. Check $PROJECT_DIR/orchestrator.log"
+exit 1